@@ -1,39 +1,63 @@
-# add ../../liteindex/ to path for importing
+# compares function_cache with diskcache's memoize on a text embedding style workload,
+# every sentence of sents.txt is looked up once cold and once warm, diskcache is optional
+import os
 import sys
-sys.path.append("../../")
+import time
+import shutil
 
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", ".."))
 
-from liteindex import function_cache, EvictLRU, EvictAny
-from diskcache import Cache
+import numpy as np
+from liteindex import function_cache, EvictionCfg
+
+try:
+    from diskcache import Cache
+except ImportError:
+    Cache = None
 
 # from sentence_transformers import SentenceTransformer
 
-sentences = open("sents.txt").readlines()
+sentences = open(os.path.join(HERE, "sents.txt")).readlines()
 
-import numpy as np
-vec = np.random.rand(256)
+vec = np.random.default_rng(0).random(256)
 
 # model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
 
-@function_cache(dir="./embeddings_cache", eviction_policy=EvictAny)
-def get_embeddings(sentence):
-    return vec
+LITEINDEX_PATH = os.path.join(HERE, "embeddings_cache.db")
+DISKCACHE_DIR = os.path.join(HERE, "diskcache_embeddings_cache")
 
+for path in [LITEINDEX_PATH, LITEINDEX_PATH + "-wal", LITEINDEX_PATH + "-shm"]:
+    if os.path.exists(path):
+        os.remove(path)
+shutil.rmtree(DISKCACHE_DIR, ignore_errors=True)
 
-cache = Cache("./diskcache_embeddings_cache")
 
-@cache.memoize()
-def get_embeddings_diskcache(sentence):
+@function_cache(path=LITEINDEX_PATH, eviction_policy=EvictionCfg.EvictAny)
+def get_embeddings(sentence):
     return vec
 
 
+benchmarked = [("liteindex", get_embeddings)]
 
+if Cache is not None:
+    cache = Cache(DISKCACHE_DIR)
 
-from tqdm import tqdm
+    @cache.memoize()
+    def get_embeddings_diskcache(sentence):
+        return vec
 
-for sentence in tqdm(sentences):
-    get_embeddings(sentence)
+    benchmarked.append(("diskcache", get_embeddings_diskcache))
+else:
+    print("diskcache is not installed, only benchmarking liteindex")
 
-for sentence in tqdm(sentences):
-    get_embeddings_diskcache(sentence)
+for name, func in benchmarked:
+    for run in ["cold", "warm"]:
+        started_at = time.perf_counter()
+        for sentence in sentences:
+            func(sentence)
+        seconds = time.perf_counter() - started_at
 
+        print(
+            f"{name:10} {run}: {len(sentences) / seconds:10.1f} calls/s, {seconds:.2f}s"
+        )
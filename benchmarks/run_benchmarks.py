@@ -0,0 +1,497 @@
+# Benchmarks for KVIndex and function_cache hot paths.
+#
+#   python benchmarks/run_benchmarks.py                          # run everything, print a table
+#   python benchmarks/run_benchmarks.py --output results.json    # also write the results as json
+#   python benchmarks/run_benchmarks.py --save-baseline          # store as benchmarks/baseline.json
+#   python benchmarks/run_benchmarks.py --baseline baseline.json # compare, exit 1 on a regression
+#   python benchmarks/run_benchmarks.py --filter evict --quick   # a subset, with fewer operations
+#
+# every workload uses its own fixed seed and a fresh file, each one is run --repeat times and the
+# fastest run is kept, it is the least affected by noise from the rest of the machine.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import gc
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import platform
+import tempfile
+import threading
+import multiprocessing
+
+from liteindex import KVIndex, EvictionCfg, function_cache
+
+DEFAULT_BASELINE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+
+NUMBER_OF_KEYS = 20000
+
+VALUE_SIZES = {
+    "number": lambda rng: rng.random(),
+    "small_str": lambda rng: "".join(
+        rng.choices("abcdefghij", k=rng.randint(8, 64))
+    ),
+    "1kb_bytes": lambda rng: rng.randbytes(1024),
+    "64kb_bytes": lambda rng: rng.randbytes(64 * 1024),
+    "mixed": lambda rng: rng.choice(
+        [rng.random(), "x" * rng.randint(1, 256), rng.randbytes(rng.randint(1, 4096))]
+    ),
+}
+
+EVICTION_POLICIES = {
+    "none": EvictionCfg.EvictNone,
+    "lru": EvictionCfg.EvictLRU,
+    "lfu": EvictionCfg.EvictLFU,
+    "fifo": EvictionCfg.EvictFIFO,
+    "any": EvictionCfg.EvictAny,
+}
+
+# (get, set, getvalues, update) weights
+OPERATION_MIXES = {
+    "read_heavy": (90, 10, 0, 0),
+    "write_heavy": (10, 90, 0, 0),
+    "batched": (0, 0, 80, 20),
+    "balanced": (40, 30, 20, 10),
+}
+
+BATCH_SIZE = 64
+
+
+def make_keys(n):
+    return [f"key_{i}" for i in range(n)]
+
+
+def fill(index, keys, value_factory, rng):
+    for i in range(0, len(keys), 1000):
+        index.update({key: value_factory(rng) for key in keys[i : i + 1000]})
+
+
+def run_mix(index, keys, value_factory, weights, number_of_operations, seed):
+    rng = random.Random(seed)
+    operations = rng.choices(
+        ["get", "set", "getvalues", "update"], weights, k=number_of_operations
+    )
+
+    for operation in operations:
+        if operation == "get":
+            index.get(rng.choice(keys))
+        elif operation == "set":
+            index[rng.choice(keys)] = value_factory(rng)
+        elif operation == "getvalues":
+            index.getvalues(rng.sample(keys, BATCH_SIZE))
+        else:
+            index.update(
+                {key: value_factory(rng) for key in rng.sample(keys, BATCH_SIZE)}
+            )
+
+    return number_of_operations
+
+
+def workload_operation_mix(db_dir, mix, number_of_operations):
+    rng = random.Random(1)
+    keys = make_keys(NUMBER_OF_KEYS)
+    index = KVIndex(os.path.join(db_dir, "kv.db"))
+    fill(index, keys, VALUE_SIZES["small_str"], rng)
+
+    def run():
+        return run_mix(
+            index,
+            keys,
+            VALUE_SIZES["small_str"],
+            OPERATION_MIXES[mix],
+            number_of_operations,
+            2,
+        )
+
+    return run
+
+
+def workload_eviction(db_dir, policy, number_of_operations):
+    rng = random.Random(3)
+    keys = make_keys(NUMBER_OF_KEYS)
+    index = KVIndex(
+        os.path.join(db_dir, "kv.db"),
+        eviction=EvictionCfg(
+            EVICTION_POLICIES[policy],
+            max_number_of_items=NUMBER_OF_KEYS // 2
+            if EVICTION_POLICIES[policy]
+            else 0,
+        ),
+    )
+    fill(index, keys, VALUE_SIZES["small_str"], rng)
+
+    def run():
+        return run_mix(
+            index,
+            keys,
+            VALUE_SIZES["small_str"],
+            OPERATION_MIXES["balanced"],
+            number_of_operations,
+            4,
+        )
+
+    return run
+
+
+def workload_value_size(db_dir, size, number_of_operations):
+    rng = random.Random(5)
+    # large values are benchmarked on fewer keys to keep the file small
+    keys = make_keys(
+        NUMBER_OF_KEYS if size != "64kb_bytes" else NUMBER_OF_KEYS // 10
+    )
+    index = KVIndex(os.path.join(db_dir, "kv.db"))
+    fill(index, keys, VALUE_SIZES[size], rng)
+
+    def run():
+        return run_mix(
+            index,
+            keys,
+            VALUE_SIZES[size],
+            OPERATION_MIXES["balanced"],
+            number_of_operations,
+            6,
+        )
+
+    return run
+
+
+def _concurrent_worker(db_path, seed, number_of_operations):
+    index = KVIndex(db_path)
+    run_mix(
+        index,
+        make_keys(NUMBER_OF_KEYS),
+        VALUE_SIZES["small_str"],
+        OPERATION_MIXES["read_heavy"],
+        number_of_operations,
+        seed,
+    )
+
+
+def workload_concurrency(db_dir, kind, number_of_operations, workers=4):
+    db_path = os.path.join(db_dir, "kv.db")
+    fill(
+        KVIndex(db_path),
+        make_keys(NUMBER_OF_KEYS),
+        VALUE_SIZES["small_str"],
+        random.Random(7),
+    )
+
+    def run():
+        per_worker = number_of_operations // workers
+
+        if kind == "threads":
+            index = KVIndex(db_path)
+            keys = make_keys(NUMBER_OF_KEYS)
+            runners = [
+                threading.Thread(
+                    target=run_mix,
+                    args=(
+                        index,
+                        keys,
+                        VALUE_SIZES["small_str"],
+                        OPERATION_MIXES["read_heavy"],
+                        per_worker,
+                        seed,
+                    ),
+                )
+                for seed in range(workers)
+            ]
+        else:
+            runners = [
+                multiprocessing.Process(
+                    target=_concurrent_worker, args=(db_path, seed, per_worker)
+                )
+                for seed in range(workers)
+            ]
+
+        for runner in runners:
+            runner.start()
+        for runner in runners:
+            runner.join()
+
+        return per_worker * workers
+
+    return run
+
+
+def workload_function_cache(db_dir, hit_ratio, number_of_operations):
+    @function_cache(
+        path=os.path.join(db_dir, "cache.db"),
+        eviction_policy=EvictionCfg.EvictNone,
+        max_number_of_items=0,
+    )
+    def square(x):
+        return x * x
+
+    # 0 .. number_of_cached - 1 are cached, misses use arguments never seen before
+    rng = random.Random(8)
+    number_of_cached = 1000
+    for x in range(number_of_cached):
+        square(x)
+
+    runs = [0]
+
+    def run():
+        runs[0] += 1
+        miss = number_of_cached + runs[0] * number_of_operations
+        for _ in range(number_of_operations):
+            if rng.random() < hit_ratio:
+                square(rng.randrange(number_of_cached))
+            else:
+                square(miss)
+                miss += 1
+
+        return number_of_operations
+
+    return run
+
+
+def workload_bloom_filter(db_dir, argument, number_of_operations):
+    # lookups of keys that were never stored, with and without the bloom filter. "set" overwrites
+    # stored keys, it is what the filter costs every write
+    bloom_filter, operation = argument
+    rng = random.Random(9)
+    keys = make_keys(NUMBER_OF_KEYS)
+    index = KVIndex(os.path.join(db_dir, "kv.db"), bloom_filter=bloom_filter)
+    fill(index, keys, VALUE_SIZES["small_str"], rng)
+
+    @function_cache(
+        path=os.path.join(db_dir, "cache.db"),
+        eviction_policy=EvictionCfg.EvictNone,
+        max_number_of_items=0,
+        bloom_filter=bloom_filter,
+    )
+    def square(x):
+        return x * x
+
+    for x in range(NUMBER_OF_KEYS):
+        square(-x)
+
+    runs = [0]
+
+    def run():
+        runs[0] += 1
+        missing = [
+            f"missing_{runs[0]}_{i}" for i in range(number_of_operations)
+        ]
+
+        if operation == "contains":
+            for key in missing:
+                key in index
+        elif operation == "get":
+            for key in missing:
+                index.get(key)
+        elif operation == "getvalues":
+            for i in range(0, number_of_operations, BATCH_SIZE):
+                index.getvalues(missing[i : i + BATCH_SIZE])
+        elif operation == "set":
+            for key in rng.choices(keys, k=number_of_operations):
+                index[key] = VALUE_SIZES["small_str"](rng)
+        else:
+            for i in range(number_of_operations):
+                square(1 + runs[0] * number_of_operations + i)
+
+        return number_of_operations
+
+    return run
+
+
+def all_workloads(scale):
+    workloads = {}
+
+    for mix in OPERATION_MIXES:
+        workloads[f"mix/{mix}"] = (
+            workload_operation_mix,
+            mix,
+            int(20000 * scale),
+        )
+
+    for policy in EVICTION_POLICIES:
+        workloads[f"evict/{policy}"] = (
+            workload_eviction,
+            policy,
+            int(10000 * scale),
+        )
+
+    for size in VALUE_SIZES:
+        workloads[f"value_size/{size}"] = (
+            workload_value_size,
+            size,
+            int(5000 * scale),
+        )
+
+    for kind in ["threads", "processes"]:
+        workloads[f"concurrency/{kind}"] = (
+            workload_concurrency,
+            kind,
+            int(20000 * scale),
+        )
+
+    for hit_ratio in [0.0, 0.5, 0.9, 0.99]:
+        workloads[f"function_cache/hit_{hit_ratio}"] = (
+            workload_function_cache,
+            hit_ratio,
+            int(10000 * scale),
+        )
+
+    for bloom_filter in [False, True]:
+        for operation in ["contains", "get", "getvalues", "set", "function_cache"]:
+            workloads[
+                f"bloom/{'on' if bloom_filter else 'off'}_{operation}"
+            ] = (
+                workload_bloom_filter,
+                (bloom_filter, operation),
+                int(10000 * scale),
+            )
+
+    return workloads
+
+
+def run_workload(setup, argument, number_of_operations, repeat):
+    db_dir = tempfile.mkdtemp()
+    run = None
+
+    try:
+        run = setup(db_dir, argument, number_of_operations)
+
+        best = None
+        for _ in range(repeat):
+            gc.collect()
+            started_at = time.perf_counter()
+            ops = run()
+            seconds = time.perf_counter() - started_at
+
+            if best is None or seconds < best[0]:
+                best = (seconds, ops)
+
+        seconds, ops = best
+        return {
+            "ops": ops,
+            "seconds": round(seconds, 6),
+            "ops_per_second": round(ops / seconds, 2),
+        }
+    finally:
+        # closes the index before its files are removed
+        run = None
+        gc.collect()
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+def compare(results, baseline, tolerance):
+    # returns names of workloads slower than the baseline by more than tolerance
+    regressions = []
+
+    print(f"\n{'workload':40} {'baseline ops/s':>16} {'ops/s':>16} {'change':>9}")
+
+    for name, result in results.items():
+        if name not in baseline:
+            print(
+                f"{name:40} {'-':>16} {result['ops_per_second']:16.1f} {'new':>9}"
+            )
+            continue
+
+        before = baseline[name]["ops_per_second"]
+        change = result["ops_per_second"] / before - 1
+        marker = ""
+        if change < -tolerance:
+            marker = " slower"
+            regressions.append(name)
+        elif change > tolerance:
+            marker = " faster"
+
+        print(
+            f"{name:40} {before:16.1f} {result['ops_per_second']:16.1f} {change:+8.1%}{marker}"
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for KVIndex and function_cache hot paths"
+    )
+    parser.add_argument(
+        "--filter", default=None, help="only run workloads whose name contains this"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--quick", action="store_true", help="10x fewer operations per workload"
+    )
+    parser.add_argument(
+        "--output", default=None, help="write results to this json file"
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="compare against this results file"
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help=f"write results to {DEFAULT_BASELINE}",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="allowed slowdown before failing, 0.1 is 10%%",
+    )
+    args = parser.parse_args()
+
+    workloads = all_workloads(0.1 if args.quick else 1)
+
+    results = {}
+    for name, (setup, argument, number_of_operations) in workloads.items():
+        if args.filter and args.filter not in name:
+            continue
+
+        results[name] = run_workload(
+            setup, argument, number_of_operations, args.repeat
+        )
+        print(f"{name:40} {results[name]['ops_per_second']:16.1f} ops/s", flush=True)
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "quick": args.quick,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(DEFAULT_BASELINE, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline["meta"].get("quick") != args.quick:
+            print(
+                "\nbaseline was recorded with a different --quick setting, numbers are not comparable"
+            )
+
+        regressions = compare(results, baseline["results"], args.tolerance)
+        if regressions:
+            print(
+                f"\n{len(regressions)} workloads slower than the baseline: {', '.join(regressions)}"
+            )
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 from .defined_index import DefinedIndex, get_defined_index_names_in_db
 from .defined_serializers import DefinedTypes
 from .kv_index import KVIndex
+from .tiered_kv_index import TieredKVIndex
 from .function_cache import function_cache
 from .common_utils import EvictionCfg
+from .fingerprint import fingerprint, register_fingerprinter
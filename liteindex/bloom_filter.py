@@ -0,0 +1,404 @@
+import os
+import sys
+import math
+import mmap
+from array import array
+
+from .kv_index_utils import in_list_batches
+
+# Bloom filter over kv_index.key_hash, persisted in the same file so that every process shares it.
+# table names below are for the default name, kv_index is replaced by the index's name.
+#
+#   TABLE kv_index_bloom_filter: chunk_index INTEGER PRIMARY KEY, words BLOB
+#   TABLE kv_index_bloom_filter_log: version INTEGER PRIMARY KEY, key_hash BLOB
+#
+# blocked bloom filter: all bits of a key are in one 512 bit block (8 consecutive words), a lookup reads
+# one block and a write touches one block. the block and the bits in it come from key_hash folded into
+# 61 bits and mixed with murmur3's fmix64, cheaper than a second cryptographic hash and the same on every
+# platform, unlike hash().
+#
+# a trigger on kv_index appends the key_hash of every new key to the log, writes don't run any
+# statement of their own and connections that don't know about the filter keep it up to date too.
+# readers replay the log rows after the version they last saw. every _LOG_FOLD_ROWS new keys a writer
+# folds the log into kv_index_bloom_filter, stored in chunks of _CHUNK_WORDS little endian words so a
+# fold rewrites at most the whole filter once instead of a row per bit. the last _LOG_MAX_ROWS folded
+# rows are kept for readers that are behind, readers further behind reload fully.
+#
+# deleted keys can't be removed from a bloom filter, rebuild() re-creates it from the keys
+# currently in kv_index and bumps bloom_filter_epoch, readers seeing a new epoch reload fully.
+#
+# a negative is only answered once the in-memory copy has every commit. WalChangeCounter reads the commit
+# counter sqlite keeps in <db>-shm without a query, without it (":memory:", no wal) PRAGMA data_version is used.
+#
+# kv_index_num_metadata keys: bloom_filter_num_bits, bloom_filter_num_hashes, bloom_filter_epoch,
+# bloom_filter_folded (last log version in kv_index_bloom_filter), bloom_filter_rebuild_at (number of
+# keys the filter's set bits estimate, above which it is rebuilt)
+
+_LOG_MAX_ROWS = 10000
+_LOG_FOLD_ROWS = 10000
+# words per row of kv_index_bloom_filter
+_CHUNK_WORDS = 128
+
+_WORD_MASK = (1 << 64) - 1
+_P61 = (1 << 61) - 1
+_BLOCK_BITS = 512
+
+
+# int.bit_count is python 3.10+
+_popcount = getattr(int, "bit_count", None) or (lambda word: bin(word).count("1"))
+
+
+def _words_to_bytes(words):
+    if sys.byteorder == "big":
+        words = array("Q", words)
+        words.byteswap()
+    return words.tobytes()
+
+
+def _words_from_bytes(data):
+    words = array("Q", data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+
+class BloomFilter:
+    def __init__(self, num_bits, num_hashes, rebuild_at=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.rebuild_at = rebuild_at
+        self.num_blocks = num_bits // _BLOCK_BITS
+        self.words = array("Q", bytes(8 * (num_bits // 64)))
+        self.num_bits_set = 0
+
+    @staticmethod
+    def size_for(capacity, error_rate):
+        # uneven block fill raises the false positive rate of a blocked filter, 30% more bits make up for it
+        num_bits = max(
+            int(-capacity * math.log(error_rate * 0.7) / (math.log(2) ** 2)),
+            _BLOCK_BITS,
+        )
+        num_bits = -(-num_bits // _BLOCK_BITS) * _BLOCK_BITS
+        num_hashes = max(int(round(num_bits / capacity * math.log(2))), 1)
+
+        return num_bits, num_hashes
+
+    @property
+    def capacity(self):
+        return self.num_bits * math.log(2) / self.num_hashes
+
+    def may_contain(self, key_hash):
+        # the block from the high bits, bits inside it stepping by an odd number so they never repeat.
+        # key_hash folded into 61 bits and mixed with fmix64, inlined since this is on every lookup
+        h = int.from_bytes(key_hash, "little") % _P61
+        h = (h ^ h >> 33) * 0xFF51AFD7ED558CCD & _WORD_MASK
+        h = (h ^ h >> 33) * 0xC4CEB9FE1A85EC53 & _WORD_MASK
+        h ^= h >> 33
+
+        words = self.words
+        block = (h >> 28) % self.num_blocks << 3
+        offset, step = h & 511, h >> 9 & 511 | 1
+        for _ in range(self.num_hashes):
+            if not words[block | offset >> 6] >> (offset & 63) & 1:
+                return False
+            offset = offset + step & 511
+        return True
+
+    def add(self, key_hashes):
+        # same bits as may_contain()
+        words = self.words
+        num_blocks, num_hashes = self.num_blocks, self.num_hashes
+        num_bits_set = self.num_bits_set
+        for key_hash in key_hashes:
+            h = int.from_bytes(key_hash, "little") % _P61
+            h = (h ^ h >> 33) * 0xFF51AFD7ED558CCD & _WORD_MASK
+            h = (h ^ h >> 33) * 0xC4CEB9FE1A85EC53 & _WORD_MASK
+            h ^= h >> 33
+
+            block = (h >> 28) % num_blocks << 3
+            offset, step = h & 511, h >> 9 & 511 | 1
+            for _ in range(num_hashes):
+                word_index = block | offset >> 6
+                word, bit = words[word_index], 1 << (offset & 63)
+                if not word & bit:
+                    words[word_index] = word | bit
+                    num_bits_set += 1
+                offset = offset + step & 511
+        self.num_bits_set = num_bits_set
+
+    def chunks(self):
+        # (chunk_index, words as little endian bytes) of every chunk with a bit set
+        for start in range(0, len(self.words), _CHUNK_WORDS):
+            chunk = _words_to_bytes(self.words[start : start + _CHUNK_WORDS])
+            if chunk.strip(b"\x00"):
+                yield start // _CHUNK_WORDS, chunk
+
+    def merge_chunks(self, chunks):
+        words = self.words
+        for chunk_index, chunk in chunks:
+            start = chunk_index * _CHUNK_WORDS
+            old_words = words[start : start + _CHUNK_WORDS]
+            old = int.from_bytes(_words_to_bytes(old_words), "little")
+            new = old | int.from_bytes(chunk, "little")
+            if new != old:
+                words[start : start + len(old_words)] = _words_from_bytes(
+                    new.to_bytes(8 * len(old_words), "little")
+                )
+                self.num_bits_set += _popcount(new ^ old)
+
+    def estimated_count(self):
+        # number of distinct keys that set this many bits, overwrites of a stored key don't add to it
+        if self.num_bits_set >= self.num_bits:
+            return math.inf
+        return (
+            -self.num_bits
+            / self.num_hashes
+            * math.log(1 - self.num_bits_set / self.num_bits)
+        )
+
+    def needs_rebuild(self):
+        return self.rebuild_at is not None and self.estimated_count() >= self.rebuild_at
+
+
+class WalChangeCounter:
+    # the wal-index header at the start of <db>-shm (https://www.sqlite.org/walformat.html) is two copies
+    # of 48 bytes, iChange at offset 8 is incremented by every commit from any connection or process.
+    # sqlite truncates or deletes the shm file only when no connection has it open, conn keeps one open
+    # for as long as the mapping is used
+    def __init__(self, conn, db_path):
+        # a read maps the shm file
+        conn.execute("SELECT 1 FROM sqlite_master").fetchall()
+
+        with open(db_path + "-shm", "rb") as f:
+            self.__shm = mmap.mmap(f.fileno(), 136, access=mmap.ACCESS_READ)
+
+        self.conn = conn
+        self.pid = os.getpid()
+
+    @classmethod
+    def open(cls, connect, db_path):
+        # None if the database has no shm file to read
+        if db_path == ":memory:" or db_path.startswith("file:"):
+            return None
+
+        conn = connect()
+        try:
+            return cls(conn, db_path)
+        except (OSError, ValueError):
+            conn.close()
+            return None
+
+    def header(self):
+        # None while a commit is half way through writing it
+        header = self.__shm[:48]
+        return header if header == self.__shm[48:96] else None
+
+    @staticmethod
+    def commits_between(before, after):
+        return (
+            int.from_bytes(after[8:12], sys.byteorder)
+            - int.from_bytes(before[8:12], sys.byteorder)
+        ) & 0xFFFFFFFF
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.conn.close()
+
+
+def bloom_filter_exists(conn, table_name="kv_index"):
+    return (
+        conn.execute(
+            f"""SELECT 1 FROM "{table_name}_num_metadata" WHERE key = 'bloom_filter_num_bits'"""
+        ).fetchone()
+        is not None
+    )
+
+
+def __get_metadata(conn, table_name, key):
+    return conn.execute(
+        f"""SELECT num FROM "{table_name}_num_metadata" WHERE key = ?""", (key,)
+    ).fetchone()[0]
+
+
+def __new_bloom_filter(conn, table_name):
+    return BloomFilter(
+        __get_metadata(conn, table_name, "bloom_filter_num_bits"),
+        __get_metadata(conn, table_name, "bloom_filter_num_hashes"),
+    )
+
+
+def __store_chunks(conn, table_name, bloom_filter):
+    conn.executemany(
+        f"""INSERT OR REPLACE INTO "{table_name}_bloom_filter" (chunk_index, words) VALUES (?, ?)""",
+        bloom_filter.chunks(),
+    )
+
+
+def create_bloom_filter(conn, table_name, capacity, error_rate):
+    # size is fixed when the filter is first created, later opens use the stored size
+    if bloom_filter_exists(conn, table_name):
+        return
+
+    num_bits, num_hashes = BloomFilter.size_for(capacity, error_rate)
+
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{table_name}_bloom_filter" (chunk_index INTEGER PRIMARY KEY, words BLOB)"""
+    )
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{table_name}_bloom_filter_log" (version INTEGER PRIMARY KEY, key_hash BLOB)"""
+    )
+
+    # overwrites of a stored key are already in the filter, it was logged when it was first inserted.
+    # the newest log row is never deleted, so versions keep increasing without AUTOINCREMENT
+    conn.execute(
+        f"""
+        CREATE TRIGGER IF NOT EXISTS "{table_name}_bloom_filter_insert"
+        BEFORE INSERT ON "{table_name}"
+        WHEN NOT EXISTS (SELECT 1 FROM "{table_name}" WHERE key_hash = NEW.key_hash)
+        BEGIN
+            INSERT INTO "{table_name}_bloom_filter_log" (key_hash) VALUES (NEW.key_hash);
+        END;
+        """
+    )
+
+    conn.executemany(
+        f"""INSERT OR IGNORE INTO "{table_name}_num_metadata" (key, num) VALUES (?, ?)""",
+        (
+            ("bloom_filter_num_bits", num_bits),
+            ("bloom_filter_num_hashes", num_hashes),
+            ("bloom_filter_epoch", 0),
+            ("bloom_filter_folded", 0),
+            ("bloom_filter_rebuild_at", capacity),
+        ),
+    )
+
+    rebuild_bloom_filter(conn, table_name)
+
+
+def rebuild_bloom_filter(conn, table_name="kv_index", if_epoch=None):
+    # with if_epoch, only rebuilds if no one else did since that epoch was read. returns whether it rebuilt
+    bloom_filter = __new_bloom_filter(conn, table_name)
+
+    # bumping the epoch first takes the write lock, no other writer can insert keys during the scan
+    if (
+        conn.execute(
+            f"""UPDATE "{table_name}_num_metadata" SET num = num + 1 WHERE key = 'bloom_filter_epoch' AND (? IS NULL OR num = ?) RETURNING num""",
+            (if_epoch, if_epoch),
+        ).fetchone()
+        is None
+    ):
+        return False
+
+    number_of_keys = 0
+    for (key_hash,) in conn.execute(f'SELECT key_hash FROM "{table_name}"'):
+        bloom_filter.add([key_hash])
+        number_of_keys += 1
+
+    # every logged key is in the scan, readers of the old epoch reload fully anyway
+    conn.execute(f'DELETE FROM "{table_name}_bloom_filter"')
+    __store_chunks(conn, table_name, bloom_filter)
+    conn.execute(
+        f"""UPDATE "{table_name}_num_metadata" SET num = (SELECT IFNULL(MAX(version), 0) FROM "{table_name}_bloom_filter_log") WHERE key = 'bloom_filter_folded'"""
+    )
+
+    # rebuilding scans every key, doing it only once the filter holds as many keys again keeps the cost amortized
+    conn.execute(
+        f"""UPDATE "{table_name}_num_metadata" SET num = ? WHERE key = 'bloom_filter_rebuild_at'""",
+        (max(int(bloom_filter.capacity), 2 * number_of_keys),),
+    )
+
+    return True
+
+
+def fold_bloom_filter(conn, table_name="kv_index", min_rows=_LOG_FOLD_ROWS):
+    # adds the keys of log rows not folded yet to kv_index_bloom_filter once there are min_rows of them,
+    # called inside a write transaction. returns whether it folded
+    folded, version = conn.execute(
+        f"""SELECT (SELECT num FROM "{table_name}_num_metadata" WHERE key = 'bloom_filter_folded'), (SELECT IFNULL(MAX(version), 0) FROM "{table_name}_bloom_filter_log")"""
+    ).fetchone()
+
+    if version - folded < max(min_rows, 1):
+        return False
+
+    bloom_filter = __new_bloom_filter(conn, table_name)
+    bloom_filter.add(
+        key_hash
+        for (key_hash,) in conn.execute(
+            f"""SELECT key_hash FROM "{table_name}_bloom_filter_log" WHERE version > ? AND version <= ?""",
+            (folded, version),
+        )
+    )
+
+    # only the chunks these keys set bits in
+    chunk_indexes = [chunk_index for chunk_index, _ in bloom_filter.chunks()]
+    for placeholders, batch in in_list_batches(chunk_indexes):
+        bloom_filter.merge_chunks(
+            conn.execute(
+                f"""SELECT chunk_index, words FROM "{table_name}_bloom_filter" WHERE chunk_index IN ({placeholders})""",
+                batch,
+            )
+        )
+    __store_chunks(conn, table_name, bloom_filter)
+
+    conn.execute(
+        f"""UPDATE "{table_name}_num_metadata" SET num = ? WHERE key = 'bloom_filter_folded'""",
+        (version,),
+    )
+    conn.execute(
+        f"""DELETE FROM "{table_name}_bloom_filter_log" WHERE version <= ?""",
+        (version - _LOG_MAX_ROWS,),
+    )
+
+    return True
+
+
+def load_bloom_filter(
+    conn, table_name="kv_index", bloom_filter=None, since_epoch=None, since_version=None
+):
+    # returns (bloom_filter, epoch, version), a fresh filter if the epoch changed, none was given or
+    # the log no longer has the row of since_version. epoch is read before the rows, a rebuild
+    # committed meanwhile only makes the next call reload again
+    epoch, rebuild_at = conn.execute(
+        f"""SELECT (SELECT num FROM "{table_name}_num_metadata" WHERE key = 'bloom_filter_epoch'), (SELECT num FROM "{table_name}_num_metadata" WHERE key = 'bloom_filter_rebuild_at')"""
+    ).fetchone()
+
+    rows = None
+    if bloom_filter is not None and epoch == since_epoch:
+        rows = conn.execute(
+            f"""SELECT version, key_hash FROM "{table_name}_bloom_filter_log" WHERE version >= ? ORDER BY version""",
+            (since_version,),
+        ).fetchall()
+
+        # the first row is the last one already applied, or the first one ever written. otherwise
+        # rows were deleted since
+        if rows and rows[0][0] == since_version:
+            del rows[0]
+        elif since_version or rows and rows[0][0] != 1:
+            rows = None
+
+    if rows is None:
+        bloom_filter = __new_bloom_filter(conn, table_name)
+
+        # one read transaction, a fold committed in between can't move rows from the log into the words unseen
+        started = not conn.in_transaction
+        if started:
+            conn.execute("BEGIN")
+        try:
+            since_version = __get_metadata(conn, table_name, "bloom_filter_folded")
+            bloom_filter.merge_chunks(
+                conn.execute(
+                    f'SELECT chunk_index, words FROM "{table_name}_bloom_filter"'
+                )
+            )
+            rows = conn.execute(
+                f"""SELECT version, key_hash FROM "{table_name}_bloom_filter_log" WHERE version > ? ORDER BY version""",
+                (since_version,),
+            ).fetchall()
+        finally:
+            if started:
+                conn.execute("COMMIT")
+
+    bloom_filter.rebuild_at = rebuild_at
+    bloom_filter.add(key_hash for _, key_hash in rows)
+
+    return bloom_filter, epoch, rows[-1][0] if rows else since_version
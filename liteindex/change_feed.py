@@ -0,0 +1,156 @@
+import time
+
+# A change feed is an append-only table written by plain SQL triggers on the watched table.
+# Because no python function is involved, writes from every process and connection are logged.
+#
+#   TABLE <feed_table>: seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, changed_at REAL, <key columns>
+#
+# op is one of "set", "delete" or "clear". seq is the cursor handed out to watchers,
+# AUTOINCREMENT guarantees it is never reused even after old rows are compacted away.
+# Compaction runs inside a trigger on the feed table itself, every `compact_every` inserts
+# rows older than the last `max_rows` are deleted.
+
+_NOW_SQL = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+def create_change_feed(
+    conn,
+    table_name,
+    feed_table_name,
+    key_columns,
+    max_rows=100000,
+    update_of_columns=None,
+):
+    if max_rows < 1:
+        raise ValueError("max_rows must be at least 1")
+
+    compact_every = max(min(max_rows // 10, 1000), 1)
+
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{feed_table_name}" (seq INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT, changed_at REAL, {', '.join([f'"{col}"' for col in key_columns])})"""
+    )
+
+    create_change_feed_triggers(
+        conn, table_name, feed_table_name, key_columns, update_of_columns
+    )
+
+    # retention can be changed by re-enabling the feed, so the compaction trigger is always re-created
+    conn.execute(f'''DROP TRIGGER IF EXISTS "{feed_table_name}_compact"''')
+    conn.execute(
+        f"""
+        CREATE TRIGGER "{feed_table_name}_compact"
+        AFTER INSERT ON "{feed_table_name}"
+        WHEN NEW.seq % {compact_every} = 0
+        BEGIN
+            DELETE FROM "{feed_table_name}" WHERE seq <= NEW.seq - {max_rows};
+        END;
+        """
+    )
+
+
+def create_change_feed_triggers(
+    conn, table_name, feed_table_name, key_columns, update_of_columns=None
+):
+    # triggers live on the watched table and are dropped along with it, the feed table and its compaction trigger are not
+    key_columns_str = ", ".join([f'"{col}"' for col in key_columns])
+
+    for event, op, ref in (
+        ("INSERT", "set", "NEW"),
+        ("UPDATE", "set", "NEW"),
+        ("DELETE", "delete", "OLD"),
+    ):
+        of_columns = (
+            f""" OF {', '.join([f'"{col}"' for col in update_of_columns])}"""
+            if event == "UPDATE" and update_of_columns
+            else ""
+        )
+
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS "{feed_table_name}_{event.lower()}"
+            AFTER {event}{of_columns} ON "{table_name}"
+            BEGIN
+                INSERT INTO "{feed_table_name}" (op, changed_at, {key_columns_str})
+                VALUES ('{op}', {_NOW_SQL}, {', '.join([f'{ref}."{col}"' for col in key_columns])});
+            END;
+            """
+        )
+
+
+def drop_change_feed(conn, feed_table_name):
+    for suffix in ("insert", "update", "delete", "compact"):
+        conn.execute(f'''DROP TRIGGER IF EXISTS "{feed_table_name}_{suffix}"''')
+
+    conn.execute(f'''DROP TABLE IF EXISTS "{feed_table_name}"''')
+
+
+def change_feed_exists(conn, feed_table_name):
+    return (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?",
+            (feed_table_name,),
+        ).fetchone()
+        is not None
+    )
+
+
+def log_change(conn, feed_table_name, op):
+    conn.execute(
+        f"""INSERT INTO "{feed_table_name}" (op, changed_at) VALUES (?, {_NOW_SQL})""",
+        (op,),
+    )
+
+
+def latest_cursor(conn, feed_table_name):
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = ?", (feed_table_name,)
+    ).fetchone()
+
+    return row[0] if row else 0
+
+
+def watch_changes(
+    get_connection,
+    feed_table_name,
+    key_columns,
+    since=None,
+    poll_interval=0.1,
+    timeout=None,
+    batch_size=1000,
+):
+    # get_connection is called on every poll so that the calling thread's connection is used
+    # even if the generator is handed over between threads
+
+    if since is None:
+        since = latest_cursor(get_connection(), feed_table_name)
+    else:
+        oldest = get_connection().execute(
+            f'''SELECT MIN(seq) FROM "{feed_table_name}"'''
+        ).fetchone()[0]
+
+        # 0 replays every retained change, any other cursor older than the feed missed changes
+        if oldest is not None and since != 0 and since + 1 < oldest:
+            raise ValueError(
+                f"cursor {since} is older than the retained change feed (oldest is {oldest}), re-sync and watch from the latest cursor"
+            )
+
+    sql = f"""SELECT seq, op, {', '.join([f'"{col}"' for col in key_columns])} FROM "{feed_table_name}" WHERE seq > ? ORDER BY seq LIMIT ?"""
+
+    last_change_seen_at = time.time()
+
+    while True:
+        rows = get_connection().execute(sql, (since, batch_size)).fetchall()
+
+        for row in rows:
+            since = row[0]
+            yield row
+
+        if rows:
+            last_change_seen_at = time.time()
+            if len(rows) == batch_size:
+                continue
+
+        if timeout is not None and time.time() - last_change_seen_at >= timeout:
+            return
+
+        time.sleep(poll_interval)
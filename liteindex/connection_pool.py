@@ -0,0 +1,207 @@
+import os
+import time
+import weakref
+import threading
+
+# Connections are leased to a thread on first use and stay with it while it is alive, so
+# `with index.__connection as conn` keeps working exactly like the old threading.local() setup.
+# The lease object lives in the pool's threading.local(), when the thread exits python drops it
+# and a weakref.finalize callback hands the connection back to the pool for the next thread.
+#
+# Connections are opened with check_same_thread=False by `connect` since they move between threads,
+# a connection is only ever used by the thread currently holding its lease.
+#
+# max_connections=None (the default) never makes a thread wait, with a number the thread that would
+# open one more connection waits up to wait_timeout for another thread to exit.
+#
+# close() only closes idle connections and refuses new leases, connections of live threads are closed
+# when their thread exits.
+#
+# After os.fork() the child sees a different pid, inherited connections are abandoned (never used or
+# closed by the child) and fresh ones are opened.
+
+
+class _Lease:
+    __slots__ = ("conn", "pid", "__weakref__")
+
+    def __init__(self, conn, pid):
+        self.conn = conn
+        self.pid = pid
+
+
+def _release(pool_ref, conn, pid):
+    if pid != os.getpid():
+        return
+
+    pool = pool_ref()
+    if pool is None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return
+
+    pool._put_back(conn, pid)
+
+
+class ConnectionPool:
+    def __init__(
+        self, connect, max_connections=None, idle_timeout=60, wait_timeout=60
+    ):
+        self.connect = connect
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+
+        self.__pid = os.getpid()
+        self.__condition = threading.Condition()
+        self.__local_storage = threading.local()
+
+        # [(conn, released_at), ...], most recently released last
+        self.__idle = []
+        self.__in_use = 0
+        self.__closed = False
+
+        self.__stats = {
+            "created": 0,
+            "reused": 0,
+            "closed_idle": 0,
+            "reopened_after_fork": 0,
+            "waited": 0,
+        }
+
+    def connection(self):
+        lease = getattr(self.__local_storage, "lease", None)
+
+        if lease is not None and lease.pid == self.__pid == os.getpid():
+            return lease.conn
+
+        conn = self.__acquire()
+
+        lease = _Lease(conn, self.__pid)
+        weakref.finalize(lease, _release, weakref.ref(self), conn, self.__pid)
+        self.__local_storage.lease = lease
+
+        return conn
+
+    def __reset_after_fork(self):
+        # the parent's lock may have been held at fork time, never touch it in the child
+        self.__pid = os.getpid()
+        self.__condition = threading.Condition()
+        self.__local_storage = threading.local()
+        self.__idle = []
+        self.__in_use = 0
+        self.__stats["reopened_after_fork"] += 1
+
+    def __close_expired_idle(self):
+        if not self.__idle:
+            return
+
+        now = time.time()
+        expired = [_ for _ in self.__idle if now - _[1] >= self.idle_timeout]
+
+        if expired:
+            self.__idle = [_ for _ in self.__idle if now - _[1] < self.idle_timeout]
+
+            for conn, _ in expired:
+                conn.close()
+
+            self.__stats["closed_idle"] += len(expired)
+
+    def __acquire(self):
+        if self.__pid != os.getpid():
+            self.__reset_after_fork()
+
+        with self.__condition:
+            if self.__closed:
+                raise Exception("Connection pool is closed")
+
+            self.__close_expired_idle()
+
+            started_waiting_at = None
+
+            while not self.__idle and (
+                self.max_connections is not None
+                and self.__in_use >= self.max_connections
+            ):
+                if started_waiting_at is None:
+                    started_waiting_at = time.time()
+                    self.__stats["waited"] += 1
+
+                remaining = self.wait_timeout - (time.time() - started_waiting_at)
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"All {self.max_connections} connections are in use by live threads"
+                    )
+
+                self.__condition.wait(remaining)
+
+            # the slot is reserved before connecting outside the lock
+            self.__in_use += 1
+
+            if self.__idle:
+                conn = self.__idle.pop()[0]
+                self.__stats["reused"] += 1
+                return conn
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self.__condition:
+                self.__in_use -= 1
+                self.__condition.notify()
+            raise
+
+        with self.__condition:
+            self.__stats["created"] += 1
+
+        return conn
+
+    def _put_back(self, conn, pid):
+        if pid != self.__pid:
+            return
+
+        with self.__condition:
+            self.__in_use -= 1
+
+            if self.__closed:
+                conn.close()
+                return
+
+            if conn.in_transaction:
+                conn.rollback()
+
+            self.__idle.append((conn, time.time()))
+            self.__close_expired_idle()
+            self.__condition.notify()
+
+    def close_idle(self):
+        with self.__condition:
+            for conn, _ in self.__idle:
+                conn.close()
+
+            self.__stats["closed_idle"] += len(self.__idle)
+            self.__idle = []
+
+    def close(self):
+        if self.__pid != os.getpid():
+            return
+
+        with self.__condition:
+            self.__closed = True
+
+            for conn, _ in self.__idle:
+                conn.close()
+
+            self.__idle = []
+            self.__condition.notify_all()
+
+    def stats(self):
+        with self.__condition:
+            return {
+                "open": self.__in_use + len(self.__idle),
+                "in_use": self.__in_use,
+                "idle": len(self.__idle),
+                "max_connections": self.max_connections,
+                **self.__stats,
+            }
@@ -22,6 +22,11 @@ try:
 except:
     zstandard = None
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 try:
     import vectorlite_py
 
@@ -31,6 +36,7 @@ except:
 
 
 from .query_parser import (
+    parse_query,
     search_query,
     distinct_query,
     distinct_count_query,
@@ -50,6 +56,68 @@ from .query_parser import (
     pop_query,
 )
 
+from .connection_pool import ConnectionPool
+from .json_index import (
+    json_path_column,
+    split_json_path,
+    create_json_value_index,
+    drop_json_value_index,
+    clear_json_value_index,
+    json_value_index_paths,
+)
+from .hybrid_search import (
+    FUSIONS,
+    FUSION_CANDIDATES_FACTOR,
+    fuse,
+    get_hybrid_search_executor,
+)
+from .change_feed import (
+    create_change_feed,
+    create_change_feed_triggers,
+    drop_change_feed,
+    change_feed_exists,
+    latest_cursor,
+    log_change,
+    watch_changes,
+)
+from .maintenance import auto_vacuum_mode, run_maintenance, MaintenanceSchedule
+from .embedding_index import (
+    create_settings_table,
+    embedding_index_settings,
+    create_embedding_index,
+    drop_embedding_index,
+    clear_embedding_index,
+    load_centroids,
+    assign_pending_rows,
+    probe_lists,
+    list_candidates,
+    distances_from_scores,
+    min_dots,
+    max_distance_of,
+    within_distance,
+    block_nearest,
+    json_ids,
+    FILTER_OVERSAMPLING,
+    estimated_row_count,
+    filtered_rows,
+    matching_integer_ids,
+)
+from .embedding_matrix import (
+    EmbeddingMatrix,
+    QUANTIZATIONS,
+    embedding_changes_table_name,
+)
+from .text_index import (
+    TEXT_INDEX_TYPES,
+    text_value,
+    text_index_keys,
+    create_text_index,
+    drop_text_index,
+    clear_text_index,
+    text_candidates,
+    pop_text_condition,
+)
+
 import threading
 
 
@@ -75,6 +143,9 @@ def get_defined_index_names_in_db(db_path):
 
 
 class DefinedIndex:
+    # __del__ also runs when __init__ raised before the pool was set
+    __connection_pool = None
+
     class Type:
         number = defined_serializers.DefinedTypes.number
         string = defined_serializers.DefinedTypes.string
@@ -101,8 +172,13 @@ class DefinedIndex:
         db_path=None,
         ram_cache_mb=64,
         compression_level=None,
-        auto_vacuum=True,
+        auto_vacuum="incremental",
         auto_vacuum_increment=1000,
+        maintenance_interval=60,
+        max_connections=None,
+        idle_connection_timeout=60,
+        statement_cache_size=128,
+        embedding_quantization=None,
     ):
         if sqlite3.sqlite_version < "3.35.0":
             raise ValueError(
@@ -114,16 +190,29 @@ class DefinedIndex:
         self.db_path = ":memory:" if db_path is None else db_path
         self.ram_cache_mb = ram_cache_mb
         self.compression_level = compression_level
-        self.auto_vacuum = auto_vacuum
+        self.auto_vacuum = auto_vacuum_mode(auto_vacuum)
         self.auto_vacuum_increment = auto_vacuum_increment
+        self.__maintenance_schedule = MaintenanceSchedule(maintenance_interval)
+        self.statement_cache_size = statement_cache_size
 
         if self.name.startswith("__"):
             raise ValueError("Index name cannot start with '__'")
 
         self.__meta_table_name = f"__{self.name}_meta"
+        self.__changes_table_name = f"__{self.name}_changes"
+        self.__embedding_indexes_table_name = f"__{self.name}_embedding_indexes"
+        # key -> (version, centroids) of its embedding index
+        self.__embedding_index_centroids = {}
+        # key -> EmbeddingMatrix, used for exact search when vectorlite is not available
+        self.__embedding_matrices = {}
         self.__column_names = ["id", "updated_at"]
 
         self.__local_storage = threading.local()
+        self.__connection_pool = ConnectionPool(
+            self.__connect,
+            max_connections=max_connections,
+            idle_timeout=idle_connection_timeout,
+        )
 
         if not self.db_path == ":memory:":
             db_dir = os.path.dirname(self.db_path).strip()
@@ -141,42 +230,97 @@ class DefinedIndex:
         self.__parse_schema()
         self.__create_table_and_meta_table()
 
+        # key -> "int8" or "binary", searched on a quantized in-memory copy and re-ranked exactly
+        self.embedding_quantization = embedding_quantization or {}
+        for key, quantization in self.embedding_quantization.items():
+            if self.schema.get(key) != "normalized_embedding":
+                raise ValueError(f"{key} is not a normalized_embedding key")
+            if quantization not in QUANTIZATIONS:
+                raise ValueError(
+                    f"Invalid quantization: {quantization}, can be one of int8, binary"
+                )
+
         self.__meta_schema = self.schema.copy()
         self.__meta_schema["updated_at"] = "number"
         self.__meta_schema["integer_id"] = "number"
 
+        # "key.a.b" json paths with a value index, membership queries on them look values up in it
+        self.__json_value_indexes = json_value_index_paths(
+            self.__connection, self.name, self.schema
+        )
+
     def __del__(self):
-        if self.__connection:
-            self.__connection.close()
+        if self.__connection_pool is None:
+            return
+
+        self.__connection_pool.close()
+
+    def __connect(self):
+        conn = sqlite3.connect(
+            self.db_path,
+            uri=True,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+        )
+        # has to come before journal_mode=WAL to take effect on a new file
+        conn.execute(f"PRAGMA auto_vacuum={self.auto_vacuum}")
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+
+        conn.execute(f"PRAGMA cache_size=-{self.ram_cache_mb * 1024}")
+
+        conn.execute(f"PRAGMA BUSY_TIMEOUT=60000")
+
+        if vectorlite_path is not None:
+            conn.enable_load_extension(True)
+            conn.load_extension(vectorlite_path)
+            conn.enable_load_extension(False)
+
+        # used by the triggers of text indexes on compressed_string keys
+        conn.create_function("liteindex_text", 1, text_value, deterministic=True)
+
+        return conn
 
     @property
     def __connection(self):
-        if (
-            not hasattr(self.__local_storage, "db_conn")
-            or self.__local_storage.db_conn is None
-        ):
-            self.__local_storage.db_conn = sqlite3.connect(self.db_path, uri=True)
-            self.__local_storage.db_conn.execute("PRAGMA journal_mode=WAL")
-            self.__local_storage.db_conn.execute("PRAGMA synchronous=NORMAL")
-
-            if self.auto_vacuum:
-                self.__local_storage.db_conn.execute("PRAGMA auto_vacuum=FULL")
-                self.__local_storage.db_conn.execute(
-                    f"PRAGMA auto_vacuum_increment={self.auto_vacuum_increment}"
-                )
+        return self.__connection_pool.connection()
 
-            self.__local_storage.db_conn.execute(
-                f"PRAGMA cache_size=-{self.ram_cache_mb * 1024}"
-            )
+    def connection_pool_stats(self):
+        """
+        Returns:
+            dict: open, in_use, idle connections and counters for created, reused, closed_idle, reopened_after_fork, waited
+        """
+        return self.__connection_pool.stats()
 
-            self.__local_storage.db_conn.execute(f"PRAGMA BUSY_TIMEOUT=60000")
+    def maintain(self, vacuum_pages=None, checkpoint="passive"):
+        """
+        Returns free pages to the filesystem and checkpoints the WAL, runs automatically after writes every maintenance_interval seconds
+
+        Args:
+            vacuum_pages (int): Max number of free pages to release, defaults to auto_vacuum_increment
+            checkpoint (str): WAL checkpoint mode, one of passive, full, restart, truncate or None to skip
+
+        Returns:
+            dict: freelist_count, vacuumed_pages, checkpoint_busy, wal_pages, checkpointed_pages
+        """
+        return run_maintenance(
+            self.__connection,
+            vacuum_pages=self.auto_vacuum_increment
+            if vacuum_pages is None
+            else vacuum_pages,
+            checkpoint=checkpoint,
+        )
 
-            if vectorlite_path is not None:
-                self.__local_storage.db_conn.enable_load_extension(True)
-                self.__local_storage.db_conn.load_extension(vectorlite_path)
-                self.__local_storage.db_conn.enable_load_extension(False)
+    def __maintain_if_due(self):
+        if not self.__maintenance_schedule.due():
+            return
 
-        return self.__local_storage.db_conn
+        try:
+            self.maintain()
+        except sqlite3.OperationalError:
+            # another connection holds the write lock, try again next interval
+            pass
 
     @property
     def __compressor(self):
@@ -286,6 +430,34 @@ class DefinedIndex:
                 [(key, value_type) for key, value_type in meta_columns],
             )
 
+            create_settings_table(
+                self.__connection, self.__embedding_indexes_table_name
+            )
+
+            # every embedding key's writes are logged for the in-memory embedding matrices of all processes,
+            # created here so that searches never write the schema. triggers are dropped with the table
+            for key, value_type in self.schema.items():
+                if value_type != "normalized_embedding":
+                    continue
+
+                feed_table_name = embedding_changes_table_name(self.name, key)
+                if change_feed_exists(self.__connection, feed_table_name):
+                    create_change_feed_triggers(
+                        self.__connection,
+                        table_name=self.name,
+                        feed_table_name=feed_table_name,
+                        key_columns=["integer_id"],
+                        update_of_columns=[key],
+                    )
+                else:
+                    create_change_feed(
+                        self.__connection,
+                        self.name,
+                        feed_table_name,
+                        ["integer_id"],
+                        update_of_columns=[key],
+                    )
+
     def update(self, data):
         ids_grouped_by_common_keys = {}
 
@@ -302,8 +474,6 @@ class DefinedIndex:
                 ids_grouped_by_common_keys[keys_in_current_data].append(_id)
 
         with self.__connection:
-            updated_at = time.time()
-
             for (
                 keys_in_current_data,
                 ids_group,
@@ -326,6 +496,10 @@ class DefinedIndex:
 
                 self.__connection.executemany(sql, yield_transaction())
 
+            self.__assign_pending_embeddings()
+
+        self.__maintain_if_due()
+
     def get(
         self,
         ids,
@@ -350,27 +524,27 @@ class DefinedIndex:
         columns = ", ".join([f'"{h}"' for h in select_keys])
         column_str = "id, " + columns
 
-        id_placeholders = ", ".join(["?" for _ in ids])
 
         if update:
             update = defined_serializers.serialize_record(
                 self.schema, update, self.__compressor
             )
+            update["updated_at"] = time.time()
 
             update_columns = ", ".join((f'"{h}" = ?' for h in update.keys()))
 
-            sql_query = f"UPDATE {self.name} SET {update_columns} WHERE id IN ({id_placeholders}) RETURNING {', '.join(('id') + select_keys)}"
+            sql_query = f"UPDATE {self.name} SET {update_columns} WHERE id IN (SELECT value FROM json_each(?)) RETURNING {column_str}"
 
-            sql_params = tuple(update.values()) + ids
+            sql_params = tuple(update.values()) + (json.dumps(list(ids)),)
 
             _result = self.__connection.execute(sql_query, sql_params).fetchall()
             self.__connection.commit()
 
         else:
-            sql_query = (
-                f"SELECT {column_str} FROM {self.name} WHERE id IN ({id_placeholders})"
-            )
-            _result = self.__connection.execute(sql_query, ids).fetchall()
+            sql_query = f"SELECT {column_str} FROM {self.name} WHERE id IN (SELECT value FROM json_each(?))"
+            _result = self.__connection.execute(
+                sql_query, (json.dumps(list(ids)),)
+            ).fetchall()
 
         if return_metadata:
             select_keys = select_keys[2:]
@@ -402,6 +576,42 @@ class DefinedIndex:
             self.__connection.execute(f'''DROP TABLE IF EXISTS "{self.name}"''')
             self.__create_table_and_meta_table()
 
+            # dropping the table drops the change feed triggers with it, re-create them and log the clear
+            if change_feed_exists(self.__connection, self.__changes_table_name):
+                create_change_feed_triggers(
+                    self.__connection,
+                    table_name=self.name,
+                    feed_table_name=self.__changes_table_name,
+                    key_columns=["id"],
+                )
+                log_change(self.__connection, self.__changes_table_name, "clear")
+
+            # the in-memory embedding matrices of every process reload on the "clear"
+            for key, value_type in self.schema.items():
+                if value_type == "normalized_embedding":
+                    log_change(
+                        self.__connection,
+                        embedding_changes_table_name(self.name, key),
+                        "clear",
+                    )
+
+            for key in embedding_index_settings(
+                self.__connection, self.__embedding_indexes_table_name
+            ):
+                clear_embedding_index(self.__connection, self.name, key)
+
+            for key in text_index_keys(self.__connection, self.name, self.schema):
+                clear_text_index(self.__connection, self.name, key, self.schema[key])
+
+            for json_path in json_value_index_paths(
+                self.__connection, self.name, self.schema
+            ):
+                clear_json_value_index(
+                    self.__connection, self.name, *split_json_path(json_path, self.schema)
+                )
+
+        self.__maintain_if_due()
+
     def drop(self):
         # DROP function: deletes both the table itself and the metadata table
         with self.__connection:
@@ -409,6 +619,36 @@ class DefinedIndex:
             self.__connection.execute(
                 f'''DROP TABLE IF EXISTS "{self.__meta_table_name}"'''
             )
+            drop_change_feed(self.__connection, self.__changes_table_name)
+
+            for key, value_type in self.schema.items():
+                if value_type == "normalized_embedding":
+                    drop_change_feed(
+                        self.__connection, embedding_changes_table_name(self.name, key)
+                    )
+
+            for key in embedding_index_settings(
+                self.__connection, self.__embedding_indexes_table_name
+            ):
+                drop_embedding_index(
+                    self.__connection,
+                    self.name,
+                    self.__embedding_indexes_table_name,
+                    key,
+                )
+            self.__connection.execute(
+                f'''DROP TABLE IF EXISTS "{self.__embedding_indexes_table_name}"'''
+            )
+
+            for key in text_index_keys(self.__connection, self.name, self.schema):
+                drop_text_index(self.__connection, self.name, key)
+
+            for json_path in json_value_index_paths(
+                self.__connection, self.name, self.schema
+            ):
+                drop_json_value_index(self.__connection, self.name, json_path)
+
+        self.__json_value_indexes = set()
 
     def search(
         self,
@@ -425,6 +665,12 @@ class DefinedIndex:
         sort_by_embedding=None,
         sort_by_embedding_metric="cosine",
         meta_query={},
+        n_probe=None,
+        rerank_factor=None,
+        max_distance=None,
+        min_similarity=None,
+        fusion=None,
+        fusion_text_weight=0.5,
     ):
         if page_no is not None:
             offset = (page_no - 1) * n
@@ -432,6 +678,10 @@ class DefinedIndex:
         if not sort_by:
             sort_by = "updated_at"
 
+        elif sort_by == "$text":
+            # bm25 relevance to the query's $text condition
+            pass
+
         elif self.schema[sort_by] in {"blob", "other"}:
             sort_by = f"__size_{sort_by}"
 
@@ -446,6 +696,72 @@ class DefinedIndex:
         if meta_query:
             query.update(meta_query)
 
+        if sort_by_embedding is not None:
+            max_distance = max_distance_of(
+                sort_by_embedding_metric, max_distance, min_similarity
+            )
+
+            # a 2-D array is a batch of queries, every one gets its own results
+            is_batch = np.ndim(sort_by_embedding) == 2
+
+            if fusion is not None:
+                if fusion not in FUSIONS:
+                    raise ValueError(
+                        f"Invalid fusion: {fusion}, can be one of rrf, weighted"
+                    )
+                if is_batch or reversed_sort:
+                    raise ValueError(
+                        "fusion needs a single query embedding and reversed_sort=False"
+                    )
+
+                return self.__ranked_results(
+                    [
+                        self.__fused_search(
+                            sort_by,
+                            query,
+                            sort_by_embedding,
+                            sort_by_embedding_metric,
+                            fusion,
+                            fusion_text_weight,
+                            n,
+                            offset,
+                            n_probe,
+                            rerank_factor,
+                            max_distance,
+                        )
+                    ],
+                    select_keys,
+                    update,
+                    return_metadata,
+                    metadata_key_name,
+                    score_name="fusion_score",
+                )[0]
+
+            ranked = self.__embedding_search(
+                sort_by,
+                query,
+                sort_by_embedding,
+                is_batch,
+                sort_by_embedding_metric,
+                reversed_sort,
+                n,
+                offset,
+                n_probe,
+                rerank_factor,
+                max_distance,
+            )
+
+            if ranked is not None:
+                results = self.__ranked_results(
+                    ranked,
+                    select_keys,
+                    update,
+                    return_metadata,
+                    metadata_key_name,
+                )
+
+                return results if is_batch else results[0]
+
         sql_query, sql_params = search_query(
             table_name=self.name,
             query=query,
@@ -458,6 +774,8 @@ class DefinedIndex:
             sort_by_embedding=sort_by_embedding,
             sort_by_embedding_metric=sort_by_embedding_metric,
             is_update=True if update else False,
+            max_distance=max_distance if sort_by_embedding is not None else None,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         _results = None
@@ -466,6 +784,7 @@ class DefinedIndex:
             update = defined_serializers.serialize_record(
                 self.schema, update, self.__compressor
             )
+            update["updated_at"] = time.time()
 
             update_columns = ", ".join([f'"{h}" = ?' for h in update.keys()])
 
@@ -481,8 +800,12 @@ class DefinedIndex:
 
         results = {}
 
+        # the 4th column is the embedding distance or the bm25 score, UPDATE ... RETURNING has neither
+        has_score = not update and (sort_by_embedding is not None or sort_by == "$text")
+        score_name = "embedding_distance" if sort_by_embedding is not None else "text_score"
+
         for result in _results:
-            if sort_by_embedding is not None:
+            if has_score:
                 integer_id, _id, updated_at, score = result[:4]
             else:
                 integer_id, _id, updated_at = result[:3]
@@ -493,7 +816,7 @@ class DefinedIndex:
                     h: val
                     for h, val in zip(
                         select_keys,
-                        result[3:] if sort_by_embedding is None else result[4:],
+                        result[4:] if has_score else result[3:],
                     )
                 },
                 self.__decompressor,
@@ -505,17 +828,448 @@ class DefinedIndex:
                     "updated_at": updated_at,
                 }
 
-                if sort_by_embedding is not None:
-                    results[_id][metadata_key_name]["embedding_distance"] = score
+                if has_score:
+                    results[_id][metadata_key_name][score_name] = score
 
         return results
 
+    def __embedding_search(
+        self,
+        key,
+        query,
+        embedding,
+        needs_ranking,
+        metric,
+        reversed_sort,
+        n,
+        offset,
+        n_probe,
+        rerank_factor,
+        max_distance,
+    ):
+        # [(integer_ids, distances)] for each query embedding, None if the search runs in sqlite with vectorlite.
+        # batches and fused searches need the ranking itself, vectorlite only ranks inside a SELECT
+        embedding_index = embedding_index_settings(
+            self.__connection, self.__embedding_indexes_table_name, key
+        ).get(key)
+
+        if not (
+            needs_ranking
+            or embedding_index is not None
+            or vectorlite_path is None
+            or key in self.embedding_quantization
+        ):
+            return None
+
+        embeddings = np.asarray(embedding, dtype=np.float32)
+        embeddings = embeddings.reshape(-1, embeddings.shape[-1])
+
+        if embedding_index is not None:
+            return self.__embedding_index_search(
+                key,
+                embedding_index,
+                query,
+                embeddings,
+                metric,
+                reversed_sort,
+                n,
+                offset,
+                n_probe,
+                max_distance,
+            )
+
+        return self.__embedding_matrix_search(
+            key,
+            query,
+            embeddings,
+            metric,
+            reversed_sort,
+            n,
+            offset,
+            rerank_factor,
+            max_distance,
+        )
+
+    def __embedding_index_search(
+        self,
+        key,
+        embedding_index,
+        query,
+        embeddings,
+        metric,
+        reversed_sort,
+        n,
+        offset,
+        n_probe,
+        max_distance,
+    ):
+        n_lists, default_n_probe, version = embedding_index
+        n_probe = default_n_probe if n_probe is None else n_probe
+
+        offset = offset or 0
+        k = None if n is None else offset + n
+
+        # rows with a smaller dot product are beyond max_distance, 1e-5 covers float32 rounding
+        bounds = (
+            None
+            if max_distance is None
+            else min_dots(embeddings, max_distance, metric)[:, None] - 1e-5
+        )
+
+        def ranked(integer_ids, vectors, row_lists=None, is_probed=None):
+            def block_scores(start, stop):
+                dots = embeddings @ vectors[start:stop].T
+                scores = dots if reversed_sort else -dots
+                if is_probed is not None:
+                    # rows of lists only another query of the batch probed
+                    scores[~is_probed[:, row_lists[start:stop] + 1]] = np.inf
+                if bounds is not None:
+                    scores[dots < bounds] = np.inf
+                return scores
+
+            return within_distance(
+                [
+                    (
+                        integer_ids[positions],
+                        distances_from_scores(embedding, scores, metric, reversed_sort),
+                    )
+                    for embedding, (positions, scores) in zip(
+                        embeddings,
+                        block_nearest(
+                            block_scores, len(integer_ids), len(embeddings), k
+                        ),
+                    )
+                ],
+                max_distance,
+            )
+
+        where_conditions, params = parse_query(
+            query,
+            self.__meta_schema,
+            table_name=self.name,
+            json_value_indexes=self.__json_value_indexes,
+        )
+
+        if where_conditions:
+            n_rows = estimated_row_count(self.__connection, self.name)
+
+            # a filter matching fewer rows than the probed lists hold is scored exactly, over just those rows
+            integer_ids, vectors, selectivity = filtered_rows(
+                self.__connection,
+                self.name,
+                key,
+                where_conditions,
+                params,
+                max(k or 0, n_rows * min(n_probe, n_lists) // n_lists),
+                with_vectors=True,
+            )
+            if selectivity is None:
+                return [
+                    (integer_ids[offset:], distances[offset:])
+                    for integer_ids, distances in ranked(integer_ids, vectors)
+                ]
+
+            if k is not None:
+                # enough lists to be expected to hold FILTER_OVERSAMPLING times k matching rows
+                n_probe = max(
+                    n_probe,
+                    int(
+                        np.ceil(
+                            FILTER_OVERSAMPLING * k * n_lists / (selectivity * n_rows)
+                        )
+                    ),
+                )
+
+        centroids = self.__centroids(key, version)
+
+        while True:
+            probed = probe_lists(centroids, embeddings, n_probe)
+            row_lists, integer_ids, vectors = list_candidates(
+                self.__connection,
+                self.name,
+                key,
+                np.unique(probed),
+                where_conditions,
+                params,
+            )
+
+            # column 0 is the pending list, scanned by every query
+            is_probed = np.zeros((len(embeddings), n_lists + 1), dtype=bool)
+            is_probed[np.arange(len(embeddings))[:, None], probed + 1] = True
+            is_probed[:, 0] = True
+
+            results = ranked(integer_ids, vectors, row_lists, is_probed)
+
+            if k is None or n_probe >= n_lists:
+                break
+
+            # the probed lists held fewer than k rows matching the filter for some query
+            rows_per_list = np.bincount(row_lists + 1, minlength=n_lists + 1)
+            if (is_probed @ rows_per_list).min() >= k:
+                break
+
+            n_probe *= 2
+
+        return [
+            (integer_ids[offset:], distances[offset:])
+            for integer_ids, distances in results
+        ]
+
+    def __embedding_matrix_search(
+        self,
+        key,
+        query,
+        embeddings,
+        metric,
+        reversed_sort,
+        n,
+        offset,
+        rerank_factor,
+        max_distance,
+    ):
+        matrix = self.__embedding_matrices.get(key)
+        if matrix is None:
+            matrix = self.__embedding_matrices.setdefault(
+                key,
+                EmbeddingMatrix(self.name, key, self.embedding_quantization.get(key)),
+            )
+        matrix.refresh(self.__connection)
+
+        offset = offset or 0
+        k = None if n is None else offset + n
+
+        def search(k, integer_ids=None):
+            return matrix.search(
+                self.__connection,
+                embeddings,
+                metric,
+                k,
+                reversed_sort,
+                integer_ids,
+                rerank_factor,
+                max_distance,
+            )
+
+        where_conditions, params = parse_query(
+            query,
+            self.__meta_schema,
+            table_name=self.name,
+            json_value_indexes=self.__json_value_indexes,
+        )
+
+        if not where_conditions:
+            results = search(k)
+        else:
+            # the filter is evaluated once for the whole batch. reading the ids of matching rows from sqlite
+            # costs several times more per row than scoring a row, so filters matching more than an 8th of
+            # the rows are applied to the results of an oversampled search over every row instead
+            integer_ids, _, selectivity = filtered_rows(
+                self.__connection,
+                self.name,
+                key,
+                where_conditions,
+                params,
+                None if k is None else max(k, matrix.size // 8),
+            )
+
+            if selectivity is None:
+                results = search(k, integer_ids)
+            else:
+                candidates_k = int(np.ceil(FILTER_OVERSAMPLING * k / selectivity))
+                while True:
+                    results = search(candidates_k)
+                    matching = matching_integer_ids(
+                        self.__connection,
+                        self.name,
+                        np.unique(
+                            np.concatenate([integer_ids for integer_ids, _ in results])
+                        ).tolist(),
+                        where_conditions,
+                        params,
+                    )
+                    filtered = []
+                    is_complete = True
+                    for integer_ids, distances in results:
+                        is_matching = np.isin(integer_ids, matching)
+                        filtered.append(
+                            (integer_ids[is_matching][:k], distances[is_matching][:k])
+                        )
+                        # fewer than candidates_k results means no other row is within max_distance
+                        if is_matching.sum() < k and len(integer_ids) >= candidates_k:
+                            is_complete = False
+                    results = filtered
+
+                    if is_complete or candidates_k >= matrix.size:
+                        break
+
+                    candidates_k *= 4
+
+        return [
+            (integer_ids[offset:], distances[offset:])
+            for integer_ids, distances in results
+        ]
+
+    def __fused_search(
+        self,
+        key,
+        query,
+        embedding,
+        metric,
+        fusion,
+        text_weight,
+        n,
+        offset,
+        n_probe,
+        rerank_factor,
+        max_distance,
+    ):
+        # (integer_ids, fused scores) of the bm25 ranking of the query's $text condition fused with the
+        # embedding ranking, the rest of the query filters both
+        text_key, text_query, query = pop_text_condition(query)
+
+        offset = offset or 0
+        candidates_k = None if n is None else FUSION_CANDIDATES_FACTOR * (offset + n)
+
+        where_conditions, params = parse_query(
+            query,
+            self.__meta_schema,
+            table_name=self.name,
+            json_value_indexes=self.__json_value_indexes,
+        )
+
+        def text_ranking():
+            return text_candidates(
+                self.__connection,
+                self.name,
+                text_key,
+                text_query,
+                where_conditions,
+                params,
+                candidates_k,
+            )
+
+        # the text index is read on another thread and its own pooled connection while embeddings are scored,
+        # every connection to :memory: opens a database of its own
+        if self.db_path != ":memory:":
+            text_ranking = get_hybrid_search_executor().submit(text_ranking).result
+
+        (integer_ids, distances), = self.__embedding_search(
+            key,
+            query,
+            embedding,
+            True,
+            metric,
+            False,
+            candidates_k,
+            None,
+            n_probe,
+            rerank_factor,
+            max_distance,
+        )
+
+        text_integer_ids, bm25_scores = text_ranking()
+
+        # bm25() and distances are smaller for better matches
+        integer_ids, scores = fuse(
+            [
+                (text_integer_ids, [-_ for _ in bm25_scores], text_weight),
+                (integer_ids.tolist(), (-distances).tolist(), 1 - text_weight),
+            ],
+            fusion,
+            None if n is None else offset + n,
+        )
+
+        return (
+            np.asarray(integer_ids, dtype=np.int64)[offset:],
+            np.asarray(scores, dtype=np.float64)[offset:],
+        )
+
+    def __ranked_results(
+        self,
+        ranked,
+        select_keys,
+        update,
+        return_metadata,
+        metadata_key_name,
+        score_name="embedding_distance",
+    ):
+        # [{id: record}] for every (integer_ids, scores) in ranked, rows shared by queries are read once
+        columns = ", ".join(
+            ("integer_id", "id", "updated_at") + tuple(f'"{_}"' for _ in select_keys)
+        )
+        params = [
+            json_ids(
+                np.unique(
+                    np.concatenate(
+                        [np.empty(0, dtype=np.int64)]
+                        + [integer_ids for integer_ids, _ in ranked]
+                    )
+                ).tolist()
+            )
+        ]
+
+        if update:
+            update = defined_serializers.serialize_record(
+                self.schema, update, self.__compressor
+            )
+            update["updated_at"] = time.time()
+
+            update_columns = ", ".join([f'"{h}" = ?' for h in update.keys()])
+
+            with self.__connection as conn:
+                rows = conn.execute(
+                    f"""UPDATE "{self.name}" SET {update_columns} WHERE integer_id IN (SELECT value FROM json_each(?)) RETURNING {columns}""",
+                    list(update.values()) + params,
+                ).fetchall()
+        else:
+            rows = self.__connection.execute(
+                f"""SELECT {columns} FROM "{self.name}" WHERE integer_id IN (SELECT value FROM json_each(?))""",
+                params,
+            ).fetchall()
+
+        records = {
+            row[0]: (
+                row[1],
+                row[2],
+                defined_serializers.deserialize_record(
+                    self.schema,
+                    {h: val for h, val in zip(select_keys, row[3:])},
+                    self.__decompressor,
+                ),
+            )
+            for row in rows
+        }
+
+        all_results = []
+        for integer_ids, scores in ranked:
+            results = {}
+            for integer_id, score in zip(integer_ids.tolist(), scores.tolist()):
+                if integer_id not in records:
+                    # deleted since it was scored
+                    continue
+
+                _id, updated_at, record = records[integer_id]
+                # every query gets its own copy, metadata differs between them
+                results[_id] = dict(record)
+
+                if return_metadata:
+                    results[_id][metadata_key_name] = {
+                        "integer_id": integer_id,
+                        "updated_at": updated_at,
+                        score_name: score,
+                    }
+
+            all_results.append(results)
+
+        return all_results
+
     def distinct(self, key, query={}):
         sql_query, sql_params = distinct_query(
             table_name=self.name,
             column=key,
             query={k: v for k, v in query.items()},
             schema=self.schema,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         return {
@@ -530,6 +1284,7 @@ class DefinedIndex:
             schema=self.schema,
             min_count=min_count,
             top_n=top_n,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         return {
@@ -546,6 +1301,7 @@ class DefinedIndex:
             columns=[key for key in keys],
             query={k: v for k, v in query.items()},
             schema=self.schema,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         return {
@@ -567,8 +1323,8 @@ class DefinedIndex:
                         self.__decompressor,
                     )
                     for row in self.__connection.execute(
-                        f"""DELETE FROM "{self.name}" WHERE id IN ({', '.join(['?' for _ in ids])}) RETURNING *""",
-                        ids,
+                        f"""DELETE FROM "{self.name}" WHERE id IN (SELECT value FROM json_each(?)) RETURNING *""",
+                        (json.dumps(list(ids)),),
                     ).fetchall()
                 }
 
@@ -580,6 +1336,7 @@ class DefinedIndex:
                 sort_by=sort_by if sort_by is not None else "updated_at",
                 reversed_sort=reversed_sort,
                 n=n,
+                json_value_indexes=self.__json_value_indexes,
             )
 
             with self.__connection:
@@ -607,6 +1364,7 @@ class DefinedIndex:
                 table_name=self.name,
                 query={k: v for k, v in query.items()},
                 schema=self.schema,
+                json_value_indexes=self.__json_value_indexes,
             )
 
             self.__connection.execute(sql_query, sql_params)
@@ -615,18 +1373,59 @@ class DefinedIndex:
             if isinstance(ids, str):
                 ids = [ids]
 
-            placeholders = ", ".join(["?" for _ in ids])
-            sql_query = f"""DELETE FROM "{self.name}" WHERE id IN ({placeholders})"""
-            self.__connection.execute(sql_query, ids)
+            sql_query = f"""DELETE FROM "{self.name}" WHERE id IN (SELECT value FROM json_each(?))"""
+            self.__connection.execute(sql_query, (json.dumps(list(ids)),))
             self.__connection.commit()
         else:
             raise ValueError("Either ids or query must be provided")
 
-    def count(self, query={}):
+        self.__maintain_if_due()
+
+    def count(
+        self,
+        query={},
+        embedding_key=None,
+        embedding=None,
+        embedding_metric="cosine",
+        max_distance=None,
+        min_similarity=None,
+        n_probe=None,
+    ):
+        if embedding is not None:
+            max_distance = max_distance_of(
+                embedding_metric, max_distance, min_similarity
+            )
+
+            # a 2-D array counts around every row of it
+            is_batch = np.ndim(embedding) == 2
+
+            ranked = self.__embedding_search(
+                embedding_key,
+                query,
+                embedding,
+                is_batch,
+                embedding_metric,
+                False,
+                None,
+                None,
+                n_probe,
+                None,
+                max_distance,
+            )
+
+            if ranked is not None:
+                counts = [len(integer_ids) for integer_ids, _ in ranked]
+                return counts if is_batch else counts[0]
+
         sql_query, sql_params = count_query(
             table_name=self.name,
             query={k: v for k, v in query.items()},
             schema=self.schema,
+            embedding_key=embedding_key,
+            embedding=embedding,
+            embedding_metric=embedding_metric,
+            max_distance=max_distance,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         return self.__connection.execute(sql_query, sql_params).fetchone()[0]
@@ -635,21 +1434,40 @@ class DefinedIndex:
         if isinstance(keys, str):
             keys = [keys]
 
-        key_hashes = []
         size_hashes = []
+        # index name part -> indexed column or expression
+        index_columns = {}
+        json_paths = []
 
         for k in keys:
-            if self.schema[k] in {"blob", "other"}:
-                key_hashes.append(f"__hash_{k}")
+            if k not in self.schema and "." in k:
+                # "key.a.b" of a json key, the index is on the json_extract() parse_query compares
+                json_key, path = split_json_path(k, self.schema)
+                index_columns[k] = json_path_column(json_key, path)
+                json_paths.append((json_key, path))
+            elif self.schema[k] in {"blob", "other"}:
                 size_hashes.append(f"__size_{k}")
+                index_columns[f"__hash_{k}"] = f'"__hash_{k}"'
             elif self.schema[k] == "json":
-                pass
+                # array membership, the whole value has no useful order
+                json_paths.append((k, []))
             else:
-                key_hashes.append(k)
+                index_columns[k] = f'"{k}"'
+
+        if json_paths:
+            with self.__connection:
+                for json_key, path in json_paths:
+                    create_json_value_index(
+                        self.__connection, self.name, json_key, path
+                    )
+
+            self.__json_value_indexes = self.__json_value_indexes | {
+                ".".join([json_key] + path) for json_key, path in json_paths
+            }
 
-        if key_hashes:
+        if index_columns:
             self.__connection.execute(
-                f"""CREATE {'UNIQUE' if is_unique else ''} INDEX IF NOT EXISTS "idx_{self.name}_{'_'.join(key_hashes)}" ON {self.name} ({','.join(['"' + _ + '"' for _ in key_hashes])})"""
+                f"""CREATE {'UNIQUE' if is_unique else ''} INDEX IF NOT EXISTS "idx_{self.name}_{'_'.join(index_columns)}" ON {self.name} ({','.join(index_columns.values())})"""
             )
 
             for size_hash in size_hashes:
@@ -659,15 +1477,103 @@ class DefinedIndex:
 
             self.__connection.commit()
 
+    def create_embedding_index(
+        self, key, n_lists=None, n_probe=8, sample_size=None, iterations=10
+    ):
+        """
+        Builds an IVF approximate nearest neighbour index used by `search(sort_by=key, sort_by_embedding=...)`,
+        it is kept up to date on every write. Calling it again retrains the index.
+
+        Args:
+            key (str): normalized_embedding key from schema
+            n_lists (int): Number of clusters, defaults to 4 * sqrt(number of embeddings)
+            n_probe (int): Default number of clusters scanned per query, more is slower with better recall
+            sample_size (int): Number of embeddings the clusters are trained on, defaults to 64 * n_lists
+            iterations (int): k-means iterations
+        """
+        if self.schema.get(key) != "normalized_embedding":
+            raise ValueError(f"{key} is not a normalized_embedding key")
+
+        with self.__connection:
+            create_embedding_index(
+                self.__connection,
+                self.name,
+                self.__embedding_indexes_table_name,
+                key,
+                n_lists=n_lists,
+                n_probe=n_probe,
+                sample_size=sample_size,
+                iterations=iterations,
+            )
+
+    def drop_embedding_index(self, key):
+        with self.__connection:
+            drop_embedding_index(
+                self.__connection, self.name, self.__embedding_indexes_table_name, key
+            )
+
+    def create_text_index(self, key, tokenize="unicode61"):
+        """
+        Creates an FTS5 full-text index on a string or compressed_string key, kept in sync on every write
+
+        Args:
+            key (str): Key to index
+            tokenize (str): FTS5 tokenizer, e.g. "porter unicode61" for english stemming, defaults to "unicode61"
+        """
+        if self.schema.get(key) not in TEXT_INDEX_TYPES:
+            raise ValueError(f"{key} is not a string or compressed_string key")
+
+        with self.__connection:
+            create_text_index(
+                self.__connection, self.name, key, self.schema[key], tokenize
+            )
+
+    def drop_text_index(self, key):
+        """
+        Removes the full-text index of key, $text queries on it fail afterwards
+
+        Args:
+            key (str): Key whose index is removed
+        """
+        with self.__connection:
+            drop_text_index(self.__connection, self.name, key)
+
+    def __assign_pending_embeddings(self):
+        # runs inside the writing transaction, puts rows written since the last call in their nearest cluster
+        for key, (_, _, version) in embedding_index_settings(
+            self.__connection, self.__embedding_indexes_table_name
+        ).items():
+            assign_pending_rows(
+                self.__connection, self.name, key, self.__centroids(key, version)
+            )
+
+    def __centroids(self, key, version):
+        # centroids only change when the index is retrained, which changes its version
+        cached = self.__embedding_index_centroids.get(key)
+        if cached is None or cached[0] != version:
+            cached = (version, load_centroids(self.__connection, self.name, key))
+            self.__embedding_index_centroids[key] = cached
+
+        return cached[1]
+
     def list_optimized_keys(self):
+        # json keys and paths with a value index are listed too
         return {
             k: v
             for k, v in {
-                _[1].replace(f"idx_{self.name}_", ""): {"is_unique": bool(_[2])}
-                for _ in self.__connection.execute(
-                    f"""PRAGMA index_list("{self.name}")"""
-                ).fetchall()
-                if _[1].startswith(f"idx_{self.name}_")
+                **{
+                    json_path: {"is_unique": False}
+                    for json_path in json_value_index_paths(
+                        self.__connection, self.name, self.schema
+                    )
+                },
+                **{
+                    _[1].replace(f"idx_{self.name}_", ""): {"is_unique": bool(_[2])}
+                    for _ in self.__connection.execute(
+                        f"""PRAGMA index_list("{self.name}")"""
+                    ).fetchall()
+                    if _[1].startswith(f"idx_{self.name}_")
+                },
             }.items()
             if k and v
         }
@@ -694,6 +1600,7 @@ class DefinedIndex:
             column=key,
             query={k: v for k, v in query.items()},
             schema=self.schema,
+            json_value_indexes=self.__json_value_indexes,
         )
 
         return self.__connection.execute(sql_query, sql_params).fetchone()[0]
@@ -792,6 +1699,61 @@ class DefinedIndex:
             ).fetchall()
         ]
 
+    def enable_change_feed(self, max_rows=100000):
+        """
+        Logs every insert, update and delete of this index to an append-only table using SQL triggers,
+        so changes made from any process or connection can be followed with `watch`.
+
+        Args:
+            max_rows (int): Number of most recent changes retained, older ones are compacted automatically
+        """
+        with self.__connection:
+            create_change_feed(
+                self.__connection,
+                table_name=self.name,
+                feed_table_name=self.__changes_table_name,
+                key_columns=["id"],
+                max_rows=max_rows,
+            )
+
+    def disable_change_feed(self):
+        """
+        Removes the change feed table and its triggers.
+        """
+        with self.__connection:
+            drop_change_feed(self.__connection, self.__changes_table_name)
+
+    def change_feed_cursor(self):
+        """
+        Returns:
+            int: Cursor of the latest change, can be passed as `since` to `watch`
+        """
+        return latest_cursor(self.__connection, self.__changes_table_name)
+
+    def watch(self, since=None, poll_interval=0.1, timeout=None, batch_size=1000):
+        """
+        Yields (cursor, op, id) for every change after `since`. op is one of "set", "delete" or "clear" (id is None for "clear").
+
+        Args:
+            since (int): Cursor to resume from. `None` starts after the latest change, 0 replays every retained change
+            poll_interval (float): Seconds to sleep between polls when there are no new changes
+            timeout (float): Stop once no change is seen for these many seconds. `None` watches forever, 0 drains and returns
+            batch_size (int): Number of changes fetched per poll
+        """
+        if not change_feed_exists(self.__connection, self.__changes_table_name):
+            raise ValueError("change feed is not enabled, call enable_change_feed()")
+
+        for row in watch_changes(
+            lambda: self.__connection,
+            self.__changes_table_name,
+            key_columns=["id"],
+            since=since,
+            poll_interval=poll_interval,
+            timeout=timeout,
+            batch_size=batch_size,
+        ):
+            yield row
+
     def vaccum(self):
         self.__connection.execute("VACUUM")
         self.__connection.commit()
@@ -0,0 +1,510 @@
+import uuid
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# IVF-flat approximate nearest neighbour index on a normalized_embedding column of a DefinedIndex.
+#
+#   TABLE <settings_table>: key TEXT PRIMARY KEY, n_lists INTEGER, n_probe INTEGER, version TEXT
+#   TABLE __<table>_ivf_<key>_centroids: list_id INTEGER PRIMARY KEY, centroid BLOB
+#   TABLE __<table>_ivf_<key>_lists: integer_id INTEGER PRIMARY KEY, list_id INTEGER (indexed)
+#
+# centroids are trained with spherical k-means on a sample of the stored embeddings and every row is put
+# in the list of its nearest centroid. a query scores the rows of its n_probe nearest lists exactly,
+# so n_probe trades recall for latency, n_probe >= n_lists is an exact search.
+#
+# plain SQL triggers on the indexed table move inserted and re-embedded rows to the pending list (-1) and
+# remove deleted ones, so writes from every process and connection keep the index correct. pending rows are
+# scanned by every query, DefinedIndex.update() assigns them to their nearest list after each write.
+#
+# embeddings are expected to be normalized, distances match vectorlite's vector_distance for such vectors.
+
+PENDING_LIST = -1
+
+_METRICS = {"cosine", "ip", "l2"}
+
+
+def _table_names(table_name, key):
+    return f"__{table_name}_ivf_{key}_centroids", f"__{table_name}_ivf_{key}_lists"
+
+
+def to_matrix(blobs):
+    return np.frombuffer(b"".join(blobs), dtype=np.float32).reshape(len(blobs), -1)
+
+
+def json_ids(integer_ids):
+    return "[" + ",".join(map(str, integer_ids)) + "]"
+
+
+def embedding_distances(queries, vectors, metric="cosine"):
+    # queries: (q, d), vectors: (n, d) normalized, returns (q, n)
+    return distances_from_dots(queries, queries @ vectors.T, metric)
+
+
+def distances_from_dots(queries, dots, metric="cosine"):
+    # dots: (q, n) dot products of queries with normalized vectors
+    if metric not in _METRICS:
+        raise ValueError(f"Invalid metric: {metric}, can be one of cosine, ip, l2")
+
+    if metric == "ip":
+        return 1 - dots
+
+    query_norms = np.linalg.norm(queries, axis=1)[:, None]
+    if metric == "cosine":
+        return 1 - dots / np.maximum(query_norms, 1e-12)
+
+    return query_norms**2 + 1 - 2 * dots
+
+
+def min_dots(queries, max_distance, metric="cosine"):
+    # (q,) smallest dot product of a normalized vector within max_distance of each query, distances_from_dots inverted
+    if metric not in _METRICS:
+        raise ValueError(f"Invalid metric: {metric}, can be one of cosine, ip, l2")
+
+    if metric == "ip":
+        return np.full(len(queries), 1 - max_distance, dtype=np.float32)
+
+    query_norms = np.linalg.norm(queries, axis=1)
+    if metric == "cosine":
+        return (1 - max_distance) * np.maximum(query_norms, 1e-12)
+
+    return (query_norms**2 + 1 - max_distance) / 2
+
+
+def max_distance_of(metric, max_distance=None, min_similarity=None):
+    # distance threshold of a range search, similarity is 1 - distance for cosine and ip
+    if min_similarity is None:
+        return max_distance
+
+    if max_distance is not None:
+        raise ValueError("Pass only one of max_distance and min_similarity")
+
+    if metric == "l2":
+        raise ValueError(
+            "min_similarity is only defined for cosine and ip, use max_distance with l2"
+        )
+
+    return 1 - min_similarity
+
+
+def within_distance(results, max_distance):
+    # [(integer_ids, distances)] without the rows beyond max_distance
+    if max_distance is None:
+        return results
+
+    return [
+        (integer_ids[distances <= max_distance], distances[distances <= max_distance])
+        for integer_ids, distances in results
+    ]
+
+
+def distances_from_scores(query, scores, metric="cosine", reversed_sort=False):
+    # block_nearest ranks by -dot product (+dot product if reversed_sort), distances of one query's results
+    return distances_from_dots(
+        query[None], (scores if reversed_sort else -scores)[None], metric
+    )[0]
+
+
+def nearest(distances, k=None, reversed_sort=False):
+    # positions of the k smallest distances (largest if reversed_sort) of a 1-D array, closest first
+    if reversed_sort:
+        distances = -distances
+
+    if k is not None and k < len(distances):
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        candidates = np.argpartition(distances, k - 1)[:k]
+    else:
+        candidates = np.arange(len(distances))
+
+    return candidates[np.argsort(distances[candidates], kind="stable")]
+
+
+# rows are scored a block of about BLOCK_ELEMENTS scores at a time, only the k lowest of each query are kept
+# between blocks, so memory doesn't grow with the number of rows scanned
+BLOCK_ELEMENTS = 1 << 22
+
+
+def _top_k(scores, positions, k):
+    # the k lowest scores of each row and their positions, unordered
+    if k is None or scores.shape[1] <= k:
+        return scores, positions
+
+    part = np.argpartition(scores, k - 1, axis=1)[:, :k]
+    return (
+        np.take_along_axis(scores, part, axis=1),
+        np.take_along_axis(positions, part, axis=1),
+    )
+
+
+def block_nearest(block_scores, n_rows, n_queries, k=None, row_cost=1):
+    # [(positions, scores)] of the k lowest scores of n_rows for each query, lowest first.
+    # block_scores(start, stop) returns (n_queries, stop - start) scores, inf for rows a query must skip
+    block_size = max(256, BLOCK_ELEMENTS // (n_queries * row_cost))
+
+    best_scores = np.empty((n_queries, 0), dtype=np.float32)
+    best_positions = np.empty((n_queries, 0), dtype=np.int64)
+    # score a row has to beat to get in the k lowest of its query
+    threshold = np.full(n_queries, np.inf, dtype=np.float32)
+
+    for start in range(0, n_rows, block_size):
+        scores = block_scores(start, min(start + block_size, n_rows))
+
+        if k is not None and best_scores.shape[1] < k:
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_positions = np.concatenate(
+                [
+                    best_positions,
+                    np.broadcast_to(
+                        np.arange(start, start + scores.shape[1]), scores.shape
+                    ),
+                ],
+                axis=1,
+            )
+            best_scores, best_positions = _top_k(best_scores, best_positions, k)
+        else:
+            # comparing is much cheaper than partitioning, only rows that beat the threshold are kept,
+            # packed to the left of a (n_queries, most kept by a query) array padded with inf.
+            # without k, the threshold stays inf and only drops the skipped rows
+            rows, columns = np.divmod(
+                np.flatnonzero(scores < threshold[:, None]), scores.shape[1]
+            )
+            if not len(rows):
+                continue
+
+            counts = np.bincount(rows, minlength=n_queries)
+            slots = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+            kept_scores = np.full((n_queries, counts.max()), np.inf, dtype=np.float32)
+            kept_scores[rows, slots] = scores[rows, columns]
+            kept_positions = np.zeros((n_queries, counts.max()), dtype=np.int64)
+            kept_positions[rows, slots] = columns + start
+
+            best_scores, best_positions = _top_k(
+                np.concatenate([best_scores, kept_scores], axis=1),
+                np.concatenate([best_positions, kept_positions], axis=1),
+                k,
+            )
+
+        if k is not None and best_scores.shape[1] >= k:
+            threshold = best_scores.max(axis=1)
+
+    results = []
+    for scores, positions in zip(best_scores, best_positions):
+        # drops the padding and the skipped rows
+        order = np.argsort(scores, kind="stable")
+        order = order[np.isfinite(scores[order])]
+        results.append((positions[order], scores[order]))
+
+    return results
+
+
+def _nearest_centroids(vectors, centroids, block_size=4096):
+    return np.concatenate(
+        [
+            np.argmax(vectors[i : i + block_size] @ centroids.T, axis=1)
+            for i in range(0, len(vectors), block_size)
+        ]
+    )
+
+
+def train_centroids(vectors, n_lists, iterations=10, seed=0):
+    # spherical k-means, centroids stay on the unit sphere so the nearest list is the one with the largest dot product
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, _nearest_centroids(vectors, centroids), vectors)
+
+        norms = np.linalg.norm(sums, axis=1)
+        # a list that lost all its vectors keeps its previous centroid
+        non_empty = norms > 0
+        centroids[non_empty] = sums[non_empty] / norms[non_empty, None]
+
+    return centroids.astype(np.float32)
+
+
+def create_settings_table(conn, settings_table_name):
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{settings_table_name}" (key TEXT PRIMARY KEY, n_lists INTEGER, n_probe INTEGER, version TEXT)"""
+    )
+
+
+def embedding_index_settings(conn, settings_table_name, key=None):
+    # {key: (n_lists, n_probe, version)} of every index, or of the one on key
+    sql = f'SELECT key, n_lists, n_probe, version FROM "{settings_table_name}"'
+    params = ()
+    if key is not None:
+        sql += " WHERE key = ?"
+        params = (key,)
+
+    return {row[0]: row[1:] for row in conn.execute(sql, params).fetchall()}
+
+
+def create_embedding_index_triggers(conn, table_name, key):
+    # triggers live on the indexed table and are dropped along with it
+    _, lists_table_name = _table_names(table_name, key)
+
+    for event, body in (
+        (
+            "insert",
+            f'INSERT OR REPLACE INTO "{lists_table_name}" (integer_id, list_id) VALUES (NEW.integer_id, {PENDING_LIST});',
+        ),
+        (
+            "update",
+            f'UPDATE "{lists_table_name}" SET list_id = {PENDING_LIST} WHERE integer_id = NEW.integer_id;',
+        ),
+        (
+            "delete",
+            f'DELETE FROM "{lists_table_name}" WHERE integer_id = OLD.integer_id;',
+        ),
+    ):
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS "{lists_table_name}_{event}"
+            AFTER {event.upper()}{f' OF "{key}"' if event == "update" else ''} ON "{table_name}"
+            BEGIN
+                {body}
+            END;
+            """
+        )
+
+
+def create_embedding_index(
+    conn,
+    table_name,
+    settings_table_name,
+    key,
+    n_lists=None,
+    n_probe=8,
+    sample_size=None,
+    iterations=10,
+    batch_size=10000,
+):
+    centroids_table_name, lists_table_name = _table_names(table_name, key)
+
+    integer_ids = np.array(
+        [
+            _[0]
+            for _ in conn.execute(
+                f'SELECT integer_id FROM "{table_name}" WHERE "{key}" IS NOT NULL'
+            ).fetchall()
+        ],
+        dtype=np.int64,
+    )
+
+    if not len(integer_ids):
+        raise ValueError(f"No embeddings stored for {key}, add some before indexing")
+
+    if n_lists is None:
+        n_lists = int(4 * np.sqrt(len(integer_ids)))
+    n_lists = max(1, min(n_lists, len(integer_ids)))
+
+    if sample_size is None:
+        sample_size = 64 * n_lists
+    sample_size = max(n_lists, min(sample_size, len(integer_ids)))
+
+    sample_ids = np.random.default_rng(0).choice(
+        integer_ids, sample_size, replace=False
+    )
+    sample = []
+    for i in range(0, len(sample_ids), batch_size):
+        sample.extend(
+            _[0]
+            for _ in conn.execute(
+                f'SELECT "{key}" FROM "{table_name}" WHERE integer_id IN (SELECT value FROM json_each(?))',
+                (json_ids(sample_ids[i : i + batch_size]),),
+            ).fetchall()
+        )
+
+    centroids = train_centroids(to_matrix(sample), n_lists, iterations)
+
+    drop_embedding_index(conn, table_name, settings_table_name, key)
+
+    conn.execute(
+        f"""CREATE TABLE "{centroids_table_name}" (list_id INTEGER PRIMARY KEY, centroid BLOB)"""
+    )
+    conn.executemany(
+        f'INSERT INTO "{centroids_table_name}" (list_id, centroid) VALUES (?, ?)',
+        ((i, centroid.tobytes()) for i, centroid in enumerate(centroids)),
+    )
+
+    conn.execute(
+        f"""CREATE TABLE "{lists_table_name}" (integer_id INTEGER PRIMARY KEY, list_id INTEGER)"""
+    )
+    conn.execute(
+        f'CREATE INDEX "idx_{lists_table_name}_list_id" ON "{lists_table_name}" (list_id)'
+    )
+    create_embedding_index_triggers(conn, table_name, key)
+
+    conn.execute(
+        f'INSERT INTO "{lists_table_name}" (integer_id, list_id) SELECT integer_id, {PENDING_LIST} FROM "{table_name}"'
+    )
+    assign_pending_rows(conn, table_name, key, centroids, batch_size)
+
+    version = uuid.uuid4().hex
+    conn.execute(
+        f'INSERT INTO "{settings_table_name}" (key, n_lists, n_probe, version) VALUES (?, ?, ?, ?)',
+        (key, n_lists, n_probe, version),
+    )
+
+    return version
+
+
+def drop_embedding_index(conn, table_name, settings_table_name, key):
+    centroids_table_name, lists_table_name = _table_names(table_name, key)
+
+    for event in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS "{lists_table_name}_{event}"')
+
+    conn.execute(f'DROP TABLE IF EXISTS "{centroids_table_name}"')
+    conn.execute(f'DROP TABLE IF EXISTS "{lists_table_name}"')
+    conn.execute(f'DELETE FROM "{settings_table_name}" WHERE key = ?', (key,))
+
+
+def clear_embedding_index(conn, table_name, key):
+    # after the indexed table was dropped and re-created, centroids are kept
+    _, lists_table_name = _table_names(table_name, key)
+    conn.execute(f'DELETE FROM "{lists_table_name}"')
+    create_embedding_index_triggers(conn, table_name, key)
+
+
+def load_centroids(conn, table_name, key):
+    centroids_table_name, _ = _table_names(table_name, key)
+    return to_matrix(
+        [
+            _[0]
+            for _ in conn.execute(
+                f'SELECT centroid FROM "{centroids_table_name}" ORDER BY list_id'
+            ).fetchall()
+        ]
+    )
+
+
+def assign_pending_rows(conn, table_name, key, centroids, batch_size=10000):
+    _, lists_table_name = _table_names(table_name, key)
+
+    while True:
+        rows = conn.execute(
+            f'SELECT l.integer_id, t."{key}" FROM "{lists_table_name}" l JOIN "{table_name}" t ON t.integer_id = l.integer_id WHERE l.list_id = {PENDING_LIST} LIMIT ?',
+            (batch_size,),
+        ).fetchall()
+
+        if not rows:
+            return
+
+        # rows without an embedding are kept out of every list
+        assignments = [(None, row[0]) for row in rows if row[1] is None]
+
+        rows = [row for row in rows if row[1] is not None]
+        if rows:
+            list_ids = _nearest_centroids(to_matrix([_[1] for _ in rows]), centroids)
+            assignments.extend(
+                (int(list_id), row[0]) for list_id, row in zip(list_ids, rows)
+            )
+
+        conn.executemany(
+            f'UPDATE "{lists_table_name}" SET list_id = ? WHERE integer_id = ?',
+            assignments,
+        )
+
+
+def probe_lists(centroids, queries, n_probe):
+    # (q, n_probe) ids of the lists nearest to each query
+    n_probe = max(1, min(n_probe, len(centroids)))
+    return np.argpartition(-(queries @ centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+
+def list_candidates(conn, table_name, key, list_ids, where_conditions, params):
+    # list ids, integer ids and embeddings of the rows in list_ids and the pending list that match the filter
+    _, lists_table_name = _table_names(table_name, key)
+
+    conditions = list(where_conditions) + [f'"{key}" IS NOT NULL']
+
+    rows = conn.execute(
+        f"""SELECT l.list_id, t.integer_id, t."{key}" FROM "{lists_table_name}" l JOIN (SELECT integer_id, "{key}" FROM "{table_name}" WHERE {' AND '.join(conditions)}) t ON t.integer_id = l.integer_id WHERE l.list_id IN (SELECT value FROM json_each(?))""",
+        list(params) + [json_ids([PENDING_LIST] + [int(_) for _ in list_ids])],
+    ).fetchall()
+
+    if not rows:
+        return (
+            np.empty(0, dtype=np.int64),
+            np.empty(0, dtype=np.int64),
+            np.empty((0, 0), dtype=np.float32),
+        )
+
+    return (
+        np.array([_[0] for _ in rows], dtype=np.int64),
+        np.array([_[1] for _ in rows], dtype=np.int64),
+        to_matrix([_[2] for _ in rows]),
+    )
+
+
+# filtered searches: a filter matching few rows is scored exactly over just those rows, a broad one is applied
+# to the results of a search over every row asking for FILTER_OVERSAMPLING times the expected number of
+# results it needs, widened until every query has its k matching rows
+FILTER_OVERSAMPLING = 2
+
+
+def estimated_row_count(conn, table_name):
+    # from the integer_id range, rows deleted in between are counted too. separate subqueries, sqlite only
+    # reads min() or max() from the end of the b-tree when it is alone in its query
+    first, last = conn.execute(
+        f'SELECT (SELECT MIN(integer_id) FROM "{table_name}"), (SELECT MAX(integer_id) FROM "{table_name}")'
+    ).fetchone()
+    return 0 if first is None else last - first + 1
+
+
+def filtered_rows(
+    conn, table_name, key, where_conditions, params, limit=None, with_vectors=False
+):
+    # (integer_ids, vectors, None) of the rows with an embedding matching the filter, sorted by integer_id, if at
+    # most limit match. else (None, None, selectivity), the fraction of rows matching, estimated from how many
+    # rows the first limit + 1 matches are spread over
+    # the filter is checked before the embedding, it is usually cheaper and rules out more rows
+    conditions = list(where_conditions) + [f'"{key}" IS NOT NULL']
+    columns = f'integer_id, "{key}"' if with_vectors else "integer_id"
+
+    query_str = f"""SELECT {columns} FROM "{table_name}" WHERE {' AND '.join(conditions)} ORDER BY integer_id"""
+    params = list(params)
+    if limit is not None:
+        # bound, the statement text does not depend on the limit
+        query_str += " LIMIT ?"
+        params.append(int(limit) + 1)
+
+    rows = conn.execute(query_str, params).fetchall()
+
+    if limit is not None and len(rows) > limit:
+        first = conn.execute(
+            f'SELECT MIN(integer_id) FROM "{table_name}"'
+        ).fetchone()[0]
+        return None, None, len(rows) / (rows[-1][0] - first + 1)
+
+    integer_ids = np.array([_[0] for _ in rows], dtype=np.int64)
+    if not with_vectors:
+        return integer_ids, None, None
+
+    return (
+        integer_ids,
+        to_matrix([_[1] for _ in rows])
+        if rows
+        else np.empty((0, 0), dtype=np.float32),
+        None,
+    )
+
+
+def matching_integer_ids(conn, table_name, integer_ids, where_conditions, params):
+    # sorted integer_ids of the given rows that match the filter
+    return np.array(
+        [
+            _[0]
+            for _ in conn.execute(
+                f"""SELECT integer_id FROM "{table_name}" WHERE integer_id IN (SELECT value FROM json_each(?)) AND {' AND '.join(where_conditions)} ORDER BY integer_id""",
+                [json_ids(integer_ids)] + list(params),
+            ).fetchall()
+        ],
+        dtype=np.int64,
+    )
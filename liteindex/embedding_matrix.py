@@ -0,0 +1,456 @@
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .change_feed import latest_cursor
+from .embedding_index import (
+    to_matrix,
+    json_ids,
+    embedding_distances,
+    distances_from_scores,
+    min_dots,
+    within_distance,
+    nearest,
+    block_nearest,
+)
+
+# In-memory copy of a normalized_embedding column for exact search when the vectorlite extension is not available.
+#
+# rows are kept sorted by integer_id in one contiguous float32 matrix, so a query is a single matrix-vector
+# product and an argpartition instead of a python function call per row. refresh() catches up with the table
+# through a change feed of the key (see change_feed.py), created by DefinedIndex along with the table:
+# - triggers log the integer_id of every insert, delete and update of the key with a monotonic seq, assigned
+#   under the write lock, so a write that waited on another writer is logged in commit order
+# - the rows logged after the last seq applied are re-read, then inserted, updated or dropped
+# - a gap before the first unread seq means the feed was compacted past it, a "clear" row that the table was
+#   dropped and re-created, both reload everything
+# nothing is read while PRAGMA data_version and the connection's total_changes are unchanged.
+#
+# with quantization only a compact copy is kept in memory and scanned, the closest k * rerank_factor
+# rows are then read back from the table and re-ranked with exact float32 distances:
+# - int8: every component scaled by 127 / the vector's largest absolute component, 4x smaller
+# - binary: one sign bit per component, ranked by hamming distance, 32x smaller
+#
+# with max_distance, rows beyond it are dropped while scanning. int8 dot products are off by at most
+# sum(|query|) * scale / 2, the scan only drops rows beyond the threshold by more than that. hamming
+# distances don't bound the exact distance, with binary the threshold is applied after re-ranking only.
+#
+# every query of a batch is scored in the same pass over the matrix, a block of rows at a time.
+
+QUANTIZATIONS = {"int8", "binary"}
+
+DEFAULT_RERANK_FACTORS = {"int8": 4, "binary": 16}
+
+if np is not None and hasattr(np, "bitwise_count"):
+
+    def _bit_count(x):
+        # sign bits are padded to whole 8 byte words
+        return np.bitwise_count(x.view(np.uint64))
+
+elif np is not None:
+    _BIT_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(
+        axis=1, dtype=np.uint8
+    )
+
+    def _bit_count(x):
+        return _BIT_COUNTS[x]
+
+
+def embedding_changes_table_name(table_name, key):
+    # change feed of the key's writes, see change_feed.py
+    return f"__{table_name}_embedding_changes_{key}"
+
+
+def _sign_bits(vectors):
+    bits = np.packbits(vectors > 0, axis=1)
+    padding = -bits.shape[1] % 8
+    if padding:
+        bits = np.pad(bits, ((0, 0), (0, padding)))
+    return bits
+
+
+class EmbeddingMatrix:
+    def __init__(self, table_name, key, quantization=None):
+        if quantization is not None and quantization not in QUANTIZATIONS:
+            raise ValueError(
+                f"Invalid quantization: {quantization}, can be one of int8, binary or None"
+            )
+
+        self.table_name = table_name
+        self.key = key
+        self.quantization = quantization
+
+        self.size = 0
+        # arrays have room for more rows than size, rows past size are unused
+        self.integer_ids = np.empty(0, dtype=np.int64)
+        self.has_embedding = np.empty(0, dtype=bool)
+        # float32 embeddings, int8 codes or packed sign bits, allocated once the first embedding tells its dimension
+        self.vectors = None
+        # int8 only, multiplies a code's dot product back to the embedding's
+        self.scales = np.empty(0, dtype=np.float32)
+        # seq of the last change feed row applied, None before the first load
+        self.seq = None
+
+        self.__lock = threading.Lock()
+        # PRAGMA data_version and total_changes last seen by each thread's connection
+        self.__local_storage = threading.local()
+
+    def refresh(self, conn):
+        # data_version changes only on commits from other connections, total_changes catches this connection's own
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        total_changes = conn.total_changes
+
+        local_storage = self.__local_storage
+        if (
+            getattr(local_storage, "conn", None) is conn
+            and local_storage.data_version == data_version
+            and local_storage.total_changes == total_changes
+        ):
+            return
+
+        with self.__lock:
+            self.__refresh(conn)
+
+        local_storage.conn = conn
+        local_storage.data_version = data_version
+        local_storage.total_changes = total_changes
+
+    def __reserve(self, size):
+        if size <= len(self.integer_ids):
+            return
+
+        capacity = max(size, 2 * len(self.integer_ids), 1024)
+
+        integer_ids = np.empty(capacity, dtype=np.int64)
+        integer_ids[: self.size] = self.integer_ids[: self.size]
+        self.integer_ids = integer_ids
+
+        has_embedding = np.zeros(capacity, dtype=bool)
+        has_embedding[: self.size] = self.has_embedding[: self.size]
+        self.has_embedding = has_embedding
+
+        if self.vectors is not None:
+            vectors = np.zeros(
+                (capacity, self.vectors.shape[1]), dtype=self.vectors.dtype
+            )
+            vectors[: self.size] = self.vectors[: self.size]
+            self.vectors = vectors
+
+        if self.quantization == "int8":
+            scales = np.zeros(capacity, dtype=np.float32)
+            scales[: self.size] = self.scales[: self.size]
+            self.scales = scales
+
+    def __encode(self, vectors):
+        if self.quantization == "int8":
+            scales = np.abs(vectors).max(axis=1)
+            scales[scales == 0] = 1
+            codes = np.round(vectors / scales[:, None] * 127).astype(np.int8)
+            return codes, scales / 127
+
+        if self.quantization == "binary":
+            return _sign_bits(vectors), None
+
+        return vectors, None
+
+    def __set_vectors(self, positions, blobs):
+        positions = [p for p, blob in zip(positions, blobs) if blob is not None]
+        if not positions:
+            return
+
+        codes, scales = self.__encode(
+            to_matrix([blob for blob in blobs if blob is not None])
+        )
+        if self.vectors is None:
+            self.vectors = np.zeros(
+                (len(self.integer_ids), codes.shape[1]), dtype=codes.dtype
+            )
+            if self.quantization == "int8":
+                self.scales = np.zeros(len(self.integer_ids), dtype=np.float32)
+
+        self.vectors[positions] = codes
+        if scales is not None:
+            self.scales[positions] = scales
+        self.has_embedding[positions] = True
+
+    def __refresh(self, conn):
+        feed_table_name = embedding_changes_table_name(self.table_name, self.key)
+
+        if self.seq is None:
+            return self.__load(conn, feed_table_name)
+
+        changes = conn.execute(
+            f'SELECT seq, integer_id FROM "{feed_table_name}" WHERE seq > ? ORDER BY seq',
+            (self.seq,),
+        ).fetchall()
+        if not changes:
+            return
+
+        if changes[0][0] != self.seq + 1 or any(_[1] is None for _ in changes):
+            return self.__load(conn, feed_table_name)
+
+        # rows changed again after this read are logged again and re-read by the next refresh
+        self.seq = changes[-1][0]
+
+        changed_ids = np.unique(np.array([_[1] for _ in changes], dtype=np.int64))
+        rows = conn.execute(
+            f'SELECT integer_id, "{self.key}" FROM "{self.table_name}" WHERE integer_id IN (SELECT value FROM json_each(?)) ORDER BY integer_id',
+            (json_ids(changed_ids.tolist()),),
+        ).fetchall()
+
+        cached_ids = self.integer_ids[: self.size]
+        positions = np.minimum(
+            np.searchsorted(cached_ids, changed_ids), max(self.size - 1, 0)
+        )
+        is_cached = (
+            cached_ids[positions] == changed_ids
+            if self.size
+            else np.zeros(len(changed_ids), dtype=bool)
+        )
+        cached = set(changed_ids[is_cached].tolist())
+
+        updated = [row for row in rows if row[0] in cached]
+        if updated:
+            # searches keep using the arrays they took under the lock, cached rows are only changed in copies
+            self.has_embedding = self.has_embedding.copy()
+            if self.vectors is not None:
+                self.vectors = self.vectors.copy()
+            if self.quantization == "int8":
+                self.scales = self.scales.copy()
+
+            update_positions = np.searchsorted(
+                cached_ids, [_[0] for _ in updated]
+            ).tolist()
+            self.has_embedding[update_positions] = False
+            self.__set_vectors(update_positions, [_[1] for _ in updated])
+
+        inserted = [row for row in rows if row[0] not in cached]
+        if inserted:
+            if self.size and inserted[0][0] <= cached_ids[-1]:
+                # AUTOINCREMENT ids only grow, an older one means the table started over
+                return self.__load(conn, feed_table_name)
+
+            # rows past size aren't part of any search's arrays, they are written in place
+            self.__reserve(self.size + len(inserted))
+            self.integer_ids[self.size : self.size + len(inserted)] = [
+                _[0] for _ in inserted
+            ]
+            self.__set_vectors(
+                range(self.size, self.size + len(inserted)),
+                [_[1] for _ in inserted],
+            )
+            self.size += len(inserted)
+
+        # logged rows that are cached but gone from the table were deleted
+        is_deleted = is_cached & ~np.isin(changed_ids, [_[0] for _ in rows])
+        if is_deleted.any():
+            keep = np.ones(self.size, dtype=bool)
+            keep[positions[is_deleted]] = False
+
+            self.size = int(keep.sum())
+            self.integer_ids = self.integer_ids[: len(keep)][keep]
+            self.has_embedding = self.has_embedding[: len(keep)][keep]
+            if self.vectors is not None:
+                self.vectors = self.vectors[: len(keep)][keep]
+            if self.quantization == "int8":
+                self.scales = self.scales[: len(keep)][keep]
+
+    def __load(self, conn, feed_table_name):
+        # the cursor is read first, changes committed while the rows are read are applied again next time
+        self.seq = latest_cursor(conn, feed_table_name)
+
+        rows = conn.execute(
+            f'SELECT integer_id, "{self.key}" FROM "{self.table_name}" ORDER BY integer_id'
+        ).fetchall()
+
+        self.size = 0
+        self.integer_ids = np.empty(0, dtype=np.int64)
+        self.has_embedding = np.empty(0, dtype=bool)
+        self.vectors = None
+        self.scales = np.empty(0, dtype=np.float32)
+
+        self.__reserve(len(rows))
+        self.integer_ids[: len(rows)] = [_[0] for _ in rows]
+        self.__set_vectors(range(len(rows)), [_[1] for _ in rows])
+        self.size = len(rows)
+
+    def __block_scores(self, embeddings, signs, vectors, scales):
+        # (q, n), lower is closer: hamming distances or negated dot products, approximate when quantized
+        if self.quantization == "binary":
+            return _bit_count(signs[:, None, :] ^ vectors[None, :, :]).sum(
+                axis=2, dtype=np.float32
+            )
+
+        if self.quantization == "int8":
+            # codes are converted to float32 a few thousand at a time, while they still fit in the cpu cache
+            return -np.concatenate(
+                [
+                    embeddings @ vectors[i : i + 4096].astype(np.float32).T
+                    for i in range(0, len(vectors), 4096)
+                ],
+                axis=1,
+            ) * scales
+
+        return -(embeddings @ vectors.T)
+
+    def search(
+        self,
+        conn,
+        embeddings,
+        metric="cosine",
+        k=None,
+        reversed_sort=False,
+        integer_ids=None,
+        rerank_factor=None,
+        max_distance=None,
+    ):
+        # [(integer_ids, distances)] of the k closest rows for each embedding, only rows of the sorted integer_ids if given
+        # and within max_distance if given
+        with self.__lock:
+            size = self.size
+            cached_integer_ids = self.integer_ids[:size]
+            has_embedding = self.has_embedding[:size]
+            vectors = self.vectors[:size] if self.vectors is not None else None
+            scales = self.scales[:size] if self.quantization == "int8" else None
+
+        if vectors is None or not size:
+            return [
+                (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+                for _ in embeddings
+            ]
+
+        if integer_ids is not None:
+            positions = np.minimum(
+                np.searchsorted(cached_integer_ids, integer_ids), size - 1
+            )
+            # rows written after the refresh are not cached yet
+            positions = positions[
+                (cached_integer_ids[positions] == integer_ids)
+                & has_embedding[positions]
+            ]
+        elif not has_embedding.all():
+            positions = np.flatnonzero(has_embedding)
+        else:
+            positions = None
+
+        if positions is not None:
+            cached_integer_ids = cached_integer_ids[positions]
+            vectors = vectors[positions]
+            if scales is not None:
+                scales = scales[positions]
+
+        candidates_k = k
+        if self.quantization is not None and k is not None:
+            candidates_k = k * (
+                DEFAULT_RERANK_FACTORS[self.quantization]
+                if rerank_factor is None
+                else rerank_factor
+            )
+
+        signs = _sign_bits(embeddings) if self.quantization == "binary" else None
+
+        bounds = None
+        if max_distance is not None and self.quantization != "binary":
+            # 1e-5 covers float32 rounding, rows right at the threshold are decided by the exact distance
+            bounds = min_dots(embeddings, max_distance, metric)[:, None] - 1e-5
+            query_l1_norms = np.abs(embeddings).sum(axis=1)[:, None]
+
+        def block_scores(start, stop):
+            scores = self.__block_scores(
+                embeddings,
+                signs,
+                vectors[start:stop],
+                None if scales is None else scales[start:stop],
+            )
+
+            if bounds is not None:
+                # -scores are the (approximate) dot products
+                beyond = -scores < (
+                    bounds - query_l1_norms * scales[start:stop] / 2
+                    if self.quantization == "int8"
+                    else bounds
+                )
+
+            # with binary and max_distance the candidates are the closest rows, the rows within the threshold
+            # are among them, reversed_sort only orders the re-ranked ones
+            if reversed_sort and (bounds is not None or max_distance is None):
+                scores = -scores
+
+            if bounds is not None:
+                scores[beyond] = np.inf
+
+            return scores
+
+        results = block_nearest(
+            block_scores,
+            len(vectors),
+            len(embeddings),
+            candidates_k,
+            # binary scores go through a (queries, rows, bytes) array
+            row_cost=vectors.shape[1] if self.quantization == "binary" else 1,
+        )
+
+        if self.quantization is not None:
+            return self.__rerank(
+                conn,
+                embeddings,
+                [cached_integer_ids[positions] for positions, _ in results],
+                metric,
+                k,
+                reversed_sort,
+                max_distance,
+            )
+
+        return within_distance(
+            [
+                (
+                    cached_integer_ids[positions],
+                    distances_from_scores(embedding, scores, metric, reversed_sort),
+                )
+                for embedding, (positions, scores) in zip(embeddings, results)
+            ],
+            max_distance,
+        )
+
+    def __rerank(
+        self, conn, embeddings, candidates, metric, k, reversed_sort, max_distance
+    ):
+        # exact distances of each query's candidates, their embeddings are read from the table once
+        integer_ids = np.unique(np.concatenate(candidates))
+
+        rows = conn.execute(
+            f'SELECT integer_id, "{self.key}" FROM "{self.table_name}" WHERE integer_id IN (SELECT value FROM json_each(?)) AND "{self.key}" IS NOT NULL ORDER BY integer_id',
+            (json_ids(integer_ids.tolist()),),
+        ).fetchall()
+
+        if not rows:
+            return [
+                (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+                for _ in embeddings
+            ]
+
+        stored_integer_ids = np.array([_[0] for _ in rows], dtype=np.int64)
+        vectors = to_matrix([_[1] for _ in rows])
+
+        reranked = []
+        for embedding, integer_ids in zip(embeddings, candidates):
+            positions = np.minimum(
+                np.searchsorted(stored_integer_ids, integer_ids), len(rows) - 1
+            )
+            # deleted since the matrix was refreshed
+            positions = positions[stored_integer_ids[positions] == integer_ids]
+
+            distances = embedding_distances(
+                embedding[None], vectors[positions], metric
+            )[0]
+            if max_distance is not None:
+                positions = positions[distances <= max_distance]
+                distances = distances[distances <= max_distance]
+
+            order = nearest(distances, k, reversed_sort)
+            reranked.append((stored_integer_ids[positions[order]], distances[order]))
+
+        return reranked
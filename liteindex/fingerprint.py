@@ -0,0 +1,161 @@
+import sys
+import struct
+import pickle
+import hashlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# fingerprint(obj) is a 32 char hex digest of a canonical encoding of obj, used as function_cache keys.
+#
+# - every value is written with a type tag and a length, so different structures never produce the same bytes
+# - dicts and sets are written in sorted order, insertion order doesn't matter
+# - floats with an integer value are written as ints, f(1) and f(1.0) share a key
+# - numpy arrays write dtype, shape and a hash of the raw buffer, non-contiguous views are copied to C order first
+# - pandas objects use pandas' own row hashing, only if pandas was already imported by the caller
+# - register_fingerprinter(type, func): func(obj) returns any fingerprintable value that stands in for obj
+# - anything else is pickled
+#
+# buffers are hashed with xxh3_128 if xxhash is installed, else with sha256 (hardware accelerated on most cpus)
+
+_fingerprinters = {}
+# type -> registered func for it or one of its bases, None if there is none
+_resolved_fingerprinters = {}
+
+
+def register_fingerprinter(_type, func):
+    _fingerprinters[_type] = func
+    _resolved_fingerprinters.clear()
+
+
+def _custom_fingerprinter(_type):
+    try:
+        return _resolved_fingerprinters[_type]
+    except KeyError:
+        pass
+
+    func = next(
+        (_fingerprinters[base] for base in _type.__mro__ if base in _fingerprinters),
+        None,
+    )
+    _resolved_fingerprinters[_type] = func
+
+    return func
+
+
+def _hash(data):
+    if xxhash is not None:
+        return xxhash.xxh3_128_digest(data)
+    return hashlib.sha256(data).digest()[:16]
+
+
+def _digest(obj):
+    out = []
+    _encode(obj, out)
+    return _hash(b"".join(out))
+
+
+def _encode(obj, out):
+    _type = type(obj)
+
+    if _type is str:
+        data = obj.encode("utf-8", "surrogatepass")
+        out.append(b"s%d:" % len(data))
+        out.append(data)
+
+    elif _type is int:
+        out.append(b"i%d;" % obj)
+
+    elif obj is None:
+        out.append(b"N")
+
+    elif _type is bool:
+        out.append(b"T" if obj else b"F")
+
+    elif _type is float:
+        if obj.is_integer():
+            out.append(b"i%d;" % obj)
+        elif obj != obj:
+            out.append(b"n")
+        else:
+            out.append(b"f" + struct.pack("<d", obj))
+
+    elif _type is tuple or _type is list:
+        out.append((b"t%d:" if _type is tuple else b"l%d:") % len(obj))
+        for item in obj:
+            _encode(item, out)
+
+    elif _type is dict:
+        # str keys (kwargs) are sorted directly, any other keys are ordered by their digests
+        # since only strs are guaranteed a total order
+        if all(type(key) is str for key in obj):
+            out.append(b"d%d:" % len(obj))
+            for key, value in sorted(obj.items()):
+                _encode(key, out)
+                _encode(value, out)
+        else:
+            out.append(b"D%d:" % len(obj))
+            for key_digest, value in sorted(
+                ((_digest(key), value) for key, value in obj.items()),
+                key=lambda _: _[0],
+            ):
+                out.append(key_digest)
+                _encode(value, out)
+
+    elif _type is set or _type is frozenset:
+        if all(type(item) is str for item in obj):
+            out.append(b"e%d:" % len(obj))
+            for item in sorted(obj):
+                _encode(item, out)
+        else:
+            out.append(b"E%d:" % len(obj))
+            out.extend(sorted(_digest(item) for item in obj))
+
+    elif _type is bytes or _type is bytearray or _type is memoryview:
+        data = bytes(obj)
+        out.append(b"b%d:" % len(data))
+        out.append(data)
+
+    elif _custom_fingerprinter(_type) is not None:
+        name = f"{_type.__module__}.{_type.__qualname__}".encode()
+        out.append(b"c%d:" % len(name))
+        out.append(name)
+        _encode(_custom_fingerprinter(_type)(obj), out)
+
+    elif np is not None and isinstance(obj, np.ndarray) and not obj.dtype.hasobject:
+        header = f"{obj.dtype.str}{obj.shape}".encode()
+        out.append(b"a%d:" % len(header))
+        out.append(header)
+        out.append(_hash(np.ascontiguousarray(obj)))
+
+    elif np is not None and isinstance(obj, np.generic):
+        _encode(obj.item(), out)
+
+    elif "pandas" in sys.modules and isinstance(
+        obj, (sys.modules["pandas"].DataFrame, sys.modules["pandas"].Series)
+    ):
+        pandas = sys.modules["pandas"]
+        if isinstance(obj, pandas.DataFrame):
+            header = [list(obj.columns), [str(_) for _ in obj.dtypes]]
+        else:
+            header = [obj.name, str(obj.dtype)]
+
+        out.append(b"p" if isinstance(obj, pandas.DataFrame) else b"P")
+        _encode(header, out)
+        _encode(pandas.util.hash_pandas_object(obj, index=True).values, out)
+
+    else:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        out.append(b"o%d:" % len(data))
+        out.append(data)
+
+
+def fingerprint(obj):
+    return _digest(obj).hex()
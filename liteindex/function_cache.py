@@ -1,36 +1,919 @@
 import os
+import re
+import sys
+import atexit
+import time
+import uuid
+import types
+import weakref
+import asyncio
+import threading
+import inspect
 import tempfile
+import functools
+import itertools
+from collections import deque, OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from .kv_index import KVIndex, EvictionCfg
+from .tiered_kv_index import TieredKVIndex
+from .fingerprint import fingerprint
+
+_MISSING = object()
+
+# chunks of a generator function read or written per getvalues / update
+_GENERATOR_BATCH_SIZE = 64
 
 
 def function_cache(
-    func,
+    func=None,
     path=os.path.join(tempfile.gettempdir(), "cache.db"),
     ram_cache_mb=32,
     eviction_policy=EvictionCfg.EvictFIFO,
     max_number_of_items=100000,
     max_size_in_mb=0,
     invalidate_after_seconds=0,
+    stale_after_seconds=0,
+    bloom_filter=False,
+    batch_arg=None,
+    single_flight=True,
+    lease_seconds=None,
+    lease_poll_interval=0.05,
+    namespace=None,
+    version=None,
+    code_version=False,
+    spill_path=None,
 ):
-    cache = KVIndex(
-        path,
-        store_key=False,
-        ram_cache_mb=ram_cache_mb,
-        eviction=EvictionCfg(
-            eviction_policy,
-            max_number_of_items=100000,
-            max_size_in_mb=0,
-            invalidate_after_seconds=0,
+    # used as @function_cache(...) with arguments
+    if func is None:
+        return functools.partial(
+            function_cache,
+            path=path,
+            ram_cache_mb=ram_cache_mb,
+            eviction_policy=eviction_policy,
+            max_number_of_items=max_number_of_items,
+            max_size_in_mb=max_size_in_mb,
+            invalidate_after_seconds=invalidate_after_seconds,
+            stale_after_seconds=stale_after_seconds,
+            bloom_filter=bloom_filter,
+            batch_arg=batch_arg,
+            single_flight=single_flight,
+            lease_seconds=lease_seconds,
+            lease_poll_interval=lease_poll_interval,
+            namespace=namespace,
+            version=version,
+            code_version=code_version,
+            spill_path=spill_path,
+        )
+
+    if (
+        stale_after_seconds
+        and invalidate_after_seconds
+        and stale_after_seconds >= invalidate_after_seconds
+    ):
+        raise ValueError(
+            "stale_after_seconds has to be less than invalidate_after_seconds"
+        )
+
+    eviction = EvictionCfg(
+        eviction_policy,
+        max_number_of_items=max_number_of_items,
+        max_size_in_mb=max_size_in_mb,
+        invalidate_after_seconds=invalidate_after_seconds,
+    )
+
+    if path is not None:
+        cache = KVIndex(
+            path,
+            store_key=False,
+            ram_cache_mb=ram_cache_mb,
+            eviction=eviction,
+            bloom_filter=bloom_filter,
+            name=_table_name(func, namespace, version, code_version),
+            shared_connections=True,
+            store_created_at=bool(stale_after_seconds),
+        )
+    elif lease_seconds is not None:
+        raise ValueError("lease_seconds needs a cache file, path can't be None")
+    elif spill_path is None:
+        cache = _MemoryCache(eviction)
+    else:
+        # results live in memory, the ones evicted from it and the rest at exit are written to
+        # spill_path, after a restart they are read back from it on first use
+        cache = TieredKVIndex(
+            spill_path,
+            hot_max_items=_memory_max_items(eviction) or sys.maxsize,
+            write_back=True,
+            store_key=False,
+            ram_cache_mb=ram_cache_mb,
+            eviction=eviction,
+            name=_table_name(func, namespace, version, code_version),
+            shared_connections=True,
+            store_created_at=bool(stale_after_seconds),
+        )
+        _spilled_caches.add(cache)
+
+    entries = _Entries(cache, stale_after_seconds)
+
+    wrapper = _wrap(
+        func, entries, batch_arg, single_flight, lease_seconds, lease_poll_interval
+    )
+    # clears only this function's table, other functions cached in the same file are kept
+    wrapper.invalidate = cache.clear
+
+    if batch_arg is None and not (
+        inspect.iscoroutinefunction(func)
+        or inspect.isgeneratorfunction(func)
+        or inspect.isasyncgenfunction(func)
+    ):
+        wrapper.map = functools.partial(_map, wrapper, entries)
+
+    return wrapper
+
+
+# caches with a spill_path still alive at exit, flushed once by _flush_spilled_caches. held weakly so that
+# caches of discarded functions are freed, TieredKVIndex flushes itself when it is
+_spilled_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_spilled_caches():
+    for cache in list(_spilled_caches):
+        cache.flush()
+
+
+def _memory_max_items(eviction):
+    # 0 is unbounded
+    if eviction.policy == EvictionCfg.EvictNone:
+        return 0
+    return eviction.max_number_of_items
+
+
+class _MemoryCache:
+    # the cache for path=None, one OrderedDict in eviction order shared by all threads of the process.
+    # EvictLRU and EvictLFU (kept as LRU) move hits to the end, the other policies evict the least
+    # recently written. max_size_in_mb only applies to files. holds (value, created_at), items older
+    # than invalidate_after_seconds are deleted when read
+    def __init__(self, eviction):
+        self.move_hits_to_end = eviction.policy in {
+            EvictionCfg.EvictLRU,
+            EvictionCfg.EvictLFU,
+        }
+        self.max_number_of_items = _memory_max_items(eviction)
+        self.max_age = eviction.invalidate_after_seconds or None
+
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __get(self, key, now):
+        # caller holds the lock
+        item = self.__items.get(key)
+        if item is None:
+            return None
+
+        if self.max_age is not None and now - item[1] >= self.max_age:
+            del self.__items[key]
+            return None
+
+        if self.move_hits_to_end:
+            self.__items.move_to_end(key)
+        return item
+
+    def get(self, key, default=None):
+        with self.__lock:
+            item = self.__get(key, time.time())
+
+        return default if item is None else item[0]
+
+    def getvalues(self, keys, default=None, return_created_at=False):
+        with self.__lock:
+            now = time.time()
+            items = [self.__get(key, now) for key in keys]
+
+        if return_created_at:
+            return [(default, None) if item is None else item for item in items]
+
+        return [default if item is None else item[0] for item in items]
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def update(self, items):
+        with self.__lock:
+            now = time.time()
+            for key, value in items:
+                self.__items[key] = (value, now)
+                self.__items.move_to_end(key)
+
+            if self.max_number_of_items:
+                while len(self.__items) > self.max_number_of_items:
+                    self.__items.popitem(last=False)
+
+    def clear(self):
+        with self.__lock:
+            self.__items.clear()
+
+
+def _code_fingerprint(code):
+    # bytecode, names and constants, nested functions and lambdas are code objects in co_consts
+    return (
+        code.co_code,
+        code.co_names,
+        tuple(
+            _code_fingerprint(const) if isinstance(const, types.CodeType) else const
+            for const in code.co_consts
         ),
     )
 
+
+def _table_name(func, namespace, version, code_version):
+    # every function gets its own table in the file, named after its namespace and a hash of
+    # the namespace and version, a new version starts an empty table
+    if namespace is None:
+        namespace = f"{func.__module__}.{func.__qualname__}"
+
+    if code_version:
+        version = (version, _code_fingerprint(func.__code__))
+
+    readable_namespace = re.sub(r"[^A-Za-z0-9_]", "_", namespace)[:48]
+
+    return f"fc_{readable_namespace}_{fingerprint((namespace, version))[:12]}"
+
+
+class _Entries:
+    # the cache treats values older than invalidate_after_seconds as missing and deletes them. values
+    # older than stale_after_seconds are returned as stale and the caller refreshes them in the background
+    def __init__(self, cache, stale_after_seconds):
+        self.cache = cache
+        self.stale_after_seconds = stale_after_seconds
+        self.refresher = _Refresher()
+
+    def get(self, key):
+        # returns (value, stale), value is _MISSING on a miss
+        if not self.stale_after_seconds:
+            return self.cache.get(key, _MISSING), False
+
+        return self.get_many([key])[0]
+
+    def get_many(self, keys):
+        if not self.stale_after_seconds:
+            return [
+                (value, False)
+                for value in self.cache.getvalues(keys, default=_MISSING)
+            ]
+
+        stale_before = time.time() - self.stale_after_seconds
+        return [
+            (value, created_at is not None and created_at <= stale_before)
+            for value, created_at in self.cache.getvalues(
+                keys, default=_MISSING, return_created_at=True
+            )
+        ]
+
+    def set(self, key, value):
+        self.cache[key] = value
+
+    def set_many(self, items):
+        self.cache.update(items)
+
+
+_refresh_executor = None
+_refresh_executor_lock = threading.Lock()
+
+
+def _get_refresh_executor():
+    global _refresh_executor
+
+    with _refresh_executor_lock:
+        if _refresh_executor is None:
+            _refresh_executor = ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 1) + 4),
+                thread_name_prefix="function_cache_refresh",
+            )
+
+        return _refresh_executor
+
+
+class _Refresher:
+    # refreshes stale keys in the background, each key by at most one job at a time.
+    # a failed refresh keeps the stale value, the next stale read tries again
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refreshing = set()
+        # running asyncio tasks, the loop only keeps weak references to them
+        self.tasks = set()
+
+    def __claim(self, keys):
+        with self.lock:
+            claimed = [key for key in dict.fromkeys(keys) if key not in self.refreshing]
+            self.refreshing.update(claimed)
+
+        return claimed
+
+    def __release(self, keys):
+        with self.lock:
+            self.refreshing.difference_update(keys)
+
+    def submit(self, keys, refresh):
+        # refresh(claimed_keys) runs on a thread of the shared refresh executor
+        claimed = self.__claim(keys)
+        if not claimed:
+            return
+
+        def run():
+            try:
+                refresh(claimed)
+            except Exception:
+                pass
+            finally:
+                self.__release(claimed)
+
+        _get_refresh_executor().submit(run)
+
+    def create_task(self, loop, keys, refresh):
+        # await refresh(claimed_keys) runs as a task on the caller's loop
+        claimed = self.__claim(keys)
+        if not claimed:
+            return
+
+        async def run():
+            try:
+                await refresh(claimed)
+            except Exception:
+                pass
+            finally:
+                self.__release(claimed)
+
+        task = loop.create_task(run())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+def _wrap(func, entries, batch_arg, single_flight, lease_seconds, lease_poll_interval):
+    is_async = inspect.iscoroutinefunction(func)
+    is_generator = inspect.isgeneratorfunction(func)
+    is_async_generator = inspect.isasyncgenfunction(func)
+
+    if batch_arg is not None and (is_generator or is_async_generator):
+        raise ValueError("batch_arg can't be used with generator functions")
+
+    if is_generator:
+        return _generator_wrapper(func, entries)
+
+    if is_async_generator:
+        return _async_generator_wrapper(func, entries)
+
+    if batch_arg is not None:
+        if is_async:
+            return _async_batch_wrapper(func, entries, batch_arg)
+        return _batch_wrapper(func, entries, batch_arg)
+
+    if is_async:
+        return _async_wrapper(
+            func, entries, single_flight, lease_seconds, lease_poll_interval
+        )
+
+    if not single_flight:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = fingerprint((args, kwargs))
+
+            value, stale = entries.get(key)
+            if value is not _MISSING:
+                if stale:
+                    entries.refresher.submit(
+                        [key], lambda _: entries.set(key, func(*args, **kwargs))
+                    )
+                return value
+
+            value = func(*args, **kwargs)
+            entries.set(key, value)
+            return value
+
+        return wrapper
+
+    return _single_flight_wrapper(func, entries, lease_seconds, lease_poll_interval)
+
+
+class _Flight:
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def _single_flight_wrapper(func, entries, lease_seconds, lease_poll_interval):
+    # on a miss one thread per process computes while the other threads with the same arguments
+    # wait for its result. with lease_seconds set, a lease row in the cache file also makes other
+    # processes wait and poll the cache instead of computing, a lease left behind by a crashed
+    # process expires after lease_seconds
+    in_flight = {}
+    lock = threading.Lock()
+    cache = entries.cache
+
+    def compute(key, args, kwargs):
+        if lease_seconds is None:
+            value = func(*args, **kwargs)
+            entries.set(key, value)
+            return value
+
+        while True:
+            token = cache.acquire_lease(key, lease_seconds)
+
+            if token is not None:
+                try:
+                    # the previous lease holder may have finished between the miss and taking the lease
+                    value = entries.get(key)[0]
+                    if value is _MISSING:
+                        value = func(*args, **kwargs)
+                        entries.set(key, value)
+                    return value
+                finally:
+                    cache.release_lease(key, token)
+
+            time.sleep(lease_poll_interval)
+
+            value = entries.get(key)[0]
+            if value is not _MISSING:
+                return value
+
+    def refresh(key, args, kwargs):
+        if lease_seconds is None:
+            entries.set(key, func(*args, **kwargs))
+            return
+
+        # a process holding the lease is already computing the key
+        token = cache.acquire_lease(key, lease_seconds)
+        if token is None:
+            return
+
+        try:
+            entries.set(key, func(*args, **kwargs))
+        finally:
+            cache.release_lease(key, token)
+
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        key = (args, kwargs)
+        key = fingerprint((args, kwargs))
+
+        value, stale = entries.get(key)
+        if value is not _MISSING:
+            if stale:
+                entries.refresher.submit([key], lambda _: refresh(key, args, kwargs))
+            return value
+
+        with lock:
+            flight = in_flight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = in_flight[key] = _Flight()
+
+        if not is_leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
         try:
-            return cache[key]
-        except KeyError:
-            value = func(*args, **kwargs)
-            cache[key] = value
+            # a previous leader may have finished between the miss and taking the lock
+            flight.value = entries.get(key)[0]
+            if flight.value is _MISSING:
+                flight.value = compute(key, args, kwargs)
+            return flight.value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with lock:
+                del in_flight[key]
+            flight.done.set()
+
+    return wrapper
+
+
+def _async_wrapper(func, entries, single_flight, lease_seconds, lease_poll_interval):
+    # cache reads and writes run in the event loop's default executor. with single_flight, concurrent
+    # awaits of the same arguments on the same loop share one task, so the function runs once for all
+    # of them, and lease_seconds protects across processes the same way as for plain functions
+    in_flight = {}
+    cache = entries.cache
+
+    async def refresh(loop, key, args, kwargs):
+        if lease_seconds is None:
+            value = await func(*args, **kwargs)
+            await loop.run_in_executor(None, entries.set, key, value)
+            return
+
+        # a process holding the lease is already computing the key
+        token = await loop.run_in_executor(None, cache.acquire_lease, key, lease_seconds)
+        if token is None:
+            return
+
+        try:
+            value = await func(*args, **kwargs)
+            await loop.run_in_executor(None, entries.set, key, value)
+        finally:
+            await loop.run_in_executor(None, cache.release_lease, key, token)
+
+    async def compute_missing(loop, key, args, kwargs):
+        if lease_seconds is None:
+            value = await func(*args, **kwargs)
+            await loop.run_in_executor(None, entries.set, key, value)
+            return value
+
+        while True:
+            token = await loop.run_in_executor(
+                None, cache.acquire_lease, key, lease_seconds
+            )
+
+            if token is not None:
+                try:
+                    # the previous lease holder may have finished between the miss and taking the lease
+                    value = (await loop.run_in_executor(None, entries.get, key))[0]
+                    if value is _MISSING:
+                        value = await func(*args, **kwargs)
+                        await loop.run_in_executor(None, entries.set, key, value)
+                    return value
+                finally:
+                    await loop.run_in_executor(None, cache.release_lease, key, token)
+
+            await asyncio.sleep(lease_poll_interval)
+
+            value = (await loop.run_in_executor(None, entries.get, key))[0]
+            if value is not _MISSING:
+                return value
+
+    async def compute(loop, key, args, kwargs):
+        value, stale = await loop.run_in_executor(None, entries.get, key)
+        if value is not _MISSING:
+            if stale:
+                entries.refresher.create_task(
+                    loop, [key], lambda _: refresh(loop, key, args, kwargs)
+                )
             return value
 
+        return await compute_missing(loop, key, args, kwargs)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        key = fingerprint((args, kwargs))
+        if not single_flight:
+            return await compute(loop, key, args, kwargs)
+
+        flight_key = (loop, key)
+
+        task = in_flight.get(flight_key)
+        if task is None:
+            task = loop.create_task(compute(loop, key, args, kwargs))
+            in_flight[flight_key] = task
+            task.add_done_callback(lambda _: in_flight.pop(flight_key, None))
+
+        # a cancelled caller must not cancel the computation the other callers are waiting on
+        return await asyncio.shield(task)
+
+    return wrapper
+
+
+class _GeneratorRecording:
+    # chunks are written in batches under "<key>:<generation>:<i>", the header (generation, number
+    # of chunks) goes in the same write as the last batch, a reader never finds a header without
+    # all of its chunks. every recording has a new generation, readers still replaying an older one
+    # don't see a mix of both, chunks of older generations are left to eviction
+    def __init__(self, key):
+        self.key = key
+        self.generation = uuid.uuid4().hex[:8]
+        self.number_of_chunks = 0
+        self.buffer = []
+
+    def add(self, chunk):
+        # returns a batch to write once enough chunks are buffered
+        self.buffer.append(
+            (f"{self.key}:{self.generation}:{self.number_of_chunks}", chunk)
+        )
+        self.number_of_chunks += 1
+
+        if len(self.buffer) >= _GENERATOR_BATCH_SIZE:
+            batch, self.buffer = self.buffer, []
+            return batch
+
+    def finish(self):
+        return self.buffer + [(self.key, (self.generation, self.number_of_chunks))]
+
+
+def _chunk_key_batches(key, header):
+    generation, number_of_chunks = header
+
+    for start in range(0, number_of_chunks, _GENERATOR_BATCH_SIZE):
+        yield start, [
+            f"{key}:{generation}:{i}"
+            for i in range(start, min(start + _GENERATOR_BATCH_SIZE, number_of_chunks))
+        ]
+
+
+def _generator_wrapper(func, entries):
+    # on a miss chunks are passed through as they are produced and recorded, on a hit they are
+    # replayed from the cache _GENERATOR_BATCH_SIZE at a time. a recording is only complete once
+    # the generator is exhausted, a consumer that stops early or an exception leaves no header
+    def record(key, args, kwargs, skip=0):
+        recording = _GeneratorRecording(key)
+
+        for i, chunk in enumerate(func(*args, **kwargs)):
+            batch = recording.add(chunk)
+            if batch:
+                entries.set_many(batch)
+
+            if i >= skip:
+                yield chunk
+
+        entries.set_many(recording.finish())
+
+    def replay(key, header, args, kwargs):
+        for start, keys in _chunk_key_batches(key, header):
+            for i, (chunk, _) in enumerate(entries.get_many(keys), start):
+                if chunk is _MISSING:
+                    # evicted since the header was read, the rest comes from a new run
+                    yield from record(key, args, kwargs, skip=i)
+                    return
+
+                yield chunk
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = fingerprint((args, kwargs))
+
+        header, stale = entries.get(key)
+        if header is _MISSING:
+            yield from record(key, args, kwargs)
+            return
+
+        if stale:
+            entries.refresher.submit(
+                [key], lambda _: deque(record(key, args, kwargs), maxlen=0)
+            )
+
+        yield from replay(key, header, args, kwargs)
+
+    return wrapper
+
+
+def _async_generator_wrapper(func, entries):
+    # same as _generator_wrapper, cache reads and writes run in the event loop's default executor
+    async def record(loop, key, args, kwargs, skip=0):
+        recording = _GeneratorRecording(key)
+
+        i = 0
+        async for chunk in func(*args, **kwargs):
+            batch = recording.add(chunk)
+            if batch:
+                await loop.run_in_executor(None, entries.set_many, batch)
+
+            if i >= skip:
+                yield chunk
+            i += 1
+
+        await loop.run_in_executor(None, entries.set_many, recording.finish())
+
+    async def replay(loop, key, header, args, kwargs):
+        for start, keys in _chunk_key_batches(key, header):
+            cached = await loop.run_in_executor(None, entries.get_many, keys)
+
+            for i, (chunk, _) in enumerate(cached, start):
+                if chunk is _MISSING:
+                    async for chunk in record(loop, key, args, kwargs, skip=i):
+                        yield chunk
+                    return
+
+                yield chunk
+
+    async def refresh(loop, key, args, kwargs):
+        async for _ in record(loop, key, args, kwargs):
+            pass
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        key = fingerprint((args, kwargs))
+
+        header, stale = await loop.run_in_executor(None, entries.get, key)
+        if header is _MISSING:
+            chunks = record(loop, key, args, kwargs)
+        else:
+            if stale:
+                entries.refresher.create_task(
+                    loop, [key], lambda _: refresh(loop, key, args, kwargs)
+                )
+            chunks = replay(loop, key, header, args, kwargs)
+
+        async for chunk in chunks:
+            yield chunk
+
+    return wrapper
+
+
+class _BatchCall:
+    # every item of the batch argument is cached on its own, keyed by the item and the other arguments
+    def __init__(self, signature, batch_arg, args, kwargs):
+        self.batch_arg = batch_arg
+        self.bound = signature.bind(*args, **kwargs)
+        self.bound.apply_defaults()
+
+        other_arguments = tuple(
+            (name, value)
+            for name, value in self.bound.arguments.items()
+            if name != batch_arg
+        )
+
+        self.items = list(self.bound.arguments[batch_arg])
+        self.keys = [fingerprint((item, other_arguments)) for item in self.items]
+
+    def set_cached(self, cached):
+        # cached is [(value, stale), ...] in the order of self.keys
+        self.results = [value for value, _ in cached]
+
+        # duplicates in a batch are computed once
+        missed = {}
+        # stale key -> position of its first item
+        self.stale = {}
+        for i, (key, (value, stale)) in enumerate(zip(self.keys, cached)):
+            if value is _MISSING:
+                missed.setdefault(key, []).append(i)
+            elif stale:
+                self.stale.setdefault(key, i)
+
+        self.missed_keys = list(missed)
+        self.missed_positions = list(missed.values())
+
+    def __arguments(self, positions):
+        # a stale refresh builds its arguments on another thread, self.bound is never modified
+        arguments = dict(self.bound.arguments)
+        arguments[self.batch_arg] = [self.items[i] for i in positions]
+
+        bound = inspect.BoundArguments(self.bound.signature, arguments)
+        return bound.args, bound.kwargs
+
+    def missed_arguments(self):
+        return self.__arguments([positions[0] for positions in self.missed_positions])
+
+    def stale_arguments(self, keys):
+        return self.__arguments([self.stale[key] for key in keys])
+
+    def set_computed(self, func, computed):
+        # returns the items to write to the cache
+        computed = list(computed)
+
+        if len(computed) != len(self.missed_keys):
+            raise ValueError(
+                f"{func.__name__} returned {len(computed)} results for a batch of {len(self.missed_keys)}"
+            )
+
+        for positions, value in zip(self.missed_positions, computed):
+            for i in positions:
+                self.results[i] = value
+
+        return list(zip(self.missed_keys, computed))
+
+
+def _check_batch_arg(func, batch_arg):
+    signature = inspect.signature(func)
+
+    if batch_arg not in signature.parameters:
+        raise ValueError(f"{func.__name__} has no argument named {batch_arg}")
+
+    return signature
+
+
+def _batch_wrapper(func, entries, batch_arg):
+    signature = _check_batch_arg(func, batch_arg)
+
+    def refresh(call, keys):
+        args, kwargs = call.stale_arguments(keys)
+        entries.set_many(zip(keys, func(*args, **kwargs)))
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call = _BatchCall(signature, batch_arg, args, kwargs)
+        call.set_cached(entries.get_many(call.keys))
+
+        if call.stale:
+            # items already being refreshed by an earlier call are left out
+            entries.refresher.submit(list(call.stale), lambda keys: refresh(call, keys))
+
+        if call.missed_keys:
+            args, kwargs = call.missed_arguments()
+            entries.set_many(call.set_computed(func, func(*args, **kwargs)))
+
+        return call.results
+
+    return wrapper
+
+
+def _async_batch_wrapper(func, entries, batch_arg):
+    signature = _check_batch_arg(func, batch_arg)
+
+    async def refresh(loop, call, keys):
+        args, kwargs = call.stale_arguments(keys)
+        items = list(zip(keys, await func(*args, **kwargs)))
+        await loop.run_in_executor(None, entries.set_many, items)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+
+        call = _BatchCall(signature, batch_arg, args, kwargs)
+        call.set_cached(await loop.run_in_executor(None, entries.get_many, call.keys))
+
+        if call.stale:
+            entries.refresher.create_task(
+                loop, list(call.stale), lambda keys: refresh(loop, call, keys)
+            )
+
+        if call.missed_keys:
+            args, kwargs = call.missed_arguments()
+            items = call.set_computed(func, await func(*args, **kwargs))
+            await loop.run_in_executor(None, entries.set_many, items)
+
+        return call.results
+
     return wrapper
+
+
+def _call_each(wrapper, items):
+    # runs in the pool. the wrapper is pickled by reference to its module level name, func itself
+    # can't be since that name points to the wrapper
+    func = wrapper.__wrapped__
+    return [func(item) for item in items]
+
+
+def _map(wrapper, entries, iterable, workers=None, executor="thread", chunk_size=1000):
+    # every chunk is looked up with one getvalues, its misses are split over the workers and
+    # written back with one update. the next chunk is looked up and queued while the previous
+    # one is computed, results are yielded in input order. processes are opt-in, they unpickle
+    # the wrapper by importing its module, which deadlocks if map runs while that module is imported
+    workers = workers or os.cpu_count() or 1
+
+    if isinstance(executor, Executor):
+        pool, owns_pool = executor, False
+    elif executor == "process":
+        pool, owns_pool = ProcessPoolExecutor(max_workers=workers), True
+    elif executor == "thread":
+        pool, owns_pool = ThreadPoolExecutor(max_workers=workers), True
+    else:
+        raise ValueError(
+            f"Invalid executor: {executor}, can be process, thread or an Executor"
+        )
+
+    def submit(chunk):
+        keys = [fingerprint(((item,), {})) for item in chunk]
+        results = [value for value, _ in entries.get_many(keys)]
+
+        # key -> positions of its items, duplicates are computed once
+        missed = {}
+        for i, (key, value) in enumerate(zip(keys, results)):
+            if value is _MISSING:
+                missed.setdefault(key, []).append(i)
+
+        missed_items = [chunk[positions[0]] for positions in missed.values()]
+        size = max(1, -(-len(missed_items) // workers))
+
+        futures = [
+            pool.submit(_call_each, wrapper, missed_items[i : i + size])
+            for i in range(0, len(missed_items), size)
+        ]
+
+        return results, missed, futures
+
+    def collect(results, missed, futures):
+        computed = [value for future in futures for value in future.result()]
+
+        if computed:
+            entries.set_many(zip(missed, computed))
+
+        for positions, value in zip(missed.values(), computed):
+            for i in positions:
+                results[i] = value
+
+        return results
+
+    iterator = iter(iterable)
+    pending = deque()
+
+    try:
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_size))
+            if not chunk:
+                break
+
+            pending.append(submit(chunk))
+
+            if len(pending) > 1:
+                yield from collect(*pending.popleft())
+
+        while pending:
+            yield from collect(*pending.popleft())
+    finally:
+        if owns_pool:
+            pool.shutdown()
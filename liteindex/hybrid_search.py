@@ -0,0 +1,62 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Hybrid search fuses a lexical ranking (bm25 of a $text condition) with an embedding ranking.
+#
+# each engine returns the FUSION_CANDIDATES_FACTOR * k best rows as (integer_ids, scores), without reading
+# the records. the text index is queried on a background thread while the embeddings are scored on the
+# caller's thread, sqlite and numpy both release the GIL. only the k fused rows are read and deserialized.
+#
+# - rrf: sum of weight / (RRF_K + rank) over the rankings a row is in, rank starts at 1
+# - weighted: sum of weight * score, scores min-max normalized to [0, 1] within each ranking
+
+FUSIONS = {"rrf", "weighted"}
+
+RRF_K = 60
+
+FUSION_CANDIDATES_FACTOR = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_hybrid_search_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=min(32, (os.cpu_count() or 1) + 4),
+                thread_name_prefix="hybrid_search",
+            )
+
+        return _executor
+
+
+def fuse(rankings, fusion="rrf", k=None):
+    # rankings: [(integer_ids, scores, weight)], best first, higher scores are better.
+    # returns (integer_ids, fused scores) of the k best rows, best first
+    if fusion not in FUSIONS:
+        raise ValueError(f"Invalid fusion: {fusion}, can be one of rrf, weighted")
+
+    fused = {}
+    for integer_ids, scores, weight in rankings:
+        if not integer_ids:
+            continue
+
+        if fusion == "rrf":
+            for rank, integer_id in enumerate(integer_ids, 1):
+                fused[integer_id] = fused.get(integer_id, 0) + weight / (RRF_K + rank)
+        else:
+            low, high = min(scores), max(scores)
+            for integer_id, score in zip(integer_ids, scores):
+                normalized = (score - low) / (high - low) if high > low else 1.0
+                fused[integer_id] = fused.get(integer_id, 0) + weight * normalized
+
+    # ties keep the order rows were first seen in, the text ranking before the embedding one
+    ranked = sorted(fused.items(), key=lambda item: -item[1])
+    if k is not None:
+        ranked = ranked[:k]
+
+    return [_[0] for _ in ranked], [_[1] for _ in ranked]
@@ -0,0 +1,111 @@
+# Value index of a json key, or of a path inside it, of a DefinedIndex.
+#
+#   TABLE __<table>_json_<key.a.b> (value, integer_id) WITHOUT ROWID, PRIMARY KEY (value, integer_id)
+#
+# one row for every value json_each() yields for the row's json, array elements for arrays and the value
+# itself for scalars. plain SQL triggers on the indexed table replace a row's values on every insert, update
+# and delete of the key, so writes from every process and connection keep it correct.
+#
+# membership conditions ($in, $nin, $like and lists) on an indexed path look values up here instead of
+# running json_each() on every row. comparisons on a path use the expression index optimize_for_query
+# creates on the same json_extract() parse_query generates.
+
+
+def json_path_column(key, path=None):
+    # the expression parse_query compares, an index on exactly this expression is used by sqlite
+    if not path:
+        return key
+    return f"json_extract({key}, '$.{'.'.join(path)}')"
+
+
+def split_json_path(json_path, schema):
+    # "key.a.b" -> ("key", ["a", "b"]) when key is a json key of schema
+    key, *path = json_path.split(".")
+
+    if schema.get(key) != "json":
+        raise ValueError(f"{key} is not a json key")
+
+    if any(not _ or "'" in _ or '"' in _ for _ in path):
+        raise ValueError(f"Invalid json path: {json_path}")
+
+    return key, path
+
+
+def json_value_index_table_name(table_name, json_path):
+    return f"__{table_name}_json_{json_path}"
+
+
+def create_json_value_index_triggers(conn, table_name, key, path):
+    # triggers live on the indexed table and are dropped along with it
+    value_table_name = json_value_index_table_name(table_name, ".".join([key] + path))
+
+    # json_each(json, path) yields nothing for a missing path and the value itself for a scalar
+    insert = f"""INSERT OR IGNORE INTO "{value_table_name}" (value, integer_id) SELECT value, NEW.integer_id FROM json_each(NEW."{key}", '${''.join('.' + _ for _ in path)}');"""
+    delete = f"""DELETE FROM "{value_table_name}" WHERE integer_id = OLD.integer_id;"""
+
+    for event, body in (
+        ("insert", insert),
+        ("update", delete + "\n" + insert),
+        ("delete", delete),
+    ):
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS "{value_table_name}_{event}"
+            AFTER {event.upper()}{f' OF "{key}"' if event == "update" else ''} ON "{table_name}"
+            BEGIN
+                {body}
+            END;
+            """
+        )
+
+
+def create_json_value_index(conn, table_name, key, path):
+    value_table_name = json_value_index_table_name(table_name, ".".join([key] + path))
+
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{value_table_name}" (value, integer_id INTEGER NOT NULL, PRIMARY KEY (value, integer_id)) WITHOUT ROWID"""
+    )
+    conn.execute(
+        f"""CREATE INDEX IF NOT EXISTS "{value_table_name}_integer_id" ON "{value_table_name}" (integer_id)"""
+    )
+
+    # indexes the rows already stored
+    conn.execute(f'DELETE FROM "{value_table_name}"')
+    conn.execute(
+        f"""INSERT OR IGNORE INTO "{value_table_name}" (value, integer_id) SELECT json_each.value, "{table_name}".integer_id FROM "{table_name}", json_each("{table_name}"."{key}", '${''.join('.' + _ for _ in path)}') WHERE "{table_name}"."{key}" IS NOT NULL"""
+    )
+
+    create_json_value_index_triggers(conn, table_name, key, path)
+
+
+def drop_json_value_index(conn, table_name, json_path):
+    value_table_name = json_value_index_table_name(table_name, json_path)
+
+    for event in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS "{value_table_name}_{event}"')
+
+    conn.execute(f'DROP TABLE IF EXISTS "{value_table_name}"')
+
+
+def clear_json_value_index(conn, table_name, key, path):
+    # after the indexed table was dropped and re-created
+    value_table_name = json_value_index_table_name(table_name, ".".join([key] + path))
+    conn.execute(f'DELETE FROM "{value_table_name}"')
+    create_json_value_index_triggers(conn, table_name, key, path)
+
+
+def json_value_index_paths(conn, table_name, schema):
+    # "key.a.b" of every value index on a json key of schema
+    prefix = json_value_index_table_name(table_name, "")
+
+    return {
+        json_path
+        for json_path in (
+            row[0][len(prefix) :]
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND substr(name, 1, ?) = ?",
+                (len(prefix), prefix),
+            ).fetchall()
+        )
+        if schema.get(json_path.split(".")[0]) == "json"
+    }
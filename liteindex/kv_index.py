@@ -1,10 +1,30 @@
 from .common_utils import set_ulimit, EvictionCfg
-from .kv_index_utils import create_tables, create_where_clause
+from .kv_index_utils import create_tables, create_where_clause, in_list_batches
+from .connection_pool import ConnectionPool
+from .change_feed import (
+    create_change_feed,
+    drop_change_feed,
+    change_feed_exists,
+    latest_cursor,
+    watch_changes,
+)
+from .bloom_filter import (
+    bloom_filter_exists,
+    create_bloom_filter,
+    rebuild_bloom_filter,
+    fold_bloom_filter,
+    load_bloom_filter,
+    WalChangeCounter,
+    _LOG_FOLD_ROWS,
+)
+from .maintenance import auto_vacuum_mode, run_maintenance, MaintenanceSchedule
 
 set_ulimit()
 
 import os
+import re
 import time
+import uuid
 import pickle
 import hashlib
 import sqlite3
@@ -12,7 +32,55 @@ import threading
 import functools
 
 
+def _connect(db_path, statement_cache_size, auto_vacuum, ram_cache_mb):
+    conn = sqlite3.connect(
+        db_path,
+        uri=True,
+        check_same_thread=False,
+        cached_statements=statement_cache_size,
+    )
+    # has to come before journal_mode=WAL to take effect on a new file
+    conn.execute(f"PRAGMA auto_vacuum={auto_vacuum}")
+
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    conn.execute(f"PRAGMA cache_size=-{ram_cache_mb * 1024}")
+
+    conn.execute(f"PRAGMA BUSY_TIMEOUT=60000")
+
+    return conn
+
+
+def encode_and_hash_key(x, return_encoded_key=False):
+    # (key_hash, encoded key), keys of up to 32 bytes are their own key_hash. keys that compare equal in
+    # python but encode differently (1, 1.0 and True) are different keys
+    x = (
+        pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
+        if not isinstance(x, str)
+        else x.encode()
+    )
+
+    if len(x) <= 32:
+        return sqlite3.Binary(x), None
+    else:
+        return sqlite3.Binary(hashlib.sha256(x).digest()), (
+            None if not return_encoded_key else sqlite3.Binary(x)
+        )
+
+
+# pool settings -> [pool, number of indexes using it], for indexes created with shared_connections=True.
+# reentrant, garbage collection can run an index's __del__ while __init__ of another holds it
+_shared_connection_pools = {}
+_shared_connection_pools_lock = threading.RLock()
+
+
 class KVIndex:
+    # __del__ also runs when __init__ raised before the pool was set
+    __connection_pool = None
+    __shared_connection_pool_key = None
+    __bloom_filter_wal = None
+
     def __init__(
         self,
         db_path=None,
@@ -20,6 +88,18 @@ class KVIndex:
         preserve_order=True,
         ram_cache_mb=32,
         eviction=EvictionCfg(EvictionCfg.EvictNone),
+        max_connections=None,
+        idle_connection_timeout=60,
+        statement_cache_size=128,
+        bloom_filter=False,
+        bloom_filter_capacity=None,
+        bloom_filter_error_rate=0.01,
+        auto_vacuum="incremental",
+        auto_vacuum_increment=1000,
+        maintenance_interval=60,
+        name="kv_index",
+        shared_connections=False,
+        store_created_at=False,
     ):
         self.store_key = store_key
         self.eviction = eviction
@@ -30,11 +110,80 @@ class KVIndex:
         ) else None
 
         self.ram_cache_mb = ram_cache_mb
+        self.statement_cache_size = statement_cache_size
         self.preserve_order = (
             preserve_order or self.eviction.policy == EvictionCfg.EvictFIFO
         )
 
-        self.__local_storage = threading.local()
+        # items older than this, in __current_time units, are misses and deleted on the next write or maintain()
+        self.__max_age = (
+            int(self.eviction.invalidate_after_seconds * 100000)
+            if self.eviction.invalidate_after_seconds > 0
+            else None
+        )
+
+        self.auto_vacuum = auto_vacuum_mode(auto_vacuum)
+        self.auto_vacuum_increment = auto_vacuum_increment
+        self.__maintenance_schedule = MaintenanceSchedule(maintenance_interval)
+
+        connect = functools.partial(
+            _connect,
+            self.db_path,
+            self.statement_cache_size,
+            self.auto_vacuum,
+            self.ram_cache_mb,
+        )
+
+        # indexes on the same file with the same settings can use one pool, one connection per thread
+        # for all of them instead of one per index. every :memory: connection is a separate database
+        if shared_connections and self.db_path != ":memory:":
+            self.__shared_connection_pool_key = (
+                os.path.abspath(self.db_path),
+                self.statement_cache_size,
+                self.auto_vacuum,
+                self.ram_cache_mb,
+                max_connections,
+                idle_connection_timeout,
+            )
+
+            with _shared_connection_pools_lock:
+                shared_pool = _shared_connection_pools.get(
+                    self.__shared_connection_pool_key
+                )
+                if shared_pool is None:
+                    shared_pool = _shared_connection_pools[
+                        self.__shared_connection_pool_key
+                    ] = [
+                        ConnectionPool(
+                            connect,
+                            max_connections=max_connections,
+                            idle_timeout=idle_connection_timeout,
+                        ),
+                        0,
+                    ]
+                shared_pool[1] += 1
+
+            self.__connection_pool = shared_pool[0]
+        else:
+            self.__connection_pool = ConnectionPool(
+                connect,
+                max_connections=max_connections,
+                idle_timeout=idle_connection_timeout,
+            )
+
+        if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name) or name.lower().startswith(
+            "sqlite_"
+        ):
+            raise ValueError(
+                f"Invalid name: {name}, can only contain letters, digits and underscores and can't start with a digit or sqlite_"
+            )
+
+        # indexes with different names share a file, each one has its own tables
+        self.name = name
+        self.__table = f'"{name}"'
+        self.__metadata_table = f'"{name}_num_metadata"'
+        self.__leases_table = f'"{name}_leases"'
+        self.__changes_table_name = f"{name}_changes"
 
         with self.__connection as conn:
             create_tables(
@@ -42,64 +191,228 @@ class KVIndex:
                 preserve_order=self.preserve_order,
                 eviction=self.eviction,
                 conn=conn,
+                table_name=self.name,
+                store_created_at=store_created_at,
             )
 
+            # rows are written positionally, tables created by other settings can have more columns
+            columns = [
+                row[1] for row in conn.execute(f"PRAGMA table_info({self.__table})")
+            ]
+            self.__store_updated_at = "updated_at" in columns
+            self.store_created_at = "created_at" in columns
+
+            # once a table has a bloom filter every instance opening it uses it and folds its log
+            self.bloom_filter = bloom_filter or bloom_filter_exists(conn, self.name)
+
+            if bloom_filter:
+                create_bloom_filter(
+                    conn,
+                    self.name,
+                    capacity=bloom_filter_capacity
+                    or self.eviction.max_number_of_items
+                    or 1000000,
+                    error_rate=bloom_filter_error_rate,
+                )
+
+        if self.bloom_filter:
+            self.__bloom_filter_lock = threading.Lock()
+            self.__bloom_filter_connect = connect
+            # wal-index header as of the last sync
+            self.__bloom_filter_wal = WalChangeCounter.open(connect, self.db_path)
+            self.__bloom_filter_header = None
+            # without it, connection, PRAGMA data_version and total_changes as of each thread's last sync
+            self.__bloom_filter_local_storage = threading.local()
+            self.__bloom_filter = None
+            self.__bloom_filter_epoch = None
+            self.__bloom_filter_version = None
+            # the first write checks whether the log is due for folding
+            self.__bloom_filter_unfolded_keys = _LOG_FOLD_ROWS
+            self.__bloom_filter_sync()
+
     @property
     def __connection(self):
-        if (
-            not hasattr(self.__local_storage, "db_conn")
-            or self.__local_storage.db_conn is None
-        ):
-            self.__local_storage.db_conn = sqlite3.connect(self.db_path, uri=True)
-            self.__local_storage.db_conn.execute("PRAGMA journal_mode=WAL")
-            self.__local_storage.db_conn.execute("PRAGMA synchronous=NORMAL")
+        return self.__connection_pool.connection()
 
-            self.__local_storage.db_conn.execute("PRAGMA auto_vacuum=FULL")
-            self.__local_storage.db_conn.execute("PRAGMA auto_vacuum_increment=1000")
+    def connection_pool_stats(self):
+        return self.__connection_pool.stats()
 
-            self.__local_storage.db_conn.execute(
-                f"PRAGMA cache_size=-{self.ram_cache_mb * 1024}"
-            )
+    def maintain(self, vacuum_pages=None, checkpoint="passive"):
+        if self.__max_age is not None:
+            with self.__connection as conn:
+                self.__delete_expired(conn)
+
+        return run_maintenance(
+            self.__connection,
+            vacuum_pages=self.auto_vacuum_increment
+            if vacuum_pages is None
+            else vacuum_pages,
+            checkpoint=checkpoint,
+        )
 
-            self.__local_storage.db_conn.execute(f"PRAGMA BUSY_TIMEOUT=60000")
+    def __maintain_if_due(self):
+        if not self.__maintenance_schedule.due():
+            return
 
-        return self.__local_storage.db_conn
+        try:
+            self.maintain()
+        except sqlite3.OperationalError:
+            # another connection holds the write lock, try again next interval
+            pass
 
     def __current_time(self):
         return int(time.time() * 100000)
 
+    def __not_expired(self):
+        # condition and parameters added to lookups by key
+        if self.__max_age is None:
+            return "", ()
+
+        return " AND created_at > ?", (self.__current_time() - self.__max_age,)
+
+    def __delete_expired(self, conn):
+        expired_before = self.__current_time() - self.__max_age
+
+        if self.eviction.max_size_in_mb:
+            sizes = conn.execute(
+                f"DELETE FROM {self.__table} WHERE created_at <= ? RETURNING size_in_bytes",
+                (expired_before,),
+            ).fetchall()
+
+            if sizes:
+                conn.execute(
+                    f"UPDATE {self.__metadata_table} SET num = num - ? WHERE key = ?",
+                    (
+                        sum([size[0] for size in sizes]) / (1024 * 1024),
+                        "current_size_in_mb",
+                    ),
+                )
+        else:
+            conn.execute(
+                f"DELETE FROM {self.__table} WHERE created_at <= ?",
+                (expired_before,),
+            )
+
     def __setitem__(self, key, value):
-        self.update({key: value})
+        self.update([(key, value)])
+
+    def __bloom_filter_may_contain(self, key_hash):
+        if self.__bloom_filter.may_contain(key_hash):
+            return True
+
+        return self.__bloom_filter_sync() and self.__bloom_filter.may_contain(key_hash)
+
+    @property
+    def __bloom_filter_wal_counter(self):
+        wal = self.__bloom_filter_wal
+
+        # the parent's connection is never used after a fork
+        if wal is not None and wal.pid != os.getpid():
+            wal = self.__bloom_filter_wal = WalChangeCounter.open(
+                self.__bloom_filter_connect, self.db_path
+            )
+
+        return wal
+
+    def __bloom_filter_sync(self):
+        # a negative is only trusted once the filter has every commit, writes of this index are merged by
+        # update() itself. with the wal-index header any commit changes it, without it PRAGMA data_version
+        # changes on commits from other connections and total_changes on writes of other indexes sharing
+        # this connection. returns whether it synced
+        wal = self.__bloom_filter_wal_counter
+
+        if wal is not None:
+            header = wal.header()
+
+            if (
+                header is not None
+                and header == self.__bloom_filter_header
+                and self.__bloom_filter_epoch is not None
+            ):
+                return False
+
+            with self.__bloom_filter_lock:
+                self.__bloom_filter_load(wal.conn)
+                self.__bloom_filter_header = header
+
+            return True
+
+        conn = self.__connection
+        local_storage = self.__bloom_filter_local_storage
+
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        total_changes = conn.total_changes
+
+        if (
+            getattr(local_storage, "conn", None) is conn
+            and local_storage.data_version == data_version
+            and local_storage.total_changes == total_changes
+            and self.__bloom_filter_epoch is not None
+        ):
+            return False
+
+        with self.__bloom_filter_lock:
+            self.__bloom_filter_load(conn)
+
+        local_storage.conn = conn
+        local_storage.data_version = data_version
+        local_storage.total_changes = total_changes
+
+        return True
+
+    def __bloom_filter_load(self, conn):
+        # called with __bloom_filter_lock held
+        (
+            self.__bloom_filter,
+            self.__bloom_filter_epoch,
+            self.__bloom_filter_version,
+        ) = load_bloom_filter(
+            conn,
+            self.name,
+            self.__bloom_filter,
+            self.__bloom_filter_epoch,
+            self.__bloom_filter_version,
+        )
+
+    def __bloom_filter_reload(self):
+        # after a rebuild, the next sync reloads the whole filter
+        with self.__bloom_filter_lock:
+            self.__bloom_filter_epoch = None
 
     def __getitem__(self, key):
         key = self.__encode_and_hash(key, return_encoded_key=False)[0]
 
+        if self.bloom_filter and not self.__bloom_filter_may_contain(key):
+            raise KeyError
+
+        not_expired, not_expired_params = self.__not_expired()
+
         if self.eviction.policy in {EvictionCfg.EvictAny, EvictionCfg.EvictNone}:
             row = self.__connection.execute(
-                "SELECT num_value, string_value, pickled_value FROM kv_index WHERE key_hash = ?",
-                (key,),
+                f"SELECT num_value, string_value, pickled_value FROM {self.__table} WHERE key_hash = ?{not_expired}",
+                (key, *not_expired_params),
             ).fetchone()
         else:
             with self.__connection as conn:
                 if self.eviction.policy == EvictionCfg.EvictLRU:
                     row = conn.execute(
-                        "UPDATE kv_index SET last_accessed_time = ? WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
-                        (self.__current_time(), key),
+                        f"UPDATE {self.__table} SET last_accessed_time = ? WHERE key_hash = ?{not_expired} RETURNING num_value, string_value, pickled_value",
+                        (self.__current_time(), key, *not_expired_params),
                     ).fetchone()
                 elif self.eviction.policy == EvictionCfg.EvictLFU:
                     row = conn.execute(
-                        "UPDATE kv_index SET access_frequency = access_frequency + 1 WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
-                        (key,),
+                        f"UPDATE {self.__table} SET access_frequency = access_frequency + 1 WHERE key_hash = ?{not_expired} RETURNING num_value, string_value, pickled_value",
+                        (key, *not_expired_params),
                     ).fetchone()
                 elif self.eviction.policy == EvictionCfg.EvictAny:
                     row = conn.execute(
-                        "UPDATE kv_index SET updated_at = ? WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
-                        (self.__current_time(), key),
+                        f"UPDATE {self.__table} SET updated_at = ? WHERE key_hash = ?{not_expired} RETURNING num_value, string_value, pickled_value",
+                        (self.__current_time(), key, *not_expired_params),
                     ).fetchone()
                 elif self.eviction.policy == EvictionCfg.EvictFIFO:
                     row = conn.execute(
-                        "UPDATE kv_index SET updated_at = ? WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
-                        (self.__current_time(), key),
+                        f"UPDATE {self.__table} SET updated_at = ? WHERE key_hash = ?{not_expired} RETURNING num_value, string_value, pickled_value",
+                        (self.__current_time(), key, *not_expired_params),
                     ).fetchone()
 
         if row is None:
@@ -107,40 +420,61 @@ class KVIndex:
 
         return self.__decode_value(row)
 
-    def getvalues(self, keys, default=None):
+    def getvalues(self, keys, default=None, return_created_at=False):
+        # with return_created_at, (value, created_at) pairs, created_at in seconds since the epoch and
+        # None for missing keys
+        if return_created_at and not self.store_created_at:
+            raise ValueError(
+                "created_at is not stored, pass store_created_at=True or set eviction.invalidate_after_seconds"
+            )
+
         keys = [self.__encode_and_hash(key)[0] for key in keys]
 
+        columns = "key_hash, num_value, string_value, pickled_value" + (
+            ", created_at" if return_created_at else ""
+        )
+        not_expired, not_expired_params = self.__not_expired()
+
+        rows = []
+
         if self.eviction.policy in {EvictionCfg.EvictAny, EvictionCfg.EvictNone}:
-            rows = self.__connection.execute(
-                f"SELECT key_hash, num_value, string_value, pickled_value FROM kv_index WHERE key_hash IN ({', '.join(['?'] * len(keys))})",
-                keys,
-            ).fetchall()
+            for placeholders, batch in in_list_batches(keys):
+                rows += self.__connection.execute(
+                    f"SELECT {columns} FROM {self.__table} WHERE key_hash IN ({placeholders}){not_expired}",
+                    (*batch, *not_expired_params),
+                ).fetchall()
 
         else:
             with self.__connection as conn:
-                if self.eviction.policy == EvictionCfg.EvictLRU:
-                    rows = conn.execute(
-                        f"UPDATE kv_index SET last_accessed_time = ? WHERE key_hash IN ({', '.join(['?'] * len(keys))}) RETURNING key_hash, num_value, string_value, pickled_value",
-                        (self.__current_time(), *keys),
-                    ).fetchall()
-                elif self.eviction.policy == EvictionCfg.EvictLFU:
-                    rows = conn.execute(
-                        f"UPDATE kv_index SET access_frequency = access_frequency + 1 WHERE key_hash IN ({', '.join(['?'] * len(keys))}) RETURNING key_hash, num_value, string_value, pickled_value",
-                        keys,
-                    ).fetchall()
-                elif self.eviction.policy == EvictionCfg.EvictAny:
-                    rows = conn.execute(
-                        f"UPDATE kv_index SET updated_at = ? WHERE key_hash IN ({', '.join(['?'] * len(keys))}) RETURNING key_hash, num_value, string_value, pickled_value",
-                        (self.__current_time(), *keys),
-                    ).fetchall()
-                elif self.eviction.policy == EvictionCfg.EvictFIFO:
-                    rows = conn.execute(
-                        f"UPDATE kv_index SET updated_at = ? WHERE key_hash IN ({', '.join(['?'] * len(keys))}) RETURNING key_hash, num_value, string_value, pickled_value",
-                        (self.__current_time(), *keys),
-                    ).fetchall()
-
-        if rows is None:
-            raise KeyError
+                for placeholders, batch in in_list_batches(keys):
+                    if self.eviction.policy == EvictionCfg.EvictLRU:
+                        rows += conn.execute(
+                            f"UPDATE {self.__table} SET last_accessed_time = ? WHERE key_hash IN ({placeholders}){not_expired} RETURNING {columns}",
+                            (self.__current_time(), *batch, *not_expired_params),
+                        ).fetchall()
+                    elif self.eviction.policy == EvictionCfg.EvictLFU:
+                        rows += conn.execute(
+                            f"UPDATE {self.__table} SET access_frequency = access_frequency + 1 WHERE key_hash IN ({placeholders}){not_expired} RETURNING {columns}",
+                            (*batch, *not_expired_params),
+                        ).fetchall()
+                    elif self.eviction.policy == EvictionCfg.EvictAny:
+                        rows += conn.execute(
+                            f"UPDATE {self.__table} SET updated_at = ? WHERE key_hash IN ({placeholders}){not_expired} RETURNING {columns}",
+                            (self.__current_time(), *batch, *not_expired_params),
+                        ).fetchall()
+                    elif self.eviction.policy == EvictionCfg.EvictFIFO:
+                        rows += conn.execute(
+                            f"UPDATE {self.__table} SET updated_at = ? WHERE key_hash IN ({placeholders}){not_expired} RETURNING {columns}",
+                            (self.__current_time(), *batch, *not_expired_params),
+                        ).fetchall()
+
+        if return_created_at:
+            rows = {
+                row[0]: (self.__decode_value(row[1:4]), row[4] / 100000)
+                for row in rows
+            }
+
+            return [rows.get(key_hash, (default, None)) for key_hash in keys]
 
         rows = {row[0]: self.__decode_value(row[1:]) for row in rows}
 
@@ -155,7 +489,7 @@ class KVIndex:
                 "Cannot iterate over items in reverse when preserve_order is False"
             )
 
-        sql = f"SELECT key_hash, pickled_key, num_value, string_value, pickled_value FROM kv_index"
+        sql = f"SELECT key_hash, pickled_key, num_value, string_value, pickled_value FROM {self.__table}"
         if self.preserve_order:
             sql += f" ORDER BY updated_at {'DESC' if reverse else 'ASC'}, rowid {'DESC' if reverse else 'ASC'}"
         elif reverse:
@@ -178,7 +512,7 @@ class KVIndex:
                 "Cannot iterate over items in reverse when preserve_order is False"
             )
 
-        sql = f"SELECT key_hash, pickled_key FROM kv_index"
+        sql = f"SELECT key_hash, pickled_key FROM {self.__table}"
         if self.preserve_order:
             sql += f" ORDER BY updated_at {'DESC' if reverse else 'ASC'}, rowid {'DESC' if reverse else 'ASC'}"
         elif reverse:
@@ -198,7 +532,7 @@ class KVIndex:
                 "Cannot iterate over items in reverse when preserve_order is False"
             )
 
-        sql = f"SELECT num_value, string_value, pickled_value FROM kv_index"
+        sql = f"SELECT num_value, string_value, pickled_value FROM {self.__table}"
         if self.preserve_order:
             sql += f" ORDER BY updated_at {'DESC' if reverse else 'ASC'}, rowid {'DESC' if reverse else 'ASC'}"
         elif reverse:
@@ -215,12 +549,19 @@ class KVIndex:
             yield self.__decode_value(value)
 
     def __len__(self):
-        return self.__connection.execute("SELECT COUNT(*) FROM kv_index").fetchone()[0]
+        return self.__connection.execute(f"SELECT COUNT(*) FROM {self.__table}").fetchone()[0]
 
     def __contains__(self, key):
+        key_hash = self.__encode_and_hash(key)[0]
+
+        if self.bloom_filter and not self.__bloom_filter_may_contain(key_hash):
+            return False
+
+        not_expired, not_expired_params = self.__not_expired()
+
         if self.__connection.execute(
-            "SELECT COUNT(*) FROM kv_index WHERE key_hash = ?",
-            (self.__encode_and_hash(key)[0],),
+            f"SELECT COUNT(*) FROM {self.__table} WHERE key_hash = ?{not_expired}",
+            (key_hash, *not_expired_params),
         ).fetchone()[0]:
             return True
 
@@ -234,14 +575,16 @@ class KVIndex:
 
         with self.__connection as conn:
             if self.eviction.max_size_in_mb:
-                sizes = conn.execute(
-                    f"DELETE FROM kv_index WHERE key_hash IN ({', '.join(['?'] * len(key_hashes))}) RETURNING size_in_bytes",
-                    key_hashes,
-                ).fetchall()
+                sizes = []
+                for placeholders, batch in in_list_batches(key_hashes):
+                    sizes += conn.execute(
+                        f"DELETE FROM {self.__table} WHERE key_hash IN ({placeholders}) RETURNING size_in_bytes",
+                        batch,
+                    ).fetchall()
 
                 if sizes:
                     conn.execute(
-                        "UPDATE kv_index_num_metadata SET num = num - ? WHERE key = ?",
+                        f"UPDATE {self.__metadata_table} SET num = num - ? WHERE key = ?",
                         (
                             sum([size[0] for size in sizes]) / (1024 * 1024),
                             "current_size_in_mb",
@@ -250,77 +593,80 @@ class KVIndex:
                 else:
                     raise KeyError
             else:
-                conn.execute(
-                    f"DELETE FROM kv_index WHERE key_hash IN ({', '.join(['?'] * len(key_hashes))})",
-                    key_hashes,
-                )
+                for placeholders, batch in in_list_batches(key_hashes):
+                    conn.execute(
+                        f"DELETE FROM {self.__table} WHERE key_hash IN ({placeholders})",
+                        batch,
+                    )
+
+        self.__maintain_if_due()
 
     def pop(self, key):
         with self.__connection as conn:
             # assume delete from returning query is suported and write a single query that returns the value, size_in_bytes and deletes the row
             if self.eviction.max_size_in_mb:
                 row = conn.execute(
-                    f"DELETE FROM kv_index WHERE key_hash = ? RETURNING num_value, string_value, pickled_value, size_in_bytes",
-                    (self.__encode_and_hash(key)[0]),
+                    f"DELETE FROM {self.__table} WHERE key_hash = ? RETURNING num_value, string_value, pickled_value, size_in_bytes",
+                    (self.__encode_and_hash(key)[0],),
                 ).fetchone()
 
                 if row is None:
                     raise KeyError
 
                 conn.execute(
-                    "UPDATE kv_index_num_metadata SET num = num - ? WHERE key = ?",
+                    f"UPDATE {self.__metadata_table} SET num = num - ? WHERE key = ?",
                     (
                         row[3] / (1024 * 1024),
                         "current_size_in_mb",
                     ),
                 )
-
-                return self.__decode_value(row[0:3])
             else:
                 row = conn.execute(
-                    f"DELETE FROM kv_index WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
+                    f"DELETE FROM {self.__table} WHERE key_hash = ? RETURNING num_value, string_value, pickled_value",
                     (self.__encode_and_hash(key)[0],),
                 ).fetchone()
 
                 if row is None:
                     raise KeyError
 
-                return self.__decode_value(row[0:3])
+        self.__maintain_if_due()
+
+        return self.__decode_value(row[0:3])
 
     def popitems(self, n=1, reverse=True):
         with self.__connection as conn:
             if self.eviction.max_size_in_mb:
                 rows = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY updated_at, rowid {'DESC' if reverse else 'ASC'} LIMIT {n}) RETURNING pickled_key, key_hash, num_value, string_value, pickled_value, size_in_bytes",
+                    f"DELETE FROM {self.__table} WHERE ROWID IN (SELECT ROWID FROM {self.__table} ORDER BY updated_at, rowid {'DESC' if reverse else 'ASC'} LIMIT ?) RETURNING pickled_key, key_hash, num_value, string_value, pickled_value, size_in_bytes",
+                    (n,),
                 ).fetchall()
 
                 if rows is None:
                     raise KeyError
 
                 conn.execute(
-                    "UPDATE kv_index_num_metadata SET num = num - ? WHERE key = ?",
+                    f"UPDATE {self.__metadata_table} SET num = num - ? WHERE key = ?",
                     (
-                        sum([row[3] for row in rows]) / (1024 * 1024),
+                        sum([row[5] for row in rows]) / (1024 * 1024),
                         "current_size_in_mb",
                     ),
                 )
 
-                return [
-                    (self.__decode_key(row[0], row[1]), self.__decode_value(row[2:5]))
-                    for row in rows
-                ]
             else:
                 rows = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY updated_at, rowid {'DESC' if reverse else 'ASC'} LIMIT {n}) RETURNING pickled_key, key_hash, num_value, string_value, pickled_value",
+                    f"DELETE FROM {self.__table} WHERE ROWID IN (SELECT ROWID FROM {self.__table} ORDER BY updated_at, rowid {'DESC' if reverse else 'ASC'} LIMIT ?) RETURNING pickled_key, key_hash, num_value, string_value, pickled_value",
+                    (n,),
                 ).fetchall()
 
                 if rows is None:
                     raise KeyError
 
-                return [
-                    (self.__decode_key(row[0], row[1]), self.__decode_value(row[2:5]))
-                    for row in rows
-                ]
+        self.__maintain_if_due()
+
+        return [
+            (self.__decode_key(row[0], row[1]), self.__decode_value(row[2:5]))
+            for row in rows
+        ]
 
     def __iter__(self):
         return self.keys()
@@ -331,20 +677,7 @@ class KVIndex:
         except KeyError:
             return default
 
-    def __encode_and_hash(self, x, return_encoded_key=False):
-        x = (
-            pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL)
-            if not isinstance(x, str)
-            else x.encode()
-        )
-        _len = len(x)
-
-        if len(x) <= 32:
-            return sqlite3.Binary(x), None
-        else:
-            return sqlite3.Binary(hashlib.sha256(x).digest()), (
-                None if not return_encoded_key else sqlite3.Binary(x)
-            )
+    __encode_and_hash = staticmethod(encode_and_hash_key)
 
     def __decode_key(self, k, k_h):
         if k is None:
@@ -380,7 +713,8 @@ class KVIndex:
             value_size_in_bytes = len(x) + 2
             string_value = x
 
-        elif _type is bytes:
+        # bytes are stored as they are unless they could be mistaken for a pickle on decode
+        elif _type is bytes and x[:1] not in {b"", b"\x80"}:
             value_size_in_bytes = len(x) + 2
             pickled_value = sqlite3.Binary(x)
 
@@ -399,7 +733,15 @@ class KVIndex:
         elif x[2] is not None:
             return pickle.loads(x[2]) if x[2][0] == 128 else x[2]
 
-    def update(self, items, reverse_order=False):
+    def update(self, items, reverse_order=False, created_at=None):
+        # created_at: seconds since the epoch for each item, in the order of items. defaults to now
+        if created_at is not None:
+            if not self.store_created_at:
+                raise ValueError(
+                    "created_at is not stored, pass store_created_at=True or set eviction.invalidate_after_seconds"
+                )
+            created_at = iter(created_at)
+
         # list of tuples of values to insert for executemany
         params_for_execute_many = []
         key_hashes = []
@@ -434,7 +776,7 @@ class KVIndex:
                 if _key is not None:
                     row_size_in_bytes += len(_key)
 
-            if self.preserve_order:
+            if self.__store_updated_at:
                 # updated_at
                 params_for_execute_many[-1].append(
                     (-1 * _time) if reverse_order else _time
@@ -456,25 +798,39 @@ class KVIndex:
                 params_for_execute_many[-1].append(value_size_in_bytes)
                 row_size_in_bytes += 4
 
+            if self.store_created_at:
+                # created_at
+                params_for_execute_many[-1].append(
+                    _time if created_at is None else int(next(created_at) * 100000)
+                )
+                row_size_in_bytes += 8
+
             # key_hash
             key_hashes.append(key_hash)
 
             total_new_size += row_size_in_bytes
 
-        with self.__connection as conn:
+        conn = self.__connection
+        total_changes = conn.total_changes
+        wal = self.__bloom_filter_wal_counter if self.bloom_filter else None
+        header = wal.header() if wal is not None else None
+
+        with conn:
             self.__run_eviction(conn)
 
             if self.eviction.max_size_in_mb:
-                total_old_size = conn.execute(
-                    f"SELECT SUM(size_in_bytes) FROM kv_index WHERE key_hash IN ({', '.join(['?'] * len(key_hashes))})",
-                    key_hashes,
-                ).fetchone()[0]
-
-                if total_old_size is None:
-                    total_old_size = 0
+                total_old_size = 0
+                for placeholders, batch in in_list_batches(key_hashes):
+                    total_old_size += (
+                        conn.execute(
+                            f"SELECT SUM(size_in_bytes) FROM {self.__table} WHERE key_hash IN ({placeholders})",
+                            batch,
+                        ).fetchone()[0]
+                        or 0
+                    )
 
                 conn.execute(
-                    "UPDATE kv_index_num_metadata SET num = num + ? WHERE key = ?",
+                    f"UPDATE {self.__metadata_table} SET num = num + ? WHERE key = ?",
                     (
                         (total_new_size - total_old_size) / (1024 * 1024),
                         "current_size_in_mb",
@@ -482,10 +838,56 @@ class KVIndex:
                 )
 
             conn.executemany(
-                f"INSERT OR REPLACE INTO kv_index VALUES ({', '.join(['?'] * len(params_for_execute_many[0]))})",
+                f"INSERT OR REPLACE INTO {self.__table} VALUES ({', '.join(['?'] * len(params_for_execute_many[0]))})",
                 params_for_execute_many,
             )
 
+            if self.bloom_filter:
+                self.__bloom_filter_unfolded_keys += len(key_hashes)
+                if self.__bloom_filter_unfolded_keys >= _LOG_FOLD_ROWS:
+                    self.__bloom_filter_unfolded_keys = 0
+                    fold_bloom_filter(conn, self.name)
+
+        if self.bloom_filter:
+            # the log rows are written by a trigger. added only after the commit, a full reload by another
+            # thread before it can't drop these bits. if this commit is the only one since the last sync,
+            # the filter is still in sync after it
+            with self.__bloom_filter_lock:
+                self.__bloom_filter.add(key_hashes)
+
+                if wal is not None:
+                    header_after = wal.header()
+                    if (
+                        header is not None
+                        and header_after is not None
+                        and header == self.__bloom_filter_header
+                        and WalChangeCounter.commits_between(header, header_after)
+                        == 1
+                    ):
+                        self.__bloom_filter_header = header_after
+
+            local_storage = self.__bloom_filter_local_storage
+            if (
+                wal is None
+                and getattr(local_storage, "conn", None) is conn
+                and local_storage.total_changes == total_changes
+            ):
+                local_storage.total_changes = conn.total_changes
+
+            if self.__bloom_filter.needs_rebuild():
+                # a filter still waiting for its reload after a rebuild is not the one to go by
+                if self.__bloom_filter_epoch is None:
+                    self.__bloom_filter_sync()
+
+                if self.__bloom_filter.needs_rebuild():
+                    with conn:
+                        rebuild_bloom_filter(
+                            conn, self.name, if_epoch=self.__bloom_filter_epoch
+                        )
+                    self.__bloom_filter_reload()
+
+        self.__maintain_if_due()
+
     def search(
         self,
         query={},
@@ -515,8 +917,8 @@ class KVIndex:
         sort_by = f"ORDER BY {sort_by} {'DESC' if reversed_sort else ''}"
 
         for row in self.__connection.execute(
-            f"SELECT key_hash, pickled_key, num_value, string_value, pickled_value FROM kv_index WHERE {query_str} {sort_by} LIMIT {n if n else -1} OFFSET {offset if offset else 0}",
-            params,
+            f"SELECT key_hash, pickled_key, num_value, string_value, pickled_value FROM {self.__table} WHERE {query_str} {sort_by} LIMIT ? OFFSET ?",
+            (*params, n if n else -1, offset if offset else 0),
         ):
             if row is None:
                 break
@@ -531,7 +933,7 @@ class KVIndex:
         if op not in ops:
             raise ValueError(f"Unsupported operation: {op}")
 
-        sql_query = f"UPDATE kv_index SET num_value = num_value {ops[op]} ? WHERE key_hash = ? RETURNING num_value"
+        sql_query = f"UPDATE {self.__table} SET num_value = num_value {ops[op]} ? WHERE key_hash = ? RETURNING num_value"
 
         with self.__connection as conn:
             row = conn.execute(
@@ -544,11 +946,14 @@ class KVIndex:
             return row[0]
 
     def __run_eviction(self, conn):
+        if self.__max_age is not None:
+            self.__delete_expired(conn)
+
         if self.eviction.policy == EvictionCfg.EvictNone:
             return
 
         current_number_of_rows = conn.execute(
-            "SELECT COUNT(*) FROM kv_index"
+            f"SELECT COUNT(*) FROM {self.__table}"
         ).fetchone()[0]
 
         number_of_rows_to_evict = 0
@@ -557,7 +962,7 @@ class KVIndex:
         if self.eviction.max_size_in_mb:
             s = time.time()
             current_size_in_mb = conn.execute(
-                "SELECT num FROM kv_index_num_metadata WHERE key = ?",
+                f"SELECT num FROM {self.__metadata_table} WHERE key = ?",
                 ("current_size_in_mb",),
             ).fetchone()[0]
 
@@ -574,47 +979,30 @@ class KVIndex:
 
         if number_of_rows_to_evict == 0:
             return
-        
-        print('----', number_of_rows_to_evict, self.eviction.policy, self.eviction.max_size_in_mb, self.eviction.max_number_of_items)
+
+        if self.eviction.policy == EvictionCfg.EvictLRU:
+            order_by = "ORDER BY last_accessed_time ASC"
+        elif self.eviction.policy == EvictionCfg.EvictLFU:
+            order_by = f"ORDER BY access_frequency{', updated_at' if self.preserve_order else ''} ASC"
+        elif self.eviction.policy == EvictionCfg.EvictAny:
+            order_by = ""
+        elif self.eviction.policy == EvictionCfg.EvictFIFO:
+            order_by = "ORDER BY updated_at ASC"
 
         if not self.eviction.max_size_in_mb:
-            if self.eviction.policy == EvictionCfg.EvictLRU:
-                conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY last_accessed_time ASC LIMIT {number_of_rows_to_evict})"
-                )
-            elif self.eviction.policy == EvictionCfg.EvictLFU:
-                conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY access_frequency{', updated_at' if self.preserve_order else ''} ASC LIMIT {number_of_rows_to_evict})"
-                )
-            elif self.eviction.policy == EvictionCfg.EvictAny:
-                conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index LIMIT {number_of_rows_to_evict})"
-                )
-            elif self.eviction.policy == EvictionCfg.EvictFIFO:
-                conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY updated_at ASC LIMIT {number_of_rows_to_evict})"
-                )
+            conn.execute(
+                f"DELETE FROM {self.__table} WHERE ROWID IN (SELECT ROWID FROM {self.__table} {order_by} LIMIT ?)",
+                (number_of_rows_to_evict,),
+            )
         else:
-            if self.eviction.policy == EvictionCfg.EvictLRU:
-                sizes = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY last_accessed_time ASC LIMIT {number_of_rows_to_evict}) RETURNING size_in_bytes"
-                ).fetchall()
-            elif self.eviction.policy == EvictionCfg.EvictLFU:
-                sizes = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY access_frequency{', updated_at' if self.preserve_order else ''} ASC LIMIT {number_of_rows_to_evict}) RETURNING size_in_bytes"
-                ).fetchall()
-            elif self.eviction.policy == EvictionCfg.EvictAny:
-                sizes = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index LIMIT {number_of_rows_to_evict}) RETURNING size_in_bytes"
-                ).fetchall()
-            elif self.eviction.policy == EvictionCfg.EvictFIFO:
-                sizes = conn.execute(
-                    f"DELETE FROM kv_index WHERE ROWID IN (SELECT ROWID FROM kv_index ORDER BY updated_at ASC LIMIT {number_of_rows_to_evict}) RETURNING size_in_bytes"
-                ).fetchall()
+            sizes = conn.execute(
+                f"DELETE FROM {self.__table} WHERE ROWID IN (SELECT ROWID FROM {self.__table} {order_by} LIMIT ?) RETURNING size_in_bytes",
+                (number_of_rows_to_evict,),
+            ).fetchall()
 
             if sizes:
                 conn.execute(
-                    "UPDATE kv_index_num_metadata SET num = num - ? WHERE key = ?",
+                    f"UPDATE {self.__metadata_table} SET num = num - ? WHERE key = ?",
                     (
                         sum([size[0] for size in sizes]) / (1024 * 1024),
                         "current_size_in_mb",
@@ -622,8 +1010,82 @@ class KVIndex:
                 )
 
     def __del__(self):
-        if self.__connection:
-            self.__connection.close()
+        if self.__bloom_filter_wal is not None:
+            self.__bloom_filter_wal.close()
+
+        if self.__connection_pool is None:
+            return
+
+        if self.__shared_connection_pool_key is not None:
+            with _shared_connection_pools_lock:
+                shared_pool = _shared_connection_pools[
+                    self.__shared_connection_pool_key
+                ]
+                shared_pool[1] -= 1
+                if shared_pool[1]:
+                    return
+                del _shared_connection_pools[self.__shared_connection_pool_key]
+
+        self.__connection_pool.close()
+
+    @property
+    def __change_feed_key_columns(self):
+        return ["key_hash", "pickled_key"] if self.store_key else ["key_hash"]
+
+    def enable_change_feed(self, max_rows=100000):
+        with self.__connection as conn:
+            create_change_feed(
+                conn,
+                table_name=self.name,
+                feed_table_name=self.__changes_table_name,
+                key_columns=self.__change_feed_key_columns,
+                max_rows=max_rows,
+                update_of_columns=["num_value", "string_value", "pickled_value"],
+            )
+
+    def disable_change_feed(self):
+        with self.__connection as conn:
+            drop_change_feed(conn, self.__changes_table_name)
+
+    def change_feed_cursor(self):
+        return latest_cursor(self.__connection, self.__changes_table_name)
+
+    def watch(self, since=None, poll_interval=0.1, timeout=None, batch_size=1000):
+        if not change_feed_exists(self.__connection, self.__changes_table_name):
+            raise ValueError("change feed is not enabled, call enable_change_feed()")
+
+        for row in watch_changes(
+            lambda: self.__connection,
+            self.__changes_table_name,
+            key_columns=self.__change_feed_key_columns,
+            since=since,
+            poll_interval=poll_interval,
+            timeout=timeout,
+            batch_size=batch_size,
+        ):
+            yield row[0], row[1], (
+                self.__decode_key(row[3], row[2]) if self.store_key else row[2]
+            )
+
+    def acquire_lease(self, key, ttl_seconds):
+        # returns a token if the lease was taken, None if another live lease holds the key
+        token = uuid.uuid4().hex
+        now = time.time()
+
+        with self.__connection as conn:
+            row = conn.execute(
+                f"INSERT INTO {self.__leases_table} (key_hash, token, expires_at) VALUES (?, ?, ?) ON CONFLICT(key_hash) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at WHERE expires_at <= ? RETURNING token",
+                (self.__encode_and_hash(key)[0], token, now + ttl_seconds, now),
+            ).fetchone()
+
+        return token if row is not None else None
+
+    def release_lease(self, key, token):
+        with self.__connection as conn:
+            conn.execute(
+                f"DELETE FROM {self.__leases_table} WHERE key_hash = ? AND token = ?",
+                (self.__encode_and_hash(key)[0], token),
+            )
 
     def vaccum(self):
         with self.__connection as conn:
@@ -634,8 +1096,25 @@ class KVIndex:
 
     def clear(self):
         with self.__connection as conn:
-            conn.execute("DELETE FROM kv_index")
-            conn.execute("UPDATE kv_index_num_metadata SET num = 0 WHERE key = ?", ("current_size_in_mb",))
+            conn.execute(f"DELETE FROM {self.__table}")
+            conn.execute(f"UPDATE {self.__metadata_table} SET num = 0 WHERE key = ?", ("current_size_in_mb",))
+
+            if self.bloom_filter:
+                rebuild_bloom_filter(conn, self.name)
+
+        if self.bloom_filter:
+            self.__bloom_filter_reload()
+
+        self.__maintain_if_due()
+
+    def rebuild_bloom_filter(self):
+        if not self.bloom_filter:
+            raise ValueError("bloom filter is not enabled, pass bloom_filter=True")
+
+        with self.__connection as conn:
+            rebuild_bloom_filter(conn, self.name)
+
+        self.__bloom_filter_reload()
 
     def create_trigger(
         self,
@@ -670,7 +1149,7 @@ class KVIndex:
                 if operation == "INSERT":
                     trigger_sql = f"""
                         CREATE TRIGGER {trigger_name}
-                        {timing} {operation} ON kv_index
+                        {timing} {operation} ON {self.__table}
 
                         WHEN NEW.key_hash = X'{self.__encode_and_hash(for_key)[0].hex()}'
 
@@ -682,7 +1161,7 @@ class KVIndex:
                 elif operation == "DELETE":
                     trigger_sql = f"""
                         CREATE TRIGGER {trigger_name}
-                        {timing} {operation} ON kv_index
+                        {timing} {operation} ON {self.__table}
 
                         WHEN OLD.key_hash = X'{self.__encode_and_hash(for_key)[0].hex()}'
 
@@ -698,7 +1177,7 @@ class KVIndex:
                 if operation == "INSERT":
                     trigger_sql = f"""
                         CREATE TRIGGER {trigger_name}
-                        {timing} {operation} ON kv_index
+                        {timing} {operation} ON {self.__table}
 
                         WHEN NEW.key_hash IN ({', '.join([f"X'{self.__encode_and_hash(key)[0].hex()}'" for key in for_keys])})
 
@@ -710,7 +1189,7 @@ class KVIndex:
                 elif operation == "DELETE":
                     trigger_sql = f"""
                         CREATE TRIGGER {trigger_name}
-                        {timing} {operation} ON kv_index
+                        {timing} {operation} ON {self.__table}
 
                         WHEN OLD.key_hash IN ({', '.join([f"X'{self.__encode_and_hash(key)[0].hex()}'" for key in for_keys])})
 
@@ -722,6 +1201,7 @@ class KVIndex:
                 raise ValueError("for_key or for_keys must be provided")
 
             if not conn.execute(
-                f"SELECT name FROM sqlite_master WHERE type='trigger' AND name='{trigger_name}'"
+                "SELECT name FROM sqlite_master WHERE type='trigger' AND name = ?",
+                (trigger_name,),
             ).fetchone():
                 conn.execute(trigger_sql)
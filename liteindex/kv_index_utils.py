@@ -3,6 +3,8 @@ try:
 except ImportError:
     from common_utils import EvictionCfg
 
+import time
+
 __policy_to_number_int_id = {
     EvictionCfg.EvictAny: 1,
     EvictionCfg.EvictFIFO: 2,
@@ -34,15 +36,30 @@ __policy_id_to_original = {v: k for k, v in __policy_to_number_int_id.items()}
 # eviction.max_size_in_mb is set: An additional 'size_in_bytes' INTEGER column is added to track the size of each stored item in bytes.
 #   TABLE kv_index with size tracking: key_hash BLOB, ..., size_in_bytes INTEGER, PRIMARY KEY (key_hash)
 
+# store_created_at=True or eviction.invalidate_after_seconds > 0: Adds a 'created_at' INTEGER column, the time of the item's last write,
+# always the last column. tables created without it get it added, existing rows are given the current time.
+#   TABLE kv_index with 'created_at': key_hash BLOB, ..., created_at INTEGER, PRIMARY KEY (key_hash)
+#   INDEX kv_index_created_at_idx ON kv_index(created_at) if eviction.invalidate_after_seconds > 0, to delete expired items.
+
 # The function also creates a 'kv_index_num_metadata' table to store numeric metadata about the key-value index.
 #   TABLE kv_index_num_metadata: key TEXT PRIMARY KEY, num INTEGER
 # This metadata table includes entries for current size (in MB), flags for store_key and preserve_order, eviction policies and their parameters like max size, max number of items, and invalidation period.
 
+# A 'kv_index_leases' table holds short lived leases on keys, used to let one process compute a missing value while others wait.
+#   TABLE kv_index_leases: key_hash BLOB PRIMARY KEY, token TEXT, expires_at REAL
+
 # An additional index is created for the 'updated_at' column if `preserve_order=True` or `eviction.invalidate_after_seconds > 0` to enable efficient querying by update time.
 #   INDEX kv_index_updated_at_idx ON kv_index(updated_at)
 
 
-def create_tables(store_key, preserve_order, eviction, conn):
+def create_tables(
+    store_key,
+    preserve_order,
+    eviction,
+    conn,
+    table_name="kv_index",
+    store_created_at=False,
+):
     columns_needed_and_sql_types = {
         "key_hash": "BLOB",
         "num_value": "NUMBER",
@@ -63,16 +80,33 @@ def create_tables(store_key, preserve_order, eviction, conn):
     if eviction.max_size_in_mb:
         columns_needed_and_sql_types["size_in_bytes"] = "INTEGER"
 
+    store_created_at = store_created_at or eviction.invalidate_after_seconds > 0
+    if store_created_at:
+        columns_needed_and_sql_types["created_at"] = "INTEGER"
+
+    conn.execute(
+        f"""CREATE TABLE IF NOT EXISTS "{table_name}" ({','.join([f'{col} {sql_type}' for col, sql_type in columns_needed_and_sql_types.items()])}, PRIMARY KEY (key_hash))"""
+    )
+
+    if store_created_at and "created_at" not in [
+        row[1] for row in conn.execute(f"""PRAGMA table_info("{table_name}")""")
+    ]:
+        conn.execute(f"""ALTER TABLE "{table_name}" ADD COLUMN created_at INTEGER""")
+        conn.execute(
+            f"""UPDATE "{table_name}" SET created_at = ?""",
+            (int(time.time() * 100000),),
+        )
+
     conn.execute(
-        f"CREATE TABLE IF NOT EXISTS kv_index ({','.join([f'{col} {sql_type}' for col, sql_type in columns_needed_and_sql_types.items()])}, PRIMARY KEY (key_hash))"
+        f"""CREATE TABLE IF NOT EXISTS "{table_name}_num_metadata" (key TEXT PRIMARY KEY, num INTEGER)"""
     )
 
     conn.execute(
-        "CREATE TABLE IF NOT EXISTS kv_index_num_metadata (key TEXT PRIMARY KEY, num INTEGER)"
+        f"""CREATE TABLE IF NOT EXISTS "{table_name}_leases" (key_hash BLOB PRIMARY KEY, token TEXT, expires_at REAL)"""
     )
 
     conn.executemany(
-        "INSERT OR IGNORE INTO kv_index_num_metadata (key, num) VALUES (?, ?)",
+        f"""INSERT OR IGNORE INTO "{table_name}_num_metadata" (key, num) VALUES (?, ?)""",
         (
             ("current_size_in_mb", 0),
             ("store_key", 1 if store_key else 0),
@@ -86,22 +120,43 @@ def create_tables(store_key, preserve_order, eviction, conn):
 
     if eviction.policy is EvictionCfg.EvictLRU:
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS kv_index_last_accessed_time_idx ON kv_index(last_accessed_time)"
+            f"""CREATE INDEX IF NOT EXISTS "{table_name}_last_accessed_time_idx" ON "{table_name}"(last_accessed_time)"""
         )
 
     if eviction.policy is EvictionCfg.EvictLFU:
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS kv_index_access_frequency_idx ON kv_index(access_frequency)"
+            f"""CREATE INDEX IF NOT EXISTS "{table_name}_access_frequency_idx" ON "{table_name}"(access_frequency)"""
         )
 
     if eviction.invalidate_after_seconds > 0:
         conn.execute(
-            "CREATE INDEX IF NOT EXISTS kv_index_updated_at_idx ON kv_index(updated_at)"
+            f"""CREATE INDEX IF NOT EXISTS "{table_name}_updated_at_idx" ON "{table_name}"(updated_at)"""
+        )
+        conn.execute(
+            f"""CREATE INDEX IF NOT EXISTS "{table_name}_created_at_idx" ON "{table_name}"(created_at)"""
         )
 
 
+import json
 import pickle
 
+# key_hash is a BLOB and cannot be passed through json_each, so IN lists over it are padded with NULLs
+# to one of these sizes. only a handful of distinct statements exist per query shape and sqlite's
+# statement cache keeps hitting, NULL never matches IN so padding does not change results.
+IN_LIST_SIZES = (1, 8, 64, 512)
+
+__placeholders_for_size = {size: ", ".join(["?"] * size) for size in IN_LIST_SIZES}
+
+
+def in_list_batches(values):
+    max_size = IN_LIST_SIZES[-1]
+
+    for i in range(0, len(values), max_size):
+        batch = list(values[i : i + max_size])
+        size = next(_ for _ in IN_LIST_SIZES if _ >= len(batch))
+
+        yield __placeholders_for_size[size], batch + [None] * (size - len(batch))
+
 
 def __get_column_name(value):
     if isinstance(value, (int, float)):
@@ -150,12 +205,18 @@ def create_where_clause(query):
             wheres.append("{} LIKE ?".format(__get_column_name(value)))
             args.append("%" + value)
         elif op in ("$in", "$nin"):
-            wheres.append(
-                "{} {} ({})".format(
-                    __get_column_name(value[0]), op_map[op], ",".join("?" * len(value))
+            column_name = __get_column_name(value[0])
+            if column_name == "pickled_value":
+                wheres.append(
+                    "{} {} ({})".format(column_name, op_map[op], ",".join("?" * len(value)))
                 )
-            )
-            args.extend(value)
+                args.extend(value)
+            else:
+                # whole list is bound as a single json parameter, statement text does not depend on its length
+                wheres.append(
+                    "{} {} (SELECT value FROM json_each(?))".format(column_name, op_map[op])
+                )
+                args.append(json.dumps(list(value)))
         elif op == "$regex":
             wheres.append("{} REGEXP ?".format(__get_column_name(value)))
             args.append(value)
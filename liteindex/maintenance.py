@@ -0,0 +1,82 @@
+import time
+
+# auto_vacuum=FULL moves pages and truncates the file in every commit that frees pages, which makes
+# deletes and eviction slow. with auto_vacuum=INCREMENTAL freed pages go to the freelist and are
+# reused by later inserts, maintain() hands a bounded number of them back to the filesystem and
+# checkpoints the WAL, so the cost is paid at most once per maintenance_interval instead of per commit.
+#
+# auto_vacuum has to be set before journal_mode=WAL, which writes the file header. on a file that
+# already has tables it can only be switched between FULL and INCREMENTAL, a file created without
+# auto_vacuum stays that way until VACUUM.
+
+_CHECKPOINT_MODES = {"PASSIVE", "FULL", "RESTART", "TRUNCATE"}
+
+
+def auto_vacuum_mode(auto_vacuum):
+    # True is kept as FULL for indexes created with the old boolean flag
+    if auto_vacuum is True:
+        return "FULL"
+    if not auto_vacuum:
+        return "NONE"
+
+    mode = str(auto_vacuum).upper()
+    if mode not in {"NONE", "FULL", "INCREMENTAL"}:
+        raise ValueError(
+            f"Invalid auto_vacuum: {auto_vacuum}, can be one of incremental, full, none"
+        )
+
+    return mode
+
+
+def run_maintenance(conn, vacuum_pages=None, checkpoint="passive"):
+    # must not be called inside a transaction, executescript() commits first
+    checkpoint = checkpoint.upper() if checkpoint else None
+    if checkpoint is not None and checkpoint not in _CHECKPOINT_MODES:
+        raise ValueError(
+            f"Invalid checkpoint: {checkpoint}, can be one of passive, full, restart, truncate or None"
+        )
+
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    vacuumed_pages = 0
+
+    if freelist_count and conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        vacuumed_pages = (
+            freelist_count if vacuum_pages is None else min(freelist_count, vacuum_pages)
+        )
+        # execute() steps a statement without result columns only once, which frees a single page
+        conn.executescript(f"PRAGMA incremental_vacuum({vacuumed_pages});")
+
+    stats = {
+        "freelist_count": freelist_count,
+        "vacuumed_pages": vacuumed_pages,
+        "checkpoint_busy": None,
+        "wal_pages": None,
+        "checkpointed_pages": None,
+    }
+
+    if checkpoint is not None:
+        (
+            stats["checkpoint_busy"],
+            stats["wal_pages"],
+            stats["checkpointed_pages"],
+        ) = conn.execute(f"PRAGMA wal_checkpoint({checkpoint})").fetchone()
+
+    return stats
+
+
+class MaintenanceSchedule:
+    # maintenance runs on the writing thread right after a write committed, at most once per interval
+    def __init__(self, interval):
+        self.interval = interval
+        self.last_run_at = time.time()
+
+    def due(self):
+        if self.interval is None:
+            return False
+
+        now = time.time()
+        if now - self.last_run_at < self.interval:
+            return False
+
+        self.last_run_at = now
+        return True
@@ -11,11 +11,26 @@ import pickle
 
 try:
     from .defined_serializers import hash_bytes
+    from .text_index import text_index_table_name, pop_text_condition
+    from .json_index import json_path_column, json_value_index_table_name
 except ImportError:
     from defined_serializers import hash_bytes
+    from text_index import text_index_table_name, pop_text_condition
+    from json_index import json_path_column, json_value_index_table_name
 
 
-def parse_query(query, schema, prefix=None):
+def json_list_param(values):
+    # the whole list is bound as a single json parameter and read back with json_each(?),
+    # so the statement text does not depend on the list's length and sqlite's statement cache keeps hitting
+    try:
+        return json.dumps(list(values), allow_nan=False)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_query(query, schema, prefix=None, table_name=None, json_value_indexes=()):
+    # table_name is needed by $text, it matches through the key's text index table.
+    # json_value_indexes: "key.a.b" json paths with a value index, membership on them is looked up in it
     where_conditions = []
     params = []
 
@@ -32,10 +47,24 @@ def parse_query(query, schema, prefix=None):
         is_json_field = schema.get(prefix[0]) == "json" if prefix else False
 
         # Build column reference
-        if is_json_field and len(prefix) > 1:
-            column = f"json_extract({prefix[0]}, '$.{'.'.join(prefix[1:])}')"
+        if is_json_field:
+            column = json_path_column(prefix[0], prefix[1:])
         else:
-            column = f'"{prefix[0]}"' if not is_json_field else prefix[0]
+            column = f'"{prefix[0]}"'
+
+        value_table_name = (
+            json_value_index_table_name(table_name, ".".join(prefix))
+            if is_json_field
+            and table_name is not None
+            and ".".join(prefix) in json_value_indexes
+            else None
+        )
+
+        def has_json_value(condition):
+            # some value json_each() yields for column meets condition
+            if value_table_name is None:
+                return f"EXISTS(SELECT 1 FROM json_each({column}) WHERE {condition})"
+            return f'integer_id IN (SELECT integer_id FROM "{value_table_name}" WHERE {condition})'
 
         column_type = schema.get(prefix[0])
 
@@ -64,7 +93,7 @@ def parse_query(query, schema, prefix=None):
 
                     if is_json_field and sub_key == "$like":
                         sub_conditions.append(
-                            f"EXISTS(SELECT 1 FROM json_each({column}) WHERE value {operator} ?)"
+                            has_json_value(f"value {operator} ?")
                         )
                     else:
                         if sub_key == "$ne":
@@ -92,15 +121,38 @@ def parse_query(query, schema, prefix=None):
 
                     params.append(processed_value)
 
+                elif sub_key == "$text":
+                    if table_name is None:
+                        raise ValueError("$text needs the table name")
+
+                    # integer_id is the rowid, sqlite looks the matches up instead of scanning the table
+                    text_table_name = text_index_table_name(table_name, prefix[0])
+                    sub_conditions.append(
+                        f'integer_id IN (SELECT rowid FROM "{text_table_name}" WHERE "{text_table_name}" MATCH ?)'
+                    )
+                    params.append(sub_value)
+
                 elif sub_key == "$in":
-                    if is_json_field:
+                    json_param = json_list_param(sub_value)
+
+                    if is_json_field and json_param is not None:
+                        sub_conditions.append(
+                            f"({has_json_value('value IN (SELECT value FROM json_each(?))')})"
+                        )
+                        params.append(json_param)
+                    elif is_json_field:
                         json_conditions = []
                         for val in sub_value:
                             json_conditions.append(
-                                f"EXISTS(SELECT 1 FROM json_each({column}) WHERE value = ?)"
+                                has_json_value("value = ?")
                             )
                             params.append(val)
                         sub_conditions.append(f"({ ' OR '.join(json_conditions) })")
+                    elif json_param is not None:
+                        sub_conditions.append(
+                            f"({column} IN (SELECT value FROM json_each(?)) OR {column} IS NULL)"
+                        )
+                        params.append(json_param)
                     else:
                         placeholders = ", ".join(["?" for _ in sub_value])
                         sub_conditions.append(
@@ -114,11 +166,21 @@ def parse_query(query, schema, prefix=None):
                         non_null_values = [v for v in sub_value if v is not None]
                         has_null = None in sub_value
 
-                        for val in non_null_values:
+                        json_param = (
+                            json_list_param(non_null_values) if non_null_values else None
+                        )
+
+                        if json_param is not None:
                             json_conditions.append(
-                                f"NOT EXISTS(SELECT 1 FROM json_each({column}) WHERE value = ?)"
+                                f"NOT {has_json_value('value IN (SELECT value FROM json_each(?))')}"
                             )
-                            params.append(val)
+                            params.append(json_param)
+                        else:
+                            for val in non_null_values:
+                                json_conditions.append(
+                                    f"NOT {has_json_value('value = ?')}"
+                                )
+                                params.append(val)
 
                         _conditions = (
                             [f"({ ' AND '.join(json_conditions) })"]
@@ -137,9 +199,16 @@ def parse_query(query, schema, prefix=None):
 
                         _conditions = []
                         if non_null_values:
-                            placeholders = ", ".join(["?" for _ in non_null_values])
-                            _conditions.append(f"{column} NOT IN ({placeholders})")
-                            params.extend(non_null_values)
+                            json_param = json_list_param(non_null_values)
+                            if json_param is not None:
+                                _conditions.append(
+                                    f"{column} NOT IN (SELECT value FROM json_each(?))"
+                                )
+                                params.append(json_param)
+                            else:
+                                placeholders = ", ".join(["?" for _ in non_null_values])
+                                _conditions.append(f"{column} NOT IN ({placeholders})")
+                                params.extend(non_null_values)
 
                         if has_null:
                             _conditions.append(f"{column} IS NOT NULL")
@@ -169,14 +238,30 @@ def parse_query(query, schema, prefix=None):
                 conditions.extend(sub_conditions)
 
         elif isinstance(value, list):
-            if is_json_field:
+            json_param = (
+                json_list_param([json.dumps(val) for val in value])
+                if is_json_field
+                else json_list_param(value)
+            )
+
+            if is_json_field and json_param is not None:
+                conditions.append(
+                    f"({has_json_value('value IN (SELECT value FROM json_each(?))')})"
+                )
+                params.append(json_param)
+            elif is_json_field:
                 json_conditions = []
                 for val in value:
                     json_conditions.append(
-                        f"EXISTS(SELECT 1 FROM json_each({column}) WHERE value = ?)"
+                        has_json_value("value = ?")
                     )
                     params.append(json.dumps(val))
                 conditions.append(f"({ ' OR '.join(json_conditions) })")
+            elif json_param is not None:
+                conditions.append(
+                    f"({column} IN (SELECT value FROM json_each(?)) OR {column} IS NULL)"
+                )
+                params.append(json_param)
             else:
                 placeholders = ", ".join(["?" for _ in value])
                 conditions.append(f"({column} IN ({placeholders}) OR {column} IS NULL)")
@@ -243,9 +328,19 @@ def parse_query(query, schema, prefix=None):
     return where_conditions, params
 
 
-def pop_query(table_name, query, schema, sort_by=None, reversed_sort=False, n=None):
+def pop_query(
+    table_name,
+    query,
+    schema,
+    sort_by=None,
+    reversed_sort=False,
+    n=None,
+    json_value_indexes=(),
+):
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     query_str = f"DELETE FROM {table_name}"
@@ -258,7 +353,8 @@ def pop_query(table_name, query, schema, sort_by=None, reversed_sort=False, n=No
         query_str += f" ORDER BY {sort_by} {'DESC' if reversed_sort else 'ASC'}"
 
     if n is not None:
-        query_str += f" LIMIT {n}"
+        query_str += " LIMIT ?"
+        params.append(n)
 
     query_str += ")"
 
@@ -279,11 +375,32 @@ def search_query(
     sort_by_embedding=None,
     sort_by_embedding_metric="cosine",
     is_update=False,
+    max_distance=None,
+    json_value_indexes=(),
 ):
     if select_columns is None:
         select_columns = tuple(schema)
 
-    where_conditions, params = parse_query(query, schema)
+    # sort_by="$text" ranks the rows matching the query's $text condition by bm25, lower is more relevant.
+    # the condition becomes a join with the text index instead of a WHERE, so it is matched only once
+    text_join = None
+    if sort_by == "$text":
+        text_key, text_query, query = pop_text_condition(query)
+        text_table_name = text_index_table_name(table_name, text_key)
+        text_join = f'JOIN (SELECT rowid AS __text_rowid, bm25("{text_table_name}") AS __text_score FROM "{text_table_name}" WHERE "{text_table_name}" MATCH ?) ON integer_id = __text_rowid'
+
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
+
+    if text_join is not None:
+        # the join comes before the WHERE conditions
+        params.insert(0, text_query)
+
+    # sqlite resolves the __distance alias in WHERE, rows beyond max_distance are never returned
+    if sort_by_embedding is not None and max_distance is not None:
+        where_conditions.append("__distance <= ?")
+        params.append(max_distance)
 
     # Add distance calculation if sort_by_embedding is provided
     if sort_by_embedding is not None:
@@ -298,6 +415,13 @@ def search_query(
         ) + select_columns
 
         params.insert(0, sort_by_embedding.tobytes())
+    elif text_join is not None and not is_update:
+        select_columns = (
+            "integer_id",
+            "id",
+            "updated_at",
+            ("__text_score",),
+        ) + select_columns
     else:
         if is_update:
             select_columns = tuple(select_columns)
@@ -312,11 +436,16 @@ def search_query(
 
     query_str = f"SELECT {selected_columns} FROM {table_name}"
 
+    if text_join is not None:
+        query_str += f" {text_join}"
+
     if where_conditions:
         query_str += f" WHERE {' AND '.join(where_conditions)}"
 
     if sort_by_embedding is not None:
         query_str += f""" ORDER BY __distance {'DESC' if reversed_sort else 'ASC'}"""
+    elif text_join is not None:
+        query_str += f""" ORDER BY __text_score {'DESC' if reversed_sort else 'ASC'}"""
     elif sort_by:
         if isinstance(sort_by, list):
             query_str += " ORDER BY "
@@ -336,14 +465,17 @@ def search_query(
                 f""" ORDER BY "{sort_by}" {'DESC' if reversed_sort else 'ASC'}"""
             )
 
-    query_str += f" LIMIT {n if n is not None else -1} OFFSET {offset if offset is not None else 0}"
+    query_str += " LIMIT ? OFFSET ?"
+    params += [n if n is not None else -1, offset if offset is not None else 0]
 
     return query_str, params
 
 
-def distinct_query(table_name, column, query, schema):
+def distinct_query(table_name, column, query, schema, json_value_indexes=()):
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     if schema[column] == "json":
@@ -363,8 +495,18 @@ def distinct_query(table_name, column, query, schema):
     return query_str, params
 
 
-def distinct_count_query(table_name, column, query, schema, min_count=0, top_n=None):
-    where_conditions, params = parse_query(query, schema)
+def distinct_count_query(
+    table_name,
+    column,
+    query,
+    schema,
+    min_count=0,
+    top_n=None,
+    json_value_indexes=(),
+):
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     if schema[column] == "json":
         query_str = f"""
@@ -381,17 +523,21 @@ def distinct_count_query(table_name, column, query, schema, min_count=0, top_n=N
         query_str += f" WHERE {' AND '.join(where_conditions)}"
 
     query_str += " GROUP BY value"
-    query_str += f" HAVING COUNT(*) >= {min_count}"
+    query_str += " HAVING COUNT(*) >= ?"
+    params.append(min_count)
 
     if top_n is not None:
-        query_str += f" ORDER BY COUNT(*) DESC LIMIT {top_n}"
+        query_str += " ORDER BY COUNT(*) DESC LIMIT ?"
+        params.append(top_n)
 
     return query_str, params
 
 
-def group_by_query(table_name, columns, query, schema):
+def group_by_query(table_name, columns, query, schema, json_value_indexes=()):
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     separator = chr(31)  # unit separator
@@ -413,9 +559,29 @@ def group_by_query(table_name, columns, query, schema):
     return query_str, params
 
 
-def count_query(table_name, query, schema):
+def count_query(
+    table_name,
+    query,
+    schema,
+    embedding_key=None,
+    embedding=None,
+    embedding_metric="cosine",
+    max_distance=None,
+    json_value_indexes=(),
+):
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
+
+    # rows with an embedding, within max_distance of the given one if set
+    if embedding is not None:
+        where_conditions.append(f'"{embedding_key}" IS NOT NULL')
+        if max_distance is not None:
+            where_conditions.append(
+                f"""vector_distance(?, "{embedding_key}", '{embedding_metric}') <= ?"""
+            )
+            params += [embedding.tobytes(), max_distance]
 
     # Build the query string
     query_str = f"SELECT COUNT(*) FROM {table_name}"
@@ -425,7 +591,7 @@ def count_query(table_name, query, schema):
     return query_str, params
 
 
-def delete_query(table_name, query, schema):
+def delete_query(table_name, query, schema, json_value_indexes=()):
     # Check if the query is empty
     if not query:
         # Optimize by clearing the table using DELETE without WHERE
@@ -433,7 +599,9 @@ def delete_query(table_name, query, schema):
         params = []
     else:
         # Prepare the query
-        where_conditions, params = parse_query(query, schema)
+        where_conditions, params = parse_query(
+            query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+        )
 
         # Build the query string
         query_str = f"DELETE FROM {table_name}"
@@ -443,14 +611,16 @@ def delete_query(table_name, query, schema):
     return query_str, params
 
 
-def sum_query(table_name, column, query, schema):
+def sum_query(table_name, column, query, schema, json_value_indexes=()):
     if column not in schema:
         raise ValueError(f"Invalid column '{column}' specified for sum")
     if schema[column] != "number":
         raise ValueError("Sum operation can only be applied on numeric columns")
 
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     query_str = f'SELECT SUM("{column}") FROM {table_name}'
@@ -460,14 +630,16 @@ def sum_query(table_name, column, query, schema):
     return query_str, params
 
 
-def avg_query(table_name, column, query, schema):
+def avg_query(table_name, column, query, schema, json_value_indexes=()):
     if column not in schema:
         raise ValueError(f"Invalid column '{column}' specified for average")
     if schema[column] != "number":
         raise ValueError("Average operation can only be applied on numeric columns")
 
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     query_str = f'SELECT AVG("{column}") FROM {table_name}'
@@ -477,12 +649,14 @@ def avg_query(table_name, column, query, schema):
     return query_str, params
 
 
-def min_query(table_name, column, query, schema):
+def min_query(table_name, column, query, schema, json_value_indexes=()):
     if column not in schema:
         raise ValueError(f"Invalid column '{column}' specified for minimum")
 
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     query_str = f'SELECT MIN("{column}") FROM {table_name}'
@@ -492,12 +666,14 @@ def min_query(table_name, column, query, schema):
     return query_str, params
 
 
-def max_query(table_name, column, query, schema):
+def max_query(table_name, column, query, schema, json_value_indexes=()):
     if column not in schema:
         raise ValueError(f"Invalid column '{column}' specified for maximum")
 
     # Prepare the query
-    where_conditions, params = parse_query(query, schema)
+    where_conditions, params = parse_query(
+        query, schema, table_name=table_name, json_value_indexes=json_value_indexes
+    )
 
     # Build the query string
     query_str = f'SELECT MAX("{column}") FROM {table_name}'
@@ -650,15 +826,20 @@ if __name__ == "__main__":
             # Test IN operator with array of values
             query = {"age": {"$in": [25, 30, 35]}}
             conditions, params = parse_query(query, self.schema)
-            self.assertEqual(conditions, ['("age" IN (?, ?, ?) OR "age" IS NULL)'])
-            self.assertEqual(params, [25, 30, 35])
+            self.assertEqual(
+                conditions,
+                ['("age" IN (SELECT value FROM json_each(?)) OR "age" IS NULL)'],
+            )
+            self.assertEqual(params, ["[25, 30, 35]"])
 
         def test_not_in_operator(self):
             # Test NOT IN operator with array of values
             query = {"age": {"$nin": [25, 30, 35]}}
             conditions, params = parse_query(query, self.schema)
-            self.assertEqual(conditions, ['("age" NOT IN (?, ?, ?))'])
-            self.assertEqual(params, [25, 30, 35])
+            self.assertEqual(
+                conditions, ['("age" NOT IN (SELECT value FROM json_each(?)))']
+            )
+            self.assertEqual(params, ["[25, 30, 35]"])
 
         def test_not_in_with_null(self):
             # Test NOT IN operator including NULL value
@@ -666,9 +847,12 @@ if __name__ == "__main__":
             conditions, params = parse_query(query, self.schema)
             print(conditions, "<<>>", params)
             self.assertEqual(
-                conditions, ['("age" NOT IN (?, ?) AND "age" IS NOT NULL)']
+                conditions,
+                [
+                    '("age" NOT IN (SELECT value FROM json_each(?)) AND "age" IS NOT NULL)'
+                ],
             )
-            self.assertEqual(params, [25, 35])
+            self.assertEqual(params, ["[25, 35]"])
 
         def test_like_operator(self):
             # Test LIKE operator for pattern matching
@@ -677,15 +861,47 @@ if __name__ == "__main__":
             self.assertEqual(conditions, ['"name" LIKE ?'])
             self.assertEqual(params, ["John%"])
 
+        def test_text_operator(self):
+            # Test $text matching through the key's FTS5 index
+            query = {"name": {"$text": "john OR jane"}}
+            conditions, params = parse_query(query, self.schema, table_name="users")
+            self.assertEqual(
+                conditions,
+                [
+                    'integer_id IN (SELECT rowid FROM "__users_fts_name" WHERE "__users_fts_name" MATCH ?)'
+                ],
+            )
+            self.assertEqual(params, ["john OR jane"])
+
+        def test_json_value_index(self):
+            # Test membership on a json path with a value index
+            query = {"tag_id_to_name": {"a": {"$in": ["x", "y"]}}, "tags_list": {"$like": "t%"}}
+            conditions, params = parse_query(
+                query,
+                self.schema,
+                table_name="users",
+                json_value_indexes={"tag_id_to_name.a"},
+            )
+            self.assertEqual(
+                conditions,
+                [
+                    '(integer_id IN (SELECT integer_id FROM "__users_json_tag_id_to_name.a" WHERE value IN (SELECT value FROM json_each(?))))',
+                    "EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value LIKE ?)",
+                ],
+            )
+            self.assertEqual(params, ['["x", "y"]', "t%"])
+
         def test_json_array_contains(self):
             # Test JSON array contains condition
             query = {"tags_list": ["tag1"]}
             conditions, params = parse_query(query, self.schema)
             self.assertEqual(
                 conditions,
-                ["(EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?))"],
+                [
+                    "(EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value IN (SELECT value FROM json_each(?))))"
+                ],
             )
-            self.assertEqual(params, [json.dumps("tag1")])
+            self.assertEqual(params, [json.dumps([json.dumps("tag1")])])
 
         def test_json_field_equality(self):
             # Test JSON field exact match
@@ -725,10 +941,10 @@ if __name__ == "__main__":
             self.assertEqual(
                 conditions,
                 [
-                    "(EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?) OR EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?))"
+                    "(EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value IN (SELECT value FROM json_each(?))))"
                 ],
             )
-            self.assertEqual(params, ["tag1", "tag2"])
+            self.assertEqual(params, ['["tag1", "tag2"]'])
 
         def test_json_not_in_operator(self):
             # Test NOT IN operator on JSON array elements
@@ -737,10 +953,10 @@ if __name__ == "__main__":
             self.assertEqual(
                 conditions,
                 [
-                    "((NOT EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?) AND NOT EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?)))"
+                    "((NOT EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value IN (SELECT value FROM json_each(?)))))"
                 ],
             )
-            self.assertEqual(params, ["tag1", "tag2"])
+            self.assertEqual(params, ['["tag1", "tag2"]'])
 
         def test_multiple_conditions(self):
             # Test multiple conditions combined with implicit AND
@@ -774,11 +990,11 @@ if __name__ == "__main__":
             conditions, params = parse_query(query, self.schema)
 
             expected_conditions = [
-                '((("name" LIKE ?) AND ("age" > ?)) OR (((EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?) OR EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value = ?))) AND ("is_true" = ?)))'
+                '((("name" LIKE ?) AND ("age" > ?)) OR (((EXISTS(SELECT 1 FROM json_each(tags_list) WHERE value IN (SELECT value FROM json_each(?))))) AND ("is_true" = ?)))'
             ]
 
             self.assertEqual(conditions, expected_conditions)
-            self.assertEqual(params, ["John%", 25, "important", "urgent", 1])
+            self.assertEqual(params, ["John%", 25, '["important", "urgent"]', 1])
 
     if __name__ == "__main__":
         unittest.main()
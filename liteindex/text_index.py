@@ -0,0 +1,163 @@
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# FTS5 full-text index on a string or compressed_string column of a DefinedIndex.
+#
+#   VIRTUAL TABLE __<table>_fts_<key> USING fts5(<key>, content=<table>, content_rowid=integer_id)
+#
+# external content: the index only holds tokens, the text itself stays in the indexed table. plain SQL
+# triggers on the indexed table add, remove and replace a row's tokens on every insert, delete and update
+# of the column, so writes from every process and connection keep the index correct.
+#
+# compressed_string columns hold zstd frames (or utf-8 bytes without compression), the triggers pass them
+# through liteindex_text(), an SQL function every liteindex connection registers. writes to a text indexed
+# compressed_string column have to go through liteindex.
+#
+# {key: {"$text": "fts5 query"}} matches rows through the index, sort_by="$text" ranks them by bm25.
+
+TEXT_INDEX_TYPES = {"string", "compressed_string"}
+
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+_local_storage = threading.local()
+
+
+def text_index_table_name(table_name, key):
+    return f"__{table_name}_fts_{key}"
+
+
+def text_value(value):
+    # liteindex_text(): the text of a string or compressed_string value
+    if not isinstance(value, bytes):
+        return value
+
+    if value.startswith(_ZSTD_MAGIC) and zstandard is not None:
+        if getattr(_local_storage, "decompressor", None) is None:
+            _local_storage.decompressor = zstandard.ZstdDecompressor()
+        value = _local_storage.decompressor.decompress(value)
+
+    return value.decode()
+
+
+def _column_value(key, column_type, row):
+    if column_type == "compressed_string":
+        return f'liteindex_text({row}."{key}")'
+    return f'{row}."{key}"'
+
+
+def create_text_index_triggers(conn, table_name, key, column_type):
+    # triggers live on the indexed table and are dropped along with it
+    text_table_name = text_index_table_name(table_name, key)
+
+    insert = f'INSERT INTO "{text_table_name}" (rowid, "{key}") VALUES (NEW.integer_id, {_column_value(key, column_type, "NEW")});'
+    # external content tables remove tokens with the 'delete' command and the exact text that was indexed
+    delete = f'INSERT INTO "{text_table_name}" ("{text_table_name}", rowid, "{key}") VALUES (\'delete\', OLD.integer_id, {_column_value(key, column_type, "OLD")});'
+
+    for event, body in (
+        ("insert", insert),
+        ("update", delete + "\n" + insert),
+        ("delete", delete),
+    ):
+        conn.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS "{text_table_name}_{event}"
+            AFTER {event.upper()}{f' OF "{key}"' if event == "update" else ''} ON "{table_name}"
+            BEGIN
+                {body}
+            END;
+            """
+        )
+
+
+def create_text_index(conn, table_name, key, column_type, tokenize="unicode61"):
+    text_table_name = text_index_table_name(table_name, key)
+    tokenize = tokenize.replace("'", "''")
+
+    conn.execute(
+        f"""CREATE VIRTUAL TABLE IF NOT EXISTS "{text_table_name}" USING fts5("{key}", content='{table_name}', content_rowid='integer_id', tokenize='{tokenize}')"""
+    )
+
+    # indexes the rows already stored, 'rebuild' would read compressed values without decompressing them
+    conn.execute(f"""INSERT INTO "{text_table_name}" ("{text_table_name}") VALUES ('delete-all')""")
+    conn.execute(
+        f"""INSERT INTO "{text_table_name}" (rowid, "{key}") SELECT integer_id, {_column_value(key, column_type, f'"{table_name}"')} FROM "{table_name}" WHERE "{key}" IS NOT NULL"""
+    )
+
+    create_text_index_triggers(conn, table_name, key, column_type)
+
+
+def drop_text_index(conn, table_name, key):
+    text_table_name = text_index_table_name(table_name, key)
+
+    for event in ("insert", "update", "delete"):
+        conn.execute(f'DROP TRIGGER IF EXISTS "{text_table_name}_{event}"')
+
+    conn.execute(f'DROP TABLE IF EXISTS "{text_table_name}"')
+
+
+def clear_text_index(conn, table_name, key, column_type):
+    # after the indexed table was dropped and re-created
+    text_table_name = text_index_table_name(table_name, key)
+    conn.execute(f"""INSERT INTO "{text_table_name}" ("{text_table_name}") VALUES ('delete-all')""")
+    create_text_index_triggers(conn, table_name, key, column_type)
+
+
+def text_index_keys(conn, table_name, schema):
+    # keys of schema with a text index
+    names = {
+        text_index_table_name(table_name, key): key
+        for key, column_type in schema.items()
+        if column_type in TEXT_INDEX_TYPES
+    }
+    if not names:
+        return []
+
+    return [
+        names[row[0]]
+        for row in conn.execute(
+            f"SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({', '.join('?' for _ in names)})",
+            list(names),
+        ).fetchall()
+    ]
+
+
+def pop_text_condition(query):
+    # (key, fts5 query, query without it) of the top level $text condition sort_by="$text" and fusion rank by
+    keys = [
+        key
+        for key, value in query.items()
+        if isinstance(value, dict) and "$text" in value
+    ]
+    if len(keys) != 1:
+        raise ValueError(
+            'sort_by="$text" and fusion need exactly one top level {key: {"$text": ...}} condition in query'
+        )
+
+    key = keys[0]
+    rest = {k: v for k, v in query[key].items() if k != "$text"}
+
+    remaining = {k: v for k, v in query.items() if k != key}
+    if rest:
+        remaining[key] = rest
+
+    return key, query[key]["$text"], remaining
+
+
+def text_candidates(conn, table_name, key, text_query, where_conditions, params, k=None):
+    # (integer_ids, bm25 scores) of the k rows matching the fts5 query and the filter, most relevant first
+    text_table_name = text_index_table_name(table_name, key)
+
+    query_str = f"""SELECT integer_id, __text_score FROM "{table_name}" JOIN (SELECT rowid AS __text_rowid, bm25("{text_table_name}") AS __text_score FROM "{text_table_name}" WHERE "{text_table_name}" MATCH ?) ON integer_id = __text_rowid"""
+    if where_conditions:
+        query_str += f" WHERE {' AND '.join(where_conditions)}"
+    query_str += " ORDER BY __text_score LIMIT ?"
+
+    rows = conn.execute(
+        query_str, [text_query] + list(params) + [-1 if k is None else k]
+    ).fetchall()
+
+    return [_[0] for _ in rows], [_[1] for _ in rows]
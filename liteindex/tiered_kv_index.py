@@ -0,0 +1,353 @@
+import time
+import threading
+from collections import OrderedDict
+
+from .kv_index import KVIndex, encode_and_hash_key
+from .common_utils import EvictionCfg
+
+# hot tier: a plain OrderedDict in LRU order, guarded by a lock, never touches sqlite. it is keyed by the
+# cold tier's key_hash and holds (key, value, created_at), so 1, 1.0 and True stay different keys like in KVIndex.
+# created_at is the time of the write, or the cold tier's created_at for promoted items if it stores it, and
+# is written to the cold tier with demoted items. items older than eviction.invalidate_after_seconds are misses
+# cold tier: a regular KVIndex file, gives capacity and sharing across processes
+#
+# reads are served from the hot tier, misses are read from the cold tier and promoted.
+# write_back=False (write-through): writes go to the cold tier first and then to the hot tier.
+# write_back=True: writes only go to the hot tier and are marked dirty, dirty items are demoted
+#   to the cold tier when evicted from the hot tier or on flush().
+#
+# other processes only see the cold tier, so the hot tier can serve stale values for keys written elsewhere.
+# with invalidate_every_seconds set, the cold tier's change feed is drained at most that often and
+# changed keys are dropped from the hot tier.
+
+_MISSING = object()
+
+
+def _key_hash(key):
+    return bytes(encode_and_hash_key(key)[0])
+
+
+class TieredKVIndex:
+    def __init__(
+        self,
+        db_path=None,
+        hot_max_items=1024,
+        write_back=False,
+        invalidate_every_seconds=None,
+        store_key=True,
+        preserve_order=True,
+        ram_cache_mb=32,
+        eviction=EvictionCfg(EvictionCfg.EvictNone),
+        name="kv_index",
+        shared_connections=False,
+        store_created_at=False,
+    ):
+        if hot_max_items < 1:
+            raise ValueError("hot_max_items must be at least 1")
+
+        if invalidate_every_seconds is not None and not store_key:
+            raise ValueError("invalidate_every_seconds requires store_key=True")
+
+        self.hot_max_items = hot_max_items
+        self.write_back = write_back
+        self.invalidate_every_seconds = invalidate_every_seconds
+        self.__max_age = eviction.invalidate_after_seconds or None
+
+        self.cold = KVIndex(
+            db_path,
+            store_key=store_key,
+            preserve_order=preserve_order,
+            ram_cache_mb=ram_cache_mb,
+            eviction=eviction,
+            name=name,
+            shared_connections=shared_connections,
+            store_created_at=store_created_at,
+        )
+
+        self.__hot = OrderedDict()
+        self.__dirty = set()
+        self.__lock = threading.RLock()
+
+        self.__stats = {"hot_hits": 0, "cold_hits": 0, "misses": 0, "demoted": 0}
+
+        if self.invalidate_every_seconds is not None:
+            self.cold.enable_change_feed()
+            self.__cursor = self.cold.change_feed_cursor()
+            self.__last_invalidated_at = time.time()
+
+    def __invalidate_from_change_feed(self):
+        if (
+            self.invalidate_every_seconds is None
+            or time.time() - self.__last_invalidated_at < self.invalidate_every_seconds
+        ):
+            return
+
+        with self.__lock:
+            self.__last_invalidated_at = time.time()
+
+            try:
+                for cursor, op, key in self.cold.watch(since=self.__cursor, timeout=0):
+                    self.__cursor = cursor
+                    key_hash = _key_hash(key)
+                    if key_hash not in self.__dirty:
+                        self.__hot.pop(key_hash, None)
+            except ValueError:
+                # fell behind the retained feed, nothing in the hot tier can be trusted
+                for key_hash in list(self.__hot):
+                    if key_hash not in self.__dirty:
+                        del self.__hot[key_hash]
+                self.__cursor = self.cold.change_feed_cursor()
+
+    def __get_hot(self, key_hash, now):
+        # caller holds the lock, expired items are dropped, cold copies of them are expired too
+        item = self.__hot.get(key_hash)
+        if item is None:
+            return None
+
+        if self.__max_age is not None and now - item[2] >= self.__max_age:
+            del self.__hot[key_hash]
+            self.__dirty.discard(key_hash)
+            return None
+
+        self.__hot.move_to_end(key_hash)
+        return item
+
+    def __put_hot(self, key_hash, key, value, dirty, created_at):
+        # caller holds the lock
+        self.__hot[key_hash] = (key, value, created_at)
+        self.__hot.move_to_end(key_hash)
+
+        if dirty:
+            self.__dirty.add(key_hash)
+        else:
+            self.__dirty.discard(key_hash)
+
+        demoted = []
+        while len(self.__hot) > self.hot_max_items:
+            old_key_hash, old_item = self.__hot.popitem(last=False)
+            if old_key_hash in self.__dirty:
+                self.__dirty.discard(old_key_hash)
+                demoted.append(old_item)
+
+        if demoted:
+            # written while holding the lock so that readers can't miss the hot tier and read a stale cold value
+            self.__write_cold(demoted)
+            self.__stats["demoted"] += len(demoted)
+
+    def __write_cold(self, hot_items):
+        self.cold.update(
+            [(key, value) for key, value, _ in hot_items],
+            created_at=[created_at for _, _, created_at in hot_items]
+            if self.cold.store_created_at
+            else None,
+        )
+
+    def __get_cold(self, keys):
+        # [(value, created_at)], value is _MISSING for missing keys
+        if self.cold.store_created_at:
+            return self.cold.getvalues(keys, default=_MISSING, return_created_at=True)
+
+        now = time.time()
+        return [
+            (value, now) for value in self.cold.getvalues(keys, default=_MISSING)
+        ]
+
+    def __getitem__(self, key):
+        self.__invalidate_from_change_feed()
+
+        key_hash = _key_hash(key)
+
+        with self.__lock:
+            item = self.__get_hot(key_hash, time.time())
+            if item is not None:
+                self.__stats["hot_hits"] += 1
+                return item[1]
+
+        if self.cold.store_created_at:
+            value, created_at = self.__get_cold([key])[0]
+        else:
+            # KVIndex answers single key misses from its bloom filter
+            value, created_at = self.cold.get(key, _MISSING), time.time()
+
+        if value is _MISSING:
+            self.__stats["misses"] += 1
+            raise KeyError(key)
+
+        with self.__lock:
+            self.__stats["cold_hits"] += 1
+            # a concurrent write may have landed in the hot tier meanwhile, it is newer than what was read
+            if key_hash not in self.__hot:
+                self.__put_hot(key_hash, key, value, dirty=False, created_at=created_at)
+
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getvalues(self, keys, default=None, return_created_at=False):
+        # with return_created_at, (value, created_at) pairs like KVIndex.getvalues
+        if return_created_at and not self.cold.store_created_at:
+            raise ValueError(
+                "created_at is not stored, pass store_created_at=True or set eviction.invalidate_after_seconds"
+            )
+
+        self.__invalidate_from_change_feed()
+
+        keys = list(keys)
+        key_hashes = [_key_hash(key) for key in keys]
+        results = [(default, None)] * len(keys)
+        cold_positions = []
+
+        with self.__lock:
+            now = time.time()
+            for i, key_hash in enumerate(key_hashes):
+                item = self.__get_hot(key_hash, now)
+                if item is None:
+                    cold_positions.append(i)
+                else:
+                    results[i] = item[1:]
+
+            self.__stats["hot_hits"] += len(keys) - len(cold_positions)
+
+        if cold_positions:
+            cold_values = self.__get_cold([keys[i] for i in cold_positions])
+
+            with self.__lock:
+                for i, (value, created_at) in zip(cold_positions, cold_values):
+                    if value is _MISSING:
+                        self.__stats["misses"] += 1
+                        continue
+
+                    self.__stats["cold_hits"] += 1
+                    results[i] = (value, created_at)
+
+                    if key_hashes[i] not in self.__hot:
+                        self.__put_hot(
+                            key_hashes[i],
+                            keys[i],
+                            value,
+                            dirty=False,
+                            created_at=created_at,
+                        )
+
+        if return_created_at:
+            return results
+
+        return [value for value, _ in results]
+
+    def __setitem__(self, key, value):
+        self.update([(key, value)])
+
+    def update(self, items):
+        items = list(items.items() if isinstance(items, dict) else items)
+        now = time.time()
+
+        if not self.write_back:
+            self.cold.update(
+                items,
+                created_at=[now] * len(items) if self.cold.store_created_at else None,
+            )
+
+        with self.__lock:
+            for key, value in items:
+                self.__put_hot(
+                    _key_hash(key), key, value, dirty=self.write_back, created_at=now
+                )
+
+    def flush(self):
+        with self.__lock:
+            if self.__dirty:
+                self.__write_cold([self.__hot[key_hash] for key_hash in self.__dirty])
+                self.__dirty.clear()
+
+    def __contains__(self, key):
+        self.__invalidate_from_change_feed()
+
+        with self.__lock:
+            if self.__get_hot(_key_hash(key), time.time()) is not None:
+                return True
+
+        return key in self.cold
+
+    def delete(self, keys):
+        keys = list(keys)
+
+        with self.__lock:
+            for key in keys:
+                key_hash = _key_hash(key)
+                self.__hot.pop(key_hash, None)
+                self.__dirty.discard(key_hash)
+
+            self.cold.delete(keys)
+
+    def __delitem__(self, key):
+        # the hot tier, with keys written back but not flushed yet, is cleared before the cold tier
+        self.delete([key])
+
+    def pop(self, key, default=_MISSING):
+        value, was_dirty = _MISSING, False
+
+        key_hash = _key_hash(key)
+
+        with self.__lock:
+            was_dirty = key_hash in self.__dirty
+            self.__dirty.discard(key_hash)
+            item = self.__hot.pop(key_hash, None)
+            if item is not None:
+                value = item[1]
+
+            try:
+                cold_value = self.cold.pop(key)
+            except KeyError:
+                cold_value = _MISSING
+
+        # a dirty hot value is newer than whatever the cold tier had
+        if value is not _MISSING and (was_dirty or cold_value is _MISSING):
+            return value
+        if cold_value is not _MISSING:
+            return cold_value
+        if default is not _MISSING:
+            return default
+        raise KeyError(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__hot.clear()
+            self.__dirty.clear()
+            self.cold.clear()
+
+    def __len__(self):
+        self.flush()
+        return len(self.cold)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self, reverse=False):
+        self.flush()
+        return self.cold.keys(reverse=reverse)
+
+    def values(self, reverse=False):
+        self.flush()
+        return self.cold.values(reverse=reverse)
+
+    def items(self, reverse=False):
+        self.flush()
+        return self.cold.items(reverse=reverse)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hot_items": len(self.__hot),
+                "dirty_items": len(self.__dirty),
+                **self.__stats,
+            }
+
+    def __del__(self):
+        try:
+            self.flush()
+        except Exception:
+            pass
@@ -25,7 +25,7 @@ REQUIRED = []
 
 # What packages are optional?
 EXTRAS = {
-    "all": ["zstandard", "vectorlite-py", "numpy"],
+    "all": ["zstandard", "vectorlite-py", "numpy", "xxhash"],
 }
 
 # The rest you shouldn't have to touch too much :)
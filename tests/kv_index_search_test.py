@@ -49,3 +49,9 @@ assert index.search({"$gte": 6}, n=10, offset=0) == {
     "key9": 9,
     "key10": 10,
 }
+
+# bytes that look like a pickle or are empty round trip as bytes
+index.update({"raw": b"\x80\x05abc", "empty": b"", "plain": b"abc"})
+assert index["raw"] == b"\x80\x05abc"
+assert index["empty"] == b""
+assert index.getvalues(["plain", "raw"]) == [b"abc", b"\x80\x05abc"]
@@ -0,0 +1,121 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import multiprocessing
+
+sys.path.append(".")
+
+from liteindex import KVIndex, EvictionCfg, function_cache
+
+db_dir = tempfile.mkdtemp()
+db_path = os.path.join(db_dir, "bloom.db")
+
+
+def insert_from_other_process(db_path, keys):
+    other = KVIndex(db_path)
+    other.update({key: key for key in keys})
+
+
+index = KVIndex(db_path, bloom_filter=True, bloom_filter_capacity=1000)
+index.update({f"key_{i}": i for i in range(100)})
+
+assert index["key_5"] == 5
+assert "key_5" in index
+assert "missing" not in index
+assert index.get("missing", "default") == "default"
+assert index.getvalues(["key_1", "missing", "key_2"], default=-1) == [1, -1, 2]
+
+# writes from another process, which only picks the filter up from the file
+process = multiprocessing.Process(
+    target=insert_from_other_process, args=(db_path, ["other_1", "other_2"])
+)
+process.start()
+process.join()
+
+assert index["other_1"] == "other_1"
+assert "other_2" in index
+assert index.getvalues(["other_1", "other_3"]) == ["other_1", None]
+
+# writes from another thread's connection
+thread = threading.Thread(target=lambda: index.update({"from_thread": 1}))
+thread.start()
+thread.join()
+assert index["from_thread"] == 1
+
+# existing files keep their filter without passing bloom_filter
+reopened = KVIndex(db_path)
+assert reopened.bloom_filter
+reopened["from_reopened"] = 1
+assert index["from_reopened"] == 1
+
+# the log is folded into the stored filter, readers further behind than the log reload fully
+folded_path = os.path.join(db_dir, "folded.db")
+reader = KVIndex(folded_path, bloom_filter=True, bloom_filter_capacity=100000)
+writer = KVIndex(folded_path)
+assert "folded_0" not in reader
+writer.update({f"folded_{i}": i for i in range(12000)})
+writer["folded_last"] = 1
+conn = sqlite3.connect(folded_path)
+assert conn.execute("SELECT MIN(version) FROM kv_index_bloom_filter_log").fetchone()[0] > 1
+assert conn.execute("SELECT COUNT(*) FROM kv_index_bloom_filter").fetchone()[0] > 0
+assert reader["folded_0"] == 0
+assert reader["folded_last"] == 1
+assert KVIndex(folded_path)["folded_11999"] == 11999
+
+# indexes sharing one connection see each other's writes
+shared_path = os.path.join(db_dir, "shared.db")
+shared_1 = KVIndex(shared_path, bloom_filter=True, shared_connections=True)
+shared_2 = KVIndex(shared_path, bloom_filter=True, shared_connections=True)
+assert "shared" not in shared_2
+shared_1["shared"] = 1
+assert "shared" in shared_2
+assert shared_2.getvalues(["shared"]) == [1]
+
+# deleted keys are dropped from the filter on rebuild, lookups stay correct before it
+del index["key_5"]
+assert "key_5" not in index
+index.rebuild_bloom_filter()
+assert "key_5" not in index
+assert index["key_6"] == 6
+assert reopened["key_6"] == 6
+
+index.clear()
+assert "key_6" not in index
+index["key_6"] = 6
+assert reopened["key_6"] == 6
+
+# enough inserts trigger an automatic rebuild
+epoch_query = "SELECT num FROM kv_index_num_metadata WHERE key = 'bloom_filter_epoch'"
+epoch = sqlite3.connect(db_path).execute(epoch_query).fetchone()[0]
+index.update({f"bulk_{i}": i for i in range(2000)})
+assert sqlite3.connect(db_path).execute(epoch_query).fetchone()[0] == epoch + 1
+assert index["bulk_1999"] == 1999
+assert reopened["bulk_0"] == 0
+
+# with eviction, misses no longer open a write transaction
+index = KVIndex(
+    os.path.join(db_dir, "bloom_lru.db"),
+    bloom_filter=True,
+    eviction=EvictionCfg(EvictionCfg.EvictLRU, max_number_of_items=100),
+)
+index.update({i: i for i in range(10)})
+assert index[3] == 3
+assert index.get(30) is None
+
+calls = []
+
+
+def square(x):
+    calls.append(x)
+    return x * x
+
+
+cached_square = function_cache(
+    square, path=os.path.join(db_dir, "cache.db"), bloom_filter=True
+)
+assert cached_square(3) == 9
+assert cached_square(3) == 9
+assert cached_square(4) == 16
+assert calls == [3, 4]
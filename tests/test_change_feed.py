@@ -0,0 +1,73 @@
+import os
+import sys
+import tempfile
+import multiprocessing
+
+sys.path.append(".")
+
+from liteindex import KVIndex, DefinedIndex
+
+db_dir = tempfile.mkdtemp()
+
+
+def write_from_other_process(db_path):
+    index = KVIndex(db_path)
+    index["key1"] = "value1"
+    index["key2"] = [1, 2]
+    del index["key1"]
+
+
+kv_index = KVIndex(os.path.join(db_dir, "kv.db"))
+kv_index.enable_change_feed(max_rows=100)
+
+cursor = kv_index.change_feed_cursor()
+
+process = multiprocessing.Process(
+    target=write_from_other_process, args=(kv_index.db_path,)
+)
+process.start()
+process.join()
+
+assert [(op, key) for _, op, key in kv_index.watch(since=cursor, timeout=0)] == [
+    ("set", "key1"),
+    ("set", "key2"),
+    ("delete", "key1"),
+]
+
+kv_index.update({i: i for i in range(500)})
+
+# older changes are compacted away
+try:
+    list(kv_index.watch(since=cursor + 1, timeout=0))
+    raise AssertionError("compacted cursor should raise")
+except ValueError:
+    pass
+
+assert len(list(kv_index.watch(since=kv_index.change_feed_cursor() - 5, timeout=0))) == 5
+
+# 0 starts from the oldest retained change instead
+replayed = list(kv_index.watch(since=0, timeout=0))
+assert replayed and replayed[-1][0] == kv_index.change_feed_cursor()
+assert replayed[0][0] > 1
+
+
+index = DefinedIndex(
+    "change_feed_test",
+    schema={"a": "number"},
+    db_path=os.path.join(db_dir, "defined.db"),
+)
+index.enable_change_feed()
+
+index.update({"1": {"a": 1}})
+index.update({"1": {"a": 2}})
+index.delete(["1"])
+index.clear()
+index.update({"2": {"a": 1}})
+
+assert [(op, _id) for _, op, _id in index.watch(since=0, timeout=0)] == [
+    ("set", "1"),
+    ("set", "1"),
+    ("delete", "1"),
+    ("clear", None),
+    ("set", "2"),
+]
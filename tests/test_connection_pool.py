@@ -0,0 +1,125 @@
+import os
+import sys
+import gc
+import time
+import tempfile
+import threading
+
+sys.path.append(".")
+
+from liteindex import KVIndex
+
+index = KVIndex(
+    os.path.join(tempfile.mkdtemp(), "kv.db"), idle_connection_timeout=0.5
+)
+
+
+def set_key(i):
+    index[i] = i
+
+
+# short lived threads reuse the connections of finished threads
+for batch in range(5):
+    threads = [threading.Thread(target=set_key, args=(batch * 10 + i,)) for i in range(10)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+
+gc.collect()
+
+stats = index.connection_pool_stats()
+assert len(index) == 50
+assert stats["created"] <= 11
+assert stats["reused"] >= 39
+
+# idle connections are closed
+time.sleep(0.6)
+thread = threading.Thread(target=set_key, args=(100,))
+thread.start()
+thread.join()
+assert index.connection_pool_stats()["closed_idle"] >= 1
+
+if hasattr(os, "fork"):
+    pid = os.fork()
+    if pid == 0:
+        index["from_child"] = 1
+        os._exit(0 if index.connection_pool_stats()["reopened_after_fork"] == 1 else 1)
+
+    assert os.waitpid(pid, 0)[1] == 0
+    assert index["from_child"] == 1
+
+# named indexes in one file keep separate tables, shared_connections gives them one pool
+shared_path = os.path.join(tempfile.mkdtemp(), "shared.db")
+first = KVIndex(shared_path, name="first", shared_connections=True)
+second = KVIndex(shared_path, name="second", shared_connections=True)
+first["a"] = 1
+second["a"] = 2
+assert first["a"] == 1 and second["a"] == 2
+assert first.connection_pool_stats()["open"] == 1
+assert second.connection_pool_stats()["open"] == 1
+
+first.clear()
+assert "a" not in first and second["a"] == 2
+
+try:
+    KVIndex(shared_path, name="bad name")
+    assert False
+except ValueError:
+    pass
+
+# without max_connections any number of live threads get a connection
+many = KVIndex(os.path.join(tempfile.mkdtemp(), "many.db"))
+many["x"] = 1
+started = threading.Barrier(201)
+done = threading.Event()
+
+
+def hold_connection():
+    assert many["x"] == 1
+    started.wait()
+    done.wait()
+
+
+threads = [threading.Thread(target=hold_connection) for _ in range(200)]
+[t.start() for t in threads]
+started.wait(timeout=30)
+assert many.connection_pool_stats()["in_use"] >= 200
+done.set()
+[t.join() for t in threads]
+
+# close() leaves connections of live threads open, new threads are refused
+from liteindex.connection_pool import ConnectionPool
+import sqlite3
+
+pool = ConnectionPool(lambda: sqlite3.connect(":memory:", check_same_thread=False))
+conn = pool.connection()
+pool.close()
+assert conn.execute("SELECT 1").fetchone() == (1,)
+assert pool.connection() is conn
+
+errors = []
+
+
+def new_thread():
+    try:
+        pool.connection()
+    except Exception as e:
+        errors.append(e)
+
+
+thread = threading.Thread(target=new_thread)
+thread.start()
+thread.join()
+assert len(errors) == 1
+
+# __del__ of an index whose __init__ raised doesn't raise
+from liteindex import DefinedIndex
+
+unraisable = []
+sys.unraisablehook = unraisable.append
+try:
+    DefinedIndex("__bad", schema={"a": DefinedIndex.Type.number})
+    assert False
+except ValueError:
+    pass
+gc.collect()
+assert not unraisable
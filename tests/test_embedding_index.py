@@ -0,0 +1,131 @@
+import sys
+
+import numpy as np
+
+sys.path.append(".")
+
+from liteindex import DefinedIndex
+
+rng = np.random.default_rng(0)
+vectors = rng.standard_normal((5000, 32)).astype(np.float32)
+vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+index = DefinedIndex(
+    "test_embedding_index",
+    schema={"embedding": "normalized_embedding", "group": "number"},
+)
+index.update(
+    {f"id_{i}": {"embedding": vector, "group": i % 4} for i, vector in enumerate(vectors)}
+)
+index.create_embedding_index("embedding", n_lists=50, n_probe=10)
+
+
+def exact(query, group=None, n=10):
+    order = np.argsort(-(vectors @ query))
+    return [f"id_{i}" for i in order if group is None or i % 4 == group][:n]
+
+
+query = vectors[7]
+
+# scanning every cluster is an exact search, with filters applied
+assert list(
+    index.search(sort_by="embedding", sort_by_embedding=query, n=10, n_probe=50)
+) == exact(query)
+assert list(
+    index.search(
+        {"group": 2}, sort_by="embedding", sort_by_embedding=query, n=10, n_probe=50
+    )
+) == exact(query, group=2)
+
+results = index.search(
+    sort_by="embedding", sort_by_embedding=query, n=3, return_metadata=True
+)
+assert list(results)[0] == "id_7"
+assert abs(results["id_7"]["__meta"]["embedding_distance"]) < 1e-5
+
+recall = np.mean(
+    [
+        len(
+            set(
+                index.search(
+                    sort_by="embedding", sort_by_embedding=vectors[i], n=10, n_probe=20
+                )
+            )
+            & set(exact(vectors[i]))
+        )
+        / 10
+        for i in range(0, 5000, 100)
+    ]
+)
+assert recall > 0.9, recall
+
+# filters keep n hits, a selective one is scored exactly and a broad one probes more clusters until it has them
+assert list(
+    index.search({"id": "id_9"}, sort_by="embedding", sort_by_embedding=query, n_probe=1)
+) == ["id_9"]
+few = [f"id_{i}" for i in range(0, 5000, 100)]
+assert list(
+    index.search(
+        {"id": {"$in": few}}, sort_by="embedding", sort_by_embedding=query, n=10, n_probe=1
+    )
+) == [_ for _ in exact(query, n=5000) if _ in few][:10]
+assert (
+    len(
+        index.search(
+            {"group": {"$ne": 1}},
+            sort_by="embedding",
+            sort_by_embedding=query,
+            n=200,
+            n_probe=1,
+        )
+    )
+    == 200
+)
+
+# range search over every cluster is exact
+within = {f"id_{i}" for i in np.flatnonzero(1 - vectors @ query <= 0.5)}
+assert (
+    set(
+        index.search(
+            sort_by="embedding", sort_by_embedding=query, max_distance=0.5, n_probe=50
+        )
+    )
+    == within
+)
+assert (
+    index.count(
+        embedding_key="embedding", embedding=query, max_distance=0.5, n_probe=50
+    )
+    == len(within)
+)
+
+# each query of a batch probes its own clusters
+batch = index.search(
+    sort_by="embedding", sort_by_embedding=vectors[[7, 8, 9]], n=10, n_probe=50
+)
+assert [list(results) for results in batch] == [exact(q) for q in vectors[[7, 8, 9]]]
+
+# writes after the index was built are searchable right away
+index.update({"new": {"embedding": query, "group": 9}})
+assert set(index.search(sort_by="embedding", sort_by_embedding=query, n=2)) == {
+    "id_7",
+    "new",
+}
+
+index.delete(["new", "id_7"])
+assert {"new", "id_7"}.isdisjoint(
+    index.search(sort_by="embedding", sort_by_embedding=query, n=10)
+)
+
+# re-embedding a row moves it to the cluster of its new embedding
+index.update({"id_8": {"embedding": query}})
+assert list(index.search(sort_by="embedding", sort_by_embedding=query, n=1)) == [
+    "id_8"
+]
+
+index.clear()
+index.update({"a": {"embedding": query}})
+assert list(index.search(sort_by="embedding", sort_by_embedding=query)) == ["a"]
+
+index.drop_embedding_index("embedding")
+index.drop()
@@ -0,0 +1,218 @@
+import sys
+
+import numpy as np
+
+sys.path.append(".")
+
+from liteindex import DefinedIndex
+
+# without vectorlite, embedding search runs on an in-memory matrix refreshed from the table
+
+rng = np.random.default_rng(1)
+vectors = rng.standard_normal((3000, 16)).astype(np.float32)
+vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+index = DefinedIndex(
+    "test_embedding_matrix",
+    schema={"embedding": "normalized_embedding", "group": "number"},
+)
+index.update(
+    {f"id_{i}": {"embedding": vector, "group": i % 3} for i, vector in enumerate(vectors)}
+)
+index.update({"no_embedding": {"group": 0}})
+
+
+def exact(query, group=None, n=10):
+    order = np.argsort(-(vectors @ query))
+    return [f"id_{i}" for i in order if group is None or i % 3 == group][:n]
+
+
+query = vectors[11]
+
+assert list(index.search(sort_by="embedding", sort_by_embedding=query, n=10)) == exact(
+    query
+)
+assert list(
+    index.search({"group": 1}, sort_by="embedding", sort_by_embedding=query, n=10)
+) == exact(query, group=1)
+assert list(
+    index.search(sort_by="embedding", sort_by_embedding=query, n=5, offset=5)
+) == exact(query)[5:]
+# a filter matching most rows is applied to the results of a search over every row, still exact
+assert list(
+    index.search(
+        {"group": {"$ne": 1}}, sort_by="embedding", sort_by_embedding=query, n=10
+    )
+) == [_ for _ in exact(query, n=30) if _ not in exact(query, group=1, n=30)][:10]
+
+results = index.search(
+    sort_by="embedding", sort_by_embedding=query, n=1, return_metadata=True
+)
+assert abs(results["id_11"]["__meta"]["embedding_distance"]) < 1e-5
+
+# range search, only rows within max_distance are scored into the results
+within = {f"id_{i}" for i in np.flatnonzero(1 - vectors @ query <= 0.4)}
+assert set(index.search(sort_by="embedding", sort_by_embedding=query, max_distance=0.4)) == within
+assert set(
+    index.search(sort_by="embedding", sort_by_embedding=query, min_similarity=0.6)
+) == within
+assert index.count(embedding_key="embedding", embedding=query, max_distance=0.4) == len(
+    within
+)
+assert index.count(
+    {"group": 1}, embedding_key="embedding", embedding=query, max_distance=0.4
+) == len([_ for _ in within if int(_[3:]) % 3 == 1])
+assert index.count(
+    embedding_key="embedding", embedding=vectors[[11, 12]], max_distance=0.4
+) == [len(within), int((1 - vectors @ vectors[12] <= 0.4).sum())]
+
+try:
+    index.search(
+        sort_by="embedding",
+        sort_by_embedding=query,
+        sort_by_embedding_metric="l2",
+        min_similarity=0.6,
+    )
+    assert False
+except ValueError:
+    pass
+
+# a 2-d array searches a batch of queries, one result dict per row
+batch = index.search(
+    {"group": 2}, sort_by="embedding", sort_by_embedding=vectors[[11, 20, 400]], n=10
+)
+assert [list(results) for results in batch] == [
+    exact(q, group=2) for q in vectors[[11, 20, 400]]
+]
+reversed_batch = index.search(
+    sort_by="embedding",
+    sort_by_embedding=vectors[[3, 4]],
+    n=3,
+    reversed_sort=True,
+    return_metadata=True,
+)
+assert [list(results) for results in reversed_batch] == [
+    exact(-q, n=3) for q in vectors[[3, 4]]
+]
+farthest = exact(-vectors[3], n=1)[0]
+assert (
+    abs(
+        reversed_batch[0][farthest]["__meta"]["embedding_distance"]
+        - (1 - vectors[3] @ vectors[int(farthest[3:])])
+    )
+    < 1e-5
+)
+
+# inserts, updates and deletes are picked up by the next search
+index.update({"new": {"embedding": vectors[12]}})
+index.delete("id_12")
+index.get("id_13", update={"embedding": query})
+assert set(index.search(sort_by="embedding", sort_by_embedding=query, n=2)) == {
+    "id_11",
+    "id_13",
+}
+assert list(index.search(sort_by="embedding", sort_by_embedding=vectors[12], n=1)) == [
+    "new"
+]
+
+# writes are picked up whatever their updated_at, e.g. one stamped before waiting on another writer
+connection = index._DefinedIndex__connection
+with connection:
+    connection.execute(
+        'UPDATE "test_embedding_matrix" SET embedding = ?, updated_at = 0 WHERE id = ?',
+        (vectors[20].tobytes(), "id_14"),
+    )
+assert set(index.search(sort_by="embedding", sort_by_embedding=vectors[20], n=2)) == {
+    "id_14",
+    "id_20",
+}
+
+index.clear()
+index.update({"a": {"embedding": query}})
+assert list(index.search(sort_by="embedding", sort_by_embedding=query)) == ["a"]
+
+index.drop()
+
+# quantized copies are scanned first and the candidates re-ranked with exact distances
+vectors = rng.standard_normal((2000, 256)).astype(np.float32)
+vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+for quantization in ["int8", "binary"]:
+    index = DefinedIndex(
+        f"test_embedding_matrix_{quantization}",
+        schema={"embedding": "normalized_embedding", "group": "number"},
+        embedding_quantization={"embedding": quantization},
+    )
+    index.update(
+        {
+            f"id_{i}": {"embedding": vector, "group": i % 3}
+            for i, vector in enumerate(vectors)
+        }
+    )
+
+    for i in range(0, 2000, 200):
+        results = index.search(
+            sort_by="embedding",
+            sort_by_embedding=vectors[i],
+            n=5,
+            return_metadata=True,
+            rerank_factor=50,
+        )
+        assert list(results)[0] == f"id_{i}"
+        # distances are exact after re-ranking
+        assert abs(results[f"id_{i}"]["__meta"]["embedding_distance"]) < 1e-5
+
+    # the threshold is applied to exact distances
+    within = {f"id_{i}" for i in np.flatnonzero(1 - vectors @ vectors[7] <= 0.5)}
+    assert (
+        set(
+            index.search(
+                sort_by="embedding", sort_by_embedding=vectors[7], max_distance=0.5
+            )
+        )
+        == within
+    )
+
+    if quantization == "int8":
+        assert list(
+            index.search(
+                {"group": 1}, sort_by="embedding", sort_by_embedding=vectors[3], n=10
+            )
+        ) == exact(vectors[3], group=1)
+
+    index.drop()
+
+try:
+    DefinedIndex(
+        "test_embedding_matrix_invalid",
+        schema={"embedding": "normalized_embedding"},
+        embedding_quantization={"embedding": "int4"},
+    )
+    assert False
+except ValueError:
+    pass
+
+# the change feed is created with the table, searches don't write the schema
+import os
+import sqlite3
+import tempfile
+
+db_path = os.path.join(tempfile.mkdtemp(), "schema.db")
+index = DefinedIndex(
+    "test_embedding_matrix_schema",
+    schema={"embedding": "normalized_embedding"},
+    db_path=db_path,
+)
+index.update({f"id_{i}": {"embedding": vectors[i]} for i in range(100)})
+
+conn = sqlite3.connect(db_path)
+schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+assert list(index.search(sort_by="embedding", sort_by_embedding=vectors[5], n=1)) == [
+    "id_5"
+]
+index.update({"id_5": {"embedding": vectors[6]}})
+assert list(index.search(sort_by="embedding", sort_by_embedding=vectors[6], n=2)) in (
+    ["id_5", "id_6"],
+    ["id_6", "id_5"],
+)
+assert conn.execute("PRAGMA schema_version").fetchone()[0] == schema_version
@@ -0,0 +1,53 @@
+import sys
+
+sys.path.append(".")
+
+import numpy as np
+
+from liteindex.fingerprint import fingerprint, register_fingerprinter
+
+assert len(fingerprint("a")) == 32
+assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+assert fingerprint({1, 2, 3}) == fingerprint({3, 2, 1})
+assert fingerprint(1) == fingerprint(1.0)
+assert fingerprint(1.5) != fingerprint(1)
+assert fingerprint(float("nan")) == fingerprint(float("nan"))
+assert fingerprint(True) != fingerprint(1)
+assert fingerprint([1, 2]) != fingerprint((1, 2))
+assert fingerprint(["ab", "c"]) != fingerprint(["a", "bc"])
+assert fingerprint("1") != fingerprint(1)
+assert fingerprint(b"a") != fingerprint("a")
+
+array = np.arange(12, dtype=np.float32).reshape(3, 4)
+assert fingerprint(array.T) == fingerprint(np.ascontiguousarray(array.T))
+assert fingerprint(array[:, ::2]) == fingerprint(array[:, ::2].copy())
+assert fingerprint(array) != fingerprint(array.reshape(4, 3))
+assert fingerprint(array) != fingerprint(array.astype(np.float64))
+assert fingerprint(np.float64(2.0)) == fingerprint(2)
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x, self.y = x, y
+
+
+register_fingerprinter(Point, lambda p: (p.x, p.y))
+assert fingerprint(Point(1, 2)) == fingerprint(Point(1, 2))
+assert fingerprint(Point(1, 2)) != fingerprint(Point(2, 1))
+assert fingerprint(Point(1, 2)) != fingerprint((1, 2))
+
+
+class Point3D(Point):
+    pass
+
+
+assert fingerprint(Point3D(1, 2)) != fingerprint(Point(1, 2))
+
+# anything else is pickled
+assert fingerprint(range(3)) == fingerprint(range(3))
+
+assert fingerprint({1.0, 2}) == fingerprint({2, 1})
+assert fingerprint({frozenset([1]): 1, frozenset([2]): 2}) == fingerprint(
+    {frozenset([2]): 2, frozenset([1]): 1}
+)
+assert fingerprint({"a": 1, 2: "b"}) == fingerprint({2: "b", "a": 1})
@@ -0,0 +1,523 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+
+sys.path.append(".")
+
+from liteindex import function_cache, EvictionCfg
+
+db_dir = tempfile.mkdtemp()
+
+calls = []
+
+
+@function_cache(path=os.path.join(db_dir, "batch.db"), batch_arg="sentences")
+def embed(sentences, scale=1):
+    calls.append(list(sentences))
+    return [len(sentence) * scale for sentence in sentences]
+
+
+assert embed(["a", "bb"]) == [1, 2]
+assert embed(["bb", "ccc", "a", "ccc"]) == [2, 3, 1, 3]
+assert calls == [["a", "bb"], ["ccc"]]
+
+# other arguments are part of the key
+assert embed(["a", "bb"], scale=10) == [10, 20]
+assert embed(sentences=["a"], scale=10) == [10]
+assert calls[-1] == ["a", "bb"]
+
+assert embed([]) == []
+assert embed([["unhashable"], ["unhashable"]]) == [1, 1]
+
+calls.clear()
+assert embed(["a", "bb", "ccc"]) == [1, 2, 3]
+assert calls == []
+
+
+@function_cache(path=os.path.join(db_dir, "batch_wrong.db"), batch_arg="xs")
+def wrong_length(xs):
+    return xs[:1]
+
+
+try:
+    wrong_length([1, 2])
+    assert False
+except ValueError:
+    pass
+
+try:
+    function_cache(lambda xs: xs, path=os.path.join(db_dir, "x.db"), batch_arg="ys")
+    assert False
+except ValueError:
+    pass
+
+
+@function_cache(path=os.path.join(db_dir, "single.db"))
+def add(a, b):
+    calls.append((a, b))
+    return a + b
+
+
+assert add(1, 2) == 3
+assert add(1, 2) == 3
+assert add(1, b=2) == 3
+assert calls == [(1, 2), (1, 2)]
+
+# async functions
+import asyncio
+
+async_calls = []
+
+
+@function_cache(path=os.path.join(db_dir, "async.db"))
+async def slow_square(x):
+    async_calls.append(x)
+    await asyncio.sleep(0.05)
+    return x * x
+
+
+async def run_concurrently():
+    return await asyncio.gather(*[slow_square(i % 2) for i in range(10)])
+
+
+assert asyncio.run(run_concurrently()) == [0, 1] * 5
+assert sorted(async_calls) == [0, 1]
+
+assert asyncio.run(slow_square(1)) == 1
+assert len(async_calls) == 2
+
+
+@function_cache(path=os.path.join(db_dir, "async_unhashable.db"))
+async def total(xs):
+    return sum(xs)
+
+
+assert asyncio.run(total([1, 2])) == 3
+
+
+@function_cache(path=os.path.join(db_dir, "async_batch.db"), batch_arg="xs")
+async def async_batch(xs):
+    async_calls.append(list(xs))
+    return [x + 1 for x in xs]
+
+
+assert asyncio.run(async_batch([1, 2])) == [2, 3]
+assert asyncio.run(async_batch([2, 3])) == [3, 4]
+assert async_calls[-2:] == [[1, 2], [3]]
+
+# single flight across threads and processes
+import multiprocessing
+
+stampede_calls = multiprocessing.Value("i", 0)
+
+
+@function_cache(path=os.path.join(db_dir, "stampede.db"), lease_seconds=10)
+def expensive(x):
+    with stampede_calls.get_lock():
+        stampede_calls.value += 1
+    time.sleep(0.3)
+    return x * 2
+
+
+threads = [threading.Thread(target=expensive, args=(21,)) for _ in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+assert stampede_calls.value == 1
+assert expensive(21) == 42
+
+processes = [multiprocessing.Process(target=expensive, args=(5,)) for _ in range(4)]
+for process in processes:
+    process.start()
+for process in processes:
+    process.join()
+
+assert stampede_calls.value == 2
+assert expensive(5) == 10
+
+
+# async functions take the lease too
+@function_cache(path=os.path.join(db_dir, "async_stampede.db"), lease_seconds=10)
+async def async_expensive(x):
+    with stampede_calls.get_lock():
+        stampede_calls.value += 1
+    await asyncio.sleep(0.3)
+    return x * 3
+
+
+def run_async_expensive(x):
+    assert asyncio.run(async_expensive(x)) == x * 3
+
+
+processes = [
+    multiprocessing.Process(target=run_async_expensive, args=(7,)) for _ in range(4)
+]
+for process in processes:
+    process.start()
+for process in processes:
+    process.join()
+
+assert stampede_calls.value == 3
+assert all(process.exitcode == 0 for process in processes)
+assert asyncio.run(async_expensive(7)) == 21
+assert stampede_calls.value == 3
+
+async_calls.clear()
+
+
+@function_cache(path=os.path.join(db_dir, "async_no_single_flight.db"), single_flight=False)
+async def async_unshared(x):
+    async_calls.append(x)
+    await asyncio.sleep(0.05)
+    return x
+
+
+async def run_unshared():
+    return await asyncio.gather(*[async_unshared(1) for _ in range(3)])
+
+
+assert asyncio.run(run_unshared()) == [1, 1, 1]
+assert async_calls == [1, 1, 1]
+
+
+@function_cache(path=os.path.join(db_dir, "failing.db"))
+def failing(x):
+    time.sleep(0.1)
+    raise RuntimeError(x)
+
+
+errors = []
+
+
+def call_failing():
+    try:
+        failing(1)
+    except RuntimeError as e:
+        errors.append(e)
+
+
+threads = [threading.Thread(target=call_failing) for _ in range(4)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+
+assert len(errors) == 4
+
+# leases
+from liteindex import KVIndex
+
+leases = KVIndex(os.path.join(db_dir, "leases.db"))
+token = leases.acquire_lease("key", ttl_seconds=0.2)
+assert token is not None
+assert leases.acquire_lease("key", ttl_seconds=0.2) is None
+leases.release_lease("key", token)
+assert leases.acquire_lease("key", ttl_seconds=0.2) is not None
+time.sleep(0.25)
+assert leases.acquire_lease("key", ttl_seconds=0.2) is not None
+
+# functions sharing one file get their own namespace, eviction budget and connections
+shared_path = os.path.join(db_dir, "shared.db")
+calls.clear()
+
+
+@function_cache(path=shared_path)
+def double(x):
+    calls.append(("double", x))
+    return x * 2
+
+
+@function_cache(path=shared_path)
+def triple(x):
+    calls.append(("triple", x))
+    return x * 3
+
+
+assert double(2) == 4
+assert triple(2) == 6
+assert double(2) == 4
+assert calls == [("double", 2), ("triple", 2)]
+
+double.invalidate()
+assert triple(2) == 6
+assert double(2) == 4
+assert calls == [("double", 2), ("triple", 2), ("double", 2)]
+
+# a new version starts empty, the same version reuses the cache
+calls.clear()
+double_v2 = function_cache(
+    lambda x: calls.append(x) or x * 2, path=shared_path, namespace="double", version=2
+)
+assert double_v2(5) == 10
+assert (
+    function_cache(lambda x: -1, path=shared_path, namespace="double", version=2)(5)
+    == 10
+)
+assert function_cache(lambda x: -1, path=shared_path, namespace="double", version=3)(5) == -1
+assert calls == [5]
+
+# code_version=True re-computes when the function's code changes
+first = function_cache(lambda x: x + 1, path=shared_path, namespace="code", code_version=True)
+second = function_cache(lambda x: x + 2, path=shared_path, namespace="code", code_version=True)
+assert first(1) == 2
+assert second(1) == 3
+
+# invalidate_after_seconds is a hard ttl, past stale_after_seconds the cached value is returned
+# and refreshed in the background
+calls.clear()
+ttl_path = os.path.join(db_dir, "ttl.db")
+
+
+@function_cache(path=ttl_path, invalidate_after_seconds=0.5)
+def hard_ttl(x):
+    calls.append(x)
+    return len(calls)
+
+
+assert hard_ttl(1) == 1
+assert hard_ttl(1) == 1
+time.sleep(0.6)
+assert hard_ttl(1) == 2
+
+calls.clear()
+
+
+@function_cache(path=ttl_path, stale_after_seconds=0.2, invalidate_after_seconds=5)
+def soft_ttl(x):
+    calls.append(x)
+    return len(calls)
+
+
+assert soft_ttl(1) == 1
+time.sleep(0.3)
+# stale, returned right away while it's recomputed
+assert soft_ttl(1) == 1
+for _ in range(100):
+    if soft_ttl(1) == 2:
+        break
+    time.sleep(0.02)
+assert soft_ttl(1) == 2
+assert calls == [1, 1]
+
+calls.clear()
+
+
+@function_cache(path=ttl_path, stale_after_seconds=0.2, batch_arg="xs")
+def soft_ttl_batch(xs):
+    calls.append(list(xs))
+    return [x * len(calls) for x in xs]
+
+
+assert soft_ttl_batch([1, 2]) == [1, 2]
+time.sleep(0.3)
+assert soft_ttl_batch([1, 2, 3]) == [1, 2, 6]
+for _ in range(100):
+    if soft_ttl_batch([1, 2]) != [1, 2]:
+        break
+    time.sleep(0.02)
+assert sorted(map(sorted, calls)) == [[1, 2], [1, 2], [3]]
+
+try:
+    function_cache(
+        lambda x: x, path=ttl_path, stale_after_seconds=2, invalidate_after_seconds=1
+    )
+    assert False
+except ValueError:
+    pass
+
+# results are stored as they are, the time they were written is a column of their own. a cache
+# written without stale_after_seconds is read by one with it
+import sqlite3
+
+plain = function_cache(lambda x: x * 10, path=ttl_path, namespace="plain")
+assert plain(1) == 10
+plain = function_cache(
+    lambda x: -1, path=ttl_path, namespace="plain", stale_after_seconds=60
+)
+assert plain(1) == 10
+
+conn = sqlite3.connect(ttl_path)
+(table,) = conn.execute(
+    "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'fc_plain_%' AND name NOT LIKE '%_num_metadata' AND name NOT LIKE '%_leases'"
+).fetchone()
+assert conn.execute(f'SELECT num_value, created_at > 0 FROM "{table}"').fetchall() == [
+    (10, 1)
+]
+conn.close()
+
+
+# max_number_of_items is passed to the index
+calls.clear()
+
+
+@function_cache(path=ttl_path, max_number_of_items=10)
+def bounded(x):
+    calls.append(x)
+    return x
+
+
+for i in range(50):
+    bounded(i)
+bounded(0)
+assert calls.count(0) == 2
+
+# map looks up and writes back per chunk, only misses go to the pool, results come back in order
+map_path = os.path.join(db_dir, "map.db")
+
+
+@function_cache(path=map_path)
+def map_square(x):
+    return x * x
+
+
+assert map_square(3) == 9
+assert list(map_square.map([5, 5, 21], workers=2, chunk_size=2)) == [25, 25, 441]
+assert list(map_square.map([])) == []
+
+calls.clear()
+
+
+@function_cache(path=map_path)
+def map_traced(x):
+    calls.append(x)
+    return -x
+
+
+assert list(map_traced.map(range(10), executor="thread", chunk_size=3)) == [
+    -x for x in range(10)
+]
+assert sorted(calls) == list(range(10))
+assert list(map_traced.map(range(12), executor="thread")) == [-x for x in range(12)]
+assert sorted(calls) == list(range(12))
+
+try:
+    list(map_traced.map(range(3), executor="cluster"))
+    assert False
+except ValueError:
+    pass
+
+# generator functions are recorded while they stream and replayed lazily
+generator_path = os.path.join(db_dir, "generator.db")
+calls.clear()
+
+
+@function_cache(path=generator_path)
+def tokens(text):
+    calls.append(text)
+    for token in text.split():
+        yield token
+
+
+assert list(tokens("a b c")) == ["a", "b", "c"]
+assert list(tokens("a b c")) == ["a", "b", "c"]
+assert calls == ["a b c"]
+
+# stopping early doesn't leave a partial result behind
+stream = tokens("x y z")
+assert next(stream) == "x"
+stream.close()
+assert list(tokens("x y z")) == ["x", "y", "z"]
+assert calls == ["a b c", "x y z", "x y z"]
+
+assert list(tokens("")) == []
+assert list(tokens("")) == []
+assert calls[-1] == ""
+
+long_text = " ".join(str(i) for i in range(1000))
+assert list(tokens(long_text)) == long_text.split()
+assert list(tokens(long_text)) == long_text.split()
+assert calls.count(long_text) == 1
+
+
+@function_cache(path=generator_path)
+async def async_tokens(text):
+    calls.append(("async", text))
+    for token in text.split():
+        await asyncio.sleep(0)
+        yield token
+
+
+async def collect(stream):
+    return [chunk async for chunk in stream]
+
+
+assert asyncio.run(collect(async_tokens("p q"))) == ["p", "q"]
+assert asyncio.run(collect(async_tokens("p q"))) == ["p", "q"]
+assert calls.count(("async", "p q")) == 1
+
+# path=None keeps results in one in-process lru shared by all threads
+calls.clear()
+
+
+@function_cache(path=None, max_number_of_items=3, eviction_policy=EvictionCfg.EvictLRU)
+def in_memory(x):
+    calls.append(x)
+    return x + 1
+
+
+assert in_memory(1) == 2
+thread = threading.Thread(target=in_memory, args=(1,))
+thread.start()
+thread.join()
+assert calls == [1]
+
+for x in [2, 3, 1, 4]:
+    in_memory(x)
+# 1 was used recently, 2 was evicted
+assert in_memory(1) == 2 and calls.count(1) == 1
+assert in_memory(2) == 3 and calls.count(2) == 2
+
+in_memory.invalidate()
+assert in_memory(1) == 2 and calls.count(1) == 2
+
+try:
+    function_cache(lambda x: x, path=None, lease_seconds=1)
+    assert False
+except ValueError:
+    pass
+
+# spill_path writes evicted results and the rest at exit to a file, read back lazily
+spill_path = os.path.join(db_dir, "spill.db")
+calls.clear()
+
+
+def spilled(x):
+    calls.append(x)
+    return x * 10
+
+
+first_run = function_cache(
+    spilled, path=None, spill_path=spill_path, max_number_of_items=2
+)
+assert [first_run(x) for x in range(4)] == [0, 10, 20, 30]
+
+second_run = function_cache(spilled, path=None, spill_path=spill_path)
+# 0 and 1 were evicted to the file, 2 and 3 are still only in the first run's memory
+assert second_run(0) == 0 and second_run(1) == 10
+assert calls == [0, 1, 2, 3]
+
+# a discarded function's cache isn't kept alive until exit, it writes the rest to the file when freed
+import gc
+import weakref
+
+first_run_cache = weakref.ref(first_run.invalidate.__self__)
+del first_run
+gc.collect()
+assert first_run_cache() is None
+assert second_run(2) == 20 and second_run(3) == 30
+assert calls == [0, 1, 2, 3]
+
+
+# workers unpickle map_square by importing this module, so processes only run once it is imported
+def test_map_with_processes():
+    assert list(
+        map_square.map(range(20), workers=2, executor="process", chunk_size=7)
+    ) == [x * x for x in range(20)]
+
+
+if __name__ == "__main__":
+    test_map_with_processes()
@@ -0,0 +1,133 @@
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append(".")
+
+from liteindex import DefinedIndex
+
+# hybrid search, bm25 of a $text condition fused with an embedding ranking
+
+rng = np.random.default_rng(2)
+vectors = rng.standard_normal((500, 16)).astype(np.float32)
+vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+words = ["disk", "network", "memory", "timeout", "cpu"]
+
+# on a file the text index is searched on another thread while embeddings are scored
+index = DefinedIndex(
+    "test_hybrid_search",
+    schema={"message": "string", "embedding": "normalized_embedding", "level": "number"},
+    db_path=os.path.join(tempfile.mkdtemp(), "hybrid.db"),
+)
+index.update(
+    {
+        f"id_{i}": {
+            "message": f"{words[i % 5]} error {words[i % 7 % 5]}",
+            "embedding": vector,
+            "level": i % 2,
+        }
+        for i, vector in enumerate(vectors)
+    }
+)
+index.create_text_index("message")
+
+# the most relevant row for both rankings
+query = rng.standard_normal(16).astype(np.float32)
+query /= np.linalg.norm(query)
+index.update({"best": {"message": "disk disk disk", "embedding": query, "level": 0}})
+
+for fusion in ["rrf", "weighted"]:
+    results = index.search(
+        {"message": {"$text": "disk"}},
+        sort_by="embedding",
+        sort_by_embedding=query,
+        fusion=fusion,
+        n=10,
+        return_metadata=True,
+    )
+    assert len(results) == 10
+    scores = [_["__meta"]["fusion_score"] for _ in results.values()]
+    assert scores == sorted(scores, reverse=True)
+    assert list(results)[0] == "best"
+
+    # the rest of the query filters both rankings
+    results = index.search(
+        {"message": {"$text": "disk"}, "level": 1},
+        sort_by="embedding",
+        sort_by_embedding=query,
+        fusion=fusion,
+        n=10,
+    )
+    assert len(results) == 10
+    assert all(_["level"] == 1 for _ in results.values())
+
+    # only the embedding ranking counts
+    assert list(
+        index.search(
+            {"message": {"$text": "disk"}},
+            sort_by="embedding",
+            sort_by_embedding=query,
+            fusion=fusion,
+            fusion_text_weight=0,
+            n=5,
+        )
+    ) == list(index.search(sort_by="embedding", sort_by_embedding=query, n=5))
+
+    # pages of the same fused ranking
+    first = index.search(
+        {"message": {"$text": "disk OR cpu"}},
+        sort_by="embedding",
+        sort_by_embedding=query,
+        fusion=fusion,
+        n=10,
+    )
+    second = index.search(
+        {"message": {"$text": "disk OR cpu"}},
+        sort_by="embedding",
+        sort_by_embedding=query,
+        fusion=fusion,
+        n=5,
+        offset=5,
+    )
+    assert list(second) == list(first)[5:]
+
+for kwargs in [
+    {"fusion": "max"},
+    {"fusion": "rrf", "reversed_sort": True},
+    {"fusion": "rrf", "sort_by_embedding": vectors[:2]},
+    {"fusion": "rrf", "query": {"level": 1}},
+]:
+    kwargs = {"query": {"message": {"$text": "disk"}}, "sort_by_embedding": query, **kwargs}
+    try:
+        index.search(sort_by="embedding", n=5, **kwargs)
+        assert False
+    except ValueError:
+        pass
+
+index.drop()
+
+# an in-memory index searches both rankings on the caller's thread
+index = DefinedIndex(
+    "test_hybrid_search",
+    schema={"message": "string", "embedding": "normalized_embedding"},
+)
+index.update(
+    {
+        "a": {"message": "disk full", "embedding": vectors[0]},
+        "b": {"message": "cpu busy", "embedding": query},
+    }
+)
+index.create_text_index("message")
+assert list(
+    index.search(
+        {"message": {"$text": "disk OR cpu"}},
+        sort_by="embedding",
+        sort_by_embedding=query,
+        fusion="rrf",
+        fusion_text_weight=0.2,
+    )
+) == ["b", "a"]
+index.drop()
@@ -0,0 +1,103 @@
+import os
+import sys
+import tempfile
+
+sys.path.append(".")
+
+from liteindex import DefinedIndex
+
+# expression indexes on json paths and value indexes for membership in json arrays
+
+db_path = os.path.join(tempfile.mkdtemp(), "json_index.db")
+
+index = DefinedIndex(
+    "test_json_index",
+    schema={"profile": "json", "tags": "json", "age": "number"},
+    db_path=db_path,
+)
+index.update(
+    {
+        "a": {"profile": {"address": {"city": "paris"}, "langs": ["fr", "en"]}, "tags": ["x", "y"], "age": 1},
+        "b": {"profile": {"address": {"city": "oslo"}, "langs": ["no"]}, "tags": ["y"], "age": 2},
+        "c": {"profile": {"address": {"city": "paris"}, "langs": "en"}, "tags": [], "age": 3},
+        "d": {"age": 4},
+    }
+)
+
+queries = [
+    {"profile": {"address": {"city": "paris"}}},
+    {"profile": {"address": {"city": {"$gte": "p"}}}},
+    {"profile": {"langs": {"$in": ["en", "no"]}}},
+    {"profile": {"langs": {"$like": "e%"}}},
+    {"tags": {"$in": ["x"]}},
+    {"tags": {"$like": "y"}},
+    {"tags": {"$nin": ["y"]}},
+    {"tags": {"$in": ["y"]}, "age": {"$lt": 2}},
+]
+
+# scalar lang values are only matched through the value index, json_each() can't read them
+before = [
+    set(index.search(query)) if i not in (2, 3) else None
+    for i, query in enumerate(queries)
+]
+
+index.optimize_for_query("profile.address.city")
+index.optimize_for_query("profile.langs")
+index.optimize_for_query("tags")
+
+assert set(index.list_optimized_keys()) >= {
+    "profile.address.city",
+    "profile.langs",
+    "tags",
+}
+
+plan = index._DefinedIndex__connection.execute(
+    "EXPLAIN QUERY PLAN SELECT id FROM test_json_index WHERE json_extract(profile, '$.address.city') = ?",
+    ["paris"],
+).fetchall()
+assert any("idx_test_json_index_profile.address.city" in str(_) for _ in plan)
+
+expected = [
+    {"a", "c"},
+    {"a", "c"},
+    {"a", "b", "c"},
+    {"a", "c"},
+    {"a"},
+    {"a", "b"},
+    {"c", "d"},
+    {"a"},
+]
+for query, results, _before in zip(queries, expected, before):
+    assert set(index.search(query)) == results, query
+    assert index.count(query) == len(results), query
+    if _before is not None:
+        assert _before == results, query
+
+# writes keep the value indexes in sync
+index.update({"b": {"tags": ["x"], "profile": {"langs": ["fr"]}}})
+assert set(index.search({"tags": {"$in": ["x"]}})) == {"a", "b"}
+assert set(index.search({"profile": {"langs": {"$in": ["no"]}}})) == set()
+index.delete("a")
+assert set(index.search({"tags": {"$in": ["x"]}})) == {"b"}
+index.delete(query={"tags": {"$in": ["x"]}})
+assert set(index.search({"tags": {"$in": ["x", "y"]}})) == set()
+
+index.clear()
+index.update({"e": {"tags": ["z"]}})
+assert set(index.search({"tags": {"$in": ["z"]}})) == {"e"}
+
+# another instance on the same file uses the value indexes too
+other = DefinedIndex("test_json_index", db_path=db_path)
+assert other._DefinedIndex__json_value_indexes == {"profile.address.city", "profile.langs", "tags"}
+assert set(other.search({"tags": {"$in": ["z"]}})) == {"e"}
+assert "tags" in other.list_optimized_keys()
+
+for invalid in ["age.a", "profile.a'b", "missing"]:
+    try:
+        index.optimize_for_query(invalid)
+        assert False
+    except (ValueError, KeyError):
+        pass
+
+index.drop()
+assert index.list_optimized_keys() == {}
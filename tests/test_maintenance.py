@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+
+from liteindex import KVIndex, DefinedIndex, EvictionCfg
+
+db_dir = tempfile.mkdtemp()
+
+index = KVIndex(os.path.join(db_dir, "kv.db"), maintenance_interval=None)
+index.update({i: "x" * 1000 for i in range(5000)})
+index.delete(range(5000))
+
+stats = index.maintain(vacuum_pages=100)
+assert stats["freelist_count"] > 100
+assert stats["vacuumed_pages"] == 100
+assert stats["checkpoint_busy"] == 0
+
+stats = index.maintain(vacuum_pages=10**6, checkpoint="truncate")
+assert stats["vacuumed_pages"] == stats["freelist_count"] > 0
+assert index.maintain()["freelist_count"] == 0
+assert os.path.getsize(os.path.join(db_dir, "kv.db-wal")) == 0
+
+# full and none are still supported, incremental_vacuum is skipped for them
+index = KVIndex(os.path.join(db_dir, "kv_full.db"), auto_vacuum="full")
+index.update({i: "x" * 1000 for i in range(1000)})
+index.clear()
+assert index.maintain()["vacuumed_pages"] == 0
+
+try:
+    KVIndex(os.path.join(db_dir, "kv_invalid.db"), auto_vacuum="sometimes")
+    assert False
+except ValueError:
+    pass
+
+# eviction heavy writes run maintenance every interval
+index = KVIndex(
+    os.path.join(db_dir, "kv_evict.db"),
+    eviction=EvictionCfg(EvictionCfg.EvictFIFO, max_number_of_items=100),
+    maintenance_interval=0,
+)
+for i in range(10):
+    index.update({(i, j): "x" * 1000 for j in range(100)})
+assert index.maintain(checkpoint=None)["freelist_count"] == 0
+
+index = DefinedIndex(
+    "docs",
+    schema={"text": "string"},
+    db_path=os.path.join(db_dir, "defined.db"),
+    maintenance_interval=None,
+)
+index.update({str(i): {"text": "x" * 1000} for i in range(2000)})
+index.delete(ids=[str(i) for i in range(2000)])
+
+stats = index.maintain()
+assert stats["freelist_count"] > 0
+assert index.maintain()["freelist_count"] == max(
+    stats["freelist_count"] - 2 * index.auto_vacuum_increment, 0
+)
+
+# items past invalidate_after_seconds are misses, deleted by the next write or maintain()
+ttl = EvictionCfg(
+    EvictionCfg.EvictFIFO, max_number_of_items=100, invalidate_after_seconds=0.2
+)
+index = KVIndex(os.path.join(db_dir, "kv_ttl.db"), eviction=ttl, maintenance_interval=None)
+index.update({"a": 1, "b": 2})
+assert index.getvalues(["a", "b"]) == [1, 2]
+time.sleep(0.3)
+index["c"] = 3
+assert len(index) == 1
+assert index.get("a") is None and "b" not in index
+assert index.getvalues(["a", "c"]) == [None, 3]
+
+time.sleep(0.3)
+assert "c" not in index and len(index) == 1
+index.maintain()
+assert len(index) == 0
+
+# tables created without created_at get it on the first open that needs it
+index = KVIndex(os.path.join(db_dir, "kv_created_at.db"))
+index["old"] = "value"
+before = time.time()
+index = KVIndex(os.path.join(db_dir, "kv_created_at.db"), store_created_at=True)
+value, created_at = index.getvalues(["old"], return_created_at=True)[0]
+assert value == "value" and created_at >= before - 1
+index.update({"new": 1}, created_at=[100])
+assert index.getvalues(["new", "missing"], return_created_at=True) == [(1, 100), (None, None)]
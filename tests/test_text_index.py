@@ -0,0 +1,69 @@
+import sys
+
+sys.path.append(".")
+
+from liteindex import DefinedIndex
+
+# full-text search through FTS5, on plain and zstd compressed strings
+
+for compression_level in [None, 3]:
+    index = DefinedIndex(
+        "test_text_index",
+        schema={"message": "string", "body": "compressed_string", "level": "number"},
+        compression_level=compression_level,
+    )
+    index.update(
+        {
+            "a": {"message": "disk full on node 3", "body": "write timeout", "level": 1},
+            "b": {"message": "connection timeout to db", "body": "retry", "level": 2},
+        }
+    )
+
+    # rows stored before the index was created are indexed too
+    index.create_text_index("message")
+    index.create_text_index("body")
+
+    index.update(
+        {"c": {"message": "timeout timeout everywhere", "body": "disk error", "level": 2}}
+    )
+
+    assert list(index.search({"message": {"$text": "timeout"}})) == ["b", "c"]
+    assert list(index.search({"body": {"$text": "disk OR timeout"}})) == ["a", "c"]
+    assert list(index.search({"message": {"$text": "time*"}, "level": 1})) == []
+    assert index.count({"message": {"$text": "timeout OR disk"}}) == 3
+
+    # bm25, the row mentioning timeout twice is more relevant
+    results = index.search(
+        {"message": {"$text": "timeout"}}, sort_by="$text", return_metadata=True
+    )
+    assert list(results) == ["c", "b"]
+    assert results["c"]["__meta"]["text_score"] < results["b"]["__meta"]["text_score"]
+    assert list(
+        index.search({"message": {"$text": "timeout"}}, sort_by="$text", reversed_sort=True)
+    ) == ["b", "c"]
+    assert list(
+        index.search({"message": {"$text": "timeout"}, "level": 2}, sort_by="$text", n=1)
+    ) == ["c"]
+
+    # updates and deletes are reflected
+    index.update({"c": {"body": "all fine"}})
+    assert list(index.search({"body": {"$text": "disk"}})) == []
+    assert list(index.search({"body": {"$text": "fine"}})) == ["c"]
+
+    index.delete("b")
+    assert list(index.search({"message": {"$text": "timeout"}})) == ["c"]
+
+    index.clear()
+    index.update({"d": {"message": "timeout again", "body": "disk"}})
+    assert list(index.search({"message": {"$text": "timeout"}})) == ["d"]
+    assert list(index.search({"body": {"$text": "disk"}})) == ["d"]
+
+    index.drop()
+
+try:
+    DefinedIndex("test_text_index_invalid", schema={"age": "number"}).create_text_index(
+        "age"
+    )
+    assert False
+except ValueError:
+    pass
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+
+from liteindex import TieredKVIndex, KVIndex, EvictionCfg
+
+db_dir = tempfile.mkdtemp()
+
+# write-through
+index = TieredKVIndex(os.path.join(db_dir, "wt.db"), hot_max_items=3)
+
+for i in range(5):
+    index[i] = i
+
+assert len(index.cold) == 5
+assert index.stats()["hot_items"] == 3
+
+assert index[4] == 4
+assert index.stats()["hot_hits"] == 1
+
+assert index[0] == 0
+assert index.stats()["cold_hits"] == 1
+
+assert index.getvalues([0, 1, "missing"], default="default") == [0, 1, "default"]
+assert index.stats()["misses"] == 1
+
+# write-back
+index = TieredKVIndex(os.path.join(db_dir, "wb.db"), hot_max_items=2, write_back=True)
+index.update({"a": 1, "b": 2})
+assert len(index.cold) == 0
+
+index["c"] = 3
+assert index.cold["a"] == 1
+assert index.stats()["demoted"] == 1
+
+index.flush()
+assert index.cold["c"] == 3
+
+assert index.pop("c") == 3
+assert "c" not in index
+
+# unhashable keys are cached too
+index[[1, 2]] = "list key"
+assert index[[1, 2]] == "list key"
+
+# keys equal in python but different in KVIndex keep their own values
+index[1] = "int"
+index[True] = "bool"
+index[1.0] = "float"
+assert index[1] == "int" and index[True] == "bool" and index[1.0] == "float"
+assert index.getvalues([1, True, 1.0]) == ["int", "bool", "float"]
+index.flush()
+assert index.cold[1] == "int" and index.cold[True] == "bool"
+
+# a key only in the write-back buffer can be deleted, and isn't written on flush
+index["buffered"] = 1
+assert "buffered" not in index.cold
+del index["buffered"]
+assert "buffered" not in index
+index.flush()
+assert "buffered" not in index.cold
+
+# invalidation of keys changed by other processes
+index = TieredKVIndex(os.path.join(db_dir, "inv.db"), invalidate_every_seconds=0)
+index["x"] = 1
+assert index["x"] == 1
+
+KVIndex(os.path.join(db_dir, "inv.db"))["x"] = 2
+assert index["x"] == 2
+
+# created_at is kept when written back, expired items are dropped from the hot tier
+index = TieredKVIndex(
+    os.path.join(db_dir, "ttl.db"),
+    write_back=True,
+    eviction=EvictionCfg(
+        EvictionCfg.EvictFIFO, max_number_of_items=100, invalidate_after_seconds=0.3
+    ),
+)
+index["x"] = 1
+created_at = index.getvalues(["x"], return_created_at=True)[0][1]
+index.flush()
+value, cold_created_at = index.cold.getvalues(["x"], return_created_at=True)[0]
+assert value == 1 and abs(cold_created_at - created_at) < 0.001
+time.sleep(0.4)
+assert "x" not in index and index.get("x") is None
+assert index.stats()["hot_items"] == 0